@@ -1,5 +1,37 @@
+from typing import Literal
+
 from pydantic import BaseModel
 
 class ChatRequest(BaseModel):
     prompt: str
     system: str | None = None
+    # react：逐步 ReAct；plan：一次规划工具 DAG 并发执行（plan-and-execute）；
+    # fanout：拆成子问题，多个子 agent 并发 ReAct 后合并
+    mode: Literal["react", "plan", "fanout"] = "react"
+    # 是否接着该 session 的历史对话继续（历史由服务端持久化，客户端不必重发）
+    use_memory: bool = True
+    # 只开放这些工具（按名字）；None = 全部。注册表很大时只挑用得到的，免得每个 prompt 都塞满工具说明
+    tools: list[str] | None = None
+    # 同步模式：POST 等 run 结束，直接返回最终回答 + 步骤统计（超过 deadline_s 取消 run）；
+    # 这时没有 SSE 订阅者就不发事件
+    wait: bool = False
+    deadline_s: float = 60.0
+
+
+class BatchRequest(BaseModel):
+    # prompts：纯文本列表；items：{"prompt", "id"?, "system"?}，两者可以同时给（prompts 在前）
+    prompts: list[str] = []
+    items: list[dict] = []
+    system: str | None = None  # 所有条目共用的 system（条目自带的优先）
+    concurrency: int = 16
+    rate_per_s: float = 0.0  # 每秒 LLM 调用上限，0 = 不额外限制（仍受全局限流器约束）
+    max_steps: int = 6
+    stream: bool = False  # True：直接按完成顺序流式返回 NDJSON 结果
+    job_id: str | None = None
+
+
+class BulkToolRequest(BaseModel):
+    calls: list[dict]  # [{"tool": "calc", "args": {...}}, ...]
+    concurrency: int = 32  # 这一批同时执行的上限（每个工具另有 ToolSpec.max_concurrency）
+    stream: bool = False  # True：按完成顺序流式返回 NDJSON；False：全部完成后按输入顺序一次返回
+    events: bool = False  # True：照常往该 session 的 SSE 发 tool_start / tool_end（量大时别开）
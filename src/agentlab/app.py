@@ -1,56 +1,314 @@
 import asyncio
-from fastapi import FastAPI, WebSocket, Body
+import contextlib
+import hmac
+from typing import Callable, Optional
+from fastapi import APIRouter, Depends, FastAPI, WebSocket, Body, Header, HTTPException, Request
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
 from sse_starlette.sse import EventSourceResponse
 
 from agentlab.config import settings
 from agentlab.runtime.task_manager import TaskManager
 
-from agentlab.runtime.events import EventBus
-from agentlab.api_schemas import ChatRequest
-from agentlab.models.gemini_genai import GeminiGenAIClient
+from agentlab.runtime.events import EventBus, NullBus, QuietBus
+from agentlab.runtime.batch import BatchJob, BatchManager, RateCappedLLMClient
+from agentlab.runtime.ws_gateway import GatewayConnection, GatewayError
+from agentlab.runtime.checkpoint import RunCheckpointStore
+from agentlab.api_schemas import BatchRequest, BulkToolRequest, ChatRequest
+from agentlab.runtime.cancel import CancellationToken
+from agentlab.models.base import LLMClient, capture_usage
+from agentlab.models.limiter import AdaptiveLimiter, LimitedLLMClient
+from agentlab.models.router import HedgedRouterClient
+from agentlab.models.recording import RecordingLLMClient
 from agentlab.tools.registry import ToolRegistry, ToolRunner, ToolError
 from agentlab.tools.builtins import register_builtin_tools
 from agentlab.orchestration.react_loop import run_react
+from agentlab.orchestration.plan_execute import run_plan_execute
+from agentlab.orchestration.fanout import run_fanout
+from agentlab.memory.session_store import SessionMemoryStore
 import json
 import time
-from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
-from agentlab.observability.otel import setup_otel
+from agentlab.observability.otel import sampling_stats, setup_otel
+from agentlab.observability import metrics, profiler
 
 # Added imports for OpenTelemetry context handling
 from opentelemetry import trace
 from opentelemetry import context as otel_context
-from opentelemetry.context import attach, detach
+from opentelemetry.context import Context, attach, detach
 import logging
 logger = logging.getLogger(__name__)
-setup_otel("agentlab")
 
-logger.info("Starting AgentLab...")
-
-app = FastAPI(title="AgentLab", version="0.1.0")
-FastAPIInstrumentor.instrument_app(app)
+# ✅ 新增：路由先挂在 router 上，create_app() 再装到 FastAPI 实例（import 本模块不建 app、不初始化 OTel）
+router = APIRouter()
 tracer = trace.get_tracer(__name__)
 # ✅ 新增：一个空的任务管理器对象，用于任务的启动和取消
-tm = TaskManager()
+tm = TaskManager(token_budget=settings.SESSION_TOKEN_BUDGET, max_sessions=settings.TASK_MAX_SESSIONS)
 # ✅ 新增：一个空的事件总线对象，用于事件的发布和订阅
 bus = EventBus()
+# ✅ 新增：不投递事件的 bus（批量任务 / 批量工具调用这类没人订阅 SSE 的路径）
+null_bus = NullBus()
 # ✅ 新增：一个空的工具注册中心对象
 tool_reg = ToolRegistry()
 # ✅ 新增：在工具注册中心注册一些内置工具
 register_builtin_tools(tool_reg)
 # ✅ 新增：一个空的工具运行器对象，用于工具的运行
 tool_runner = ToolRunner(tool_reg)
+# ✅ 新增：落盘的单例（会话记忆 / checkpoint / 向量记忆 / 批量任务）第一次用到时才建，同 LLM 后端：
+# import 本模块不建 data/ 目录、不 mmap、不加载 numpy
+_memory: SessionMemoryStore | None = None
+_checkpoints: RunCheckpointStore | None = None
+_checkpoints_ready = False  # CHECKPOINT_DIR 为空时 _checkpoints 一直是 None，单独记是否已经初始化过
+_vector_memory = None  # VectorMemoryIndex（模块本身带 numpy，用到时才 import）
+_batches: BatchManager | None = None
+
+
+def _memory_store() -> SessionMemoryStore:
+    """多轮会话记忆（append-only 日志 + 紧凑索引，最近窗口常驻内存）。"""
+    global _memory
+    if _memory is None:
+        _memory = SessionMemoryStore(
+            settings.MEMORY_DIR,
+            recent_turns=settings.MEMORY_RECENT_TURNS,
+            retention_turns=settings.MEMORY_RETENTION_TURNS or None,
+        )
+    return _memory
+
+
+def _checkpoint_store() -> RunCheckpointStore | None:
+    """ReAct run 的步骤级 checkpoint（进程重启 / 部署后从最后完成的步骤续跑），CHECKPOINT_DIR 为空则关闭。"""
+    global _checkpoints, _checkpoints_ready
+    if not _checkpoints_ready:
+        if settings.CHECKPOINT_DIR:
+            _checkpoints = RunCheckpointStore(settings.CHECKPOINT_DIR, compact_every=settings.CHECKPOINT_COMPACT_EVERY)
+        _checkpoints_ready = True
+    return _checkpoints
+
+
+def _vector_index():
+    """跨 session 的长期记忆（向量检索，top-k 注入 ReAct system prompt）。"""
+    global _vector_memory
+    if _vector_memory is None:
+        from agentlab.memory.vector_store import VectorMemoryIndex
+
+        _vector_memory = VectorMemoryIndex(
+            settings.VECTOR_MEMORY_DIR,
+            ivf_min_rows=settings.VECTOR_IVF_MIN_ROWS,
+            ivf_retrain_ratio=settings.VECTOR_IVF_RETRAIN_RATIO,
+        )
+    return _vector_memory
+
+
+# ✅ 新增：所有会话共享的 LLM 出站限流器（按 429/503 与延迟自适应并发）
+llm_limiter = AdaptiveLimiter(
+    initial_limit=settings.LLM_INITIAL_CONCURRENCY,
+    max_limit=settings.LLM_MAX_CONCURRENCY,
+    tpm_limit=settings.LLM_TPM_LIMIT or None,
+)
+
+# ✅ 新增：配置了备用模型时，所有 job 共享一个对冲路由（延迟直方图跨请求累积）
+_llm_router: HedgedRouterClient | None = None
+# ✅ 新增：可替换的后端工厂（压测 / 回放时注入 ScriptedLLMClient 等），为 None 时走 Gemini
+_llm_factory: Callable[[], LLMClient] | None = None
+# ✅ 新增：配置 LLM_RECORD_PATH 时所有真实后端调用共用一个录制器（一个文件句柄）
+_llm_recorder: RecordingLLMClient | None = None
+
+
+def set_llm_factory(factory: Callable[[], LLMClient] | None) -> None:
+    """注入 LLM 后端（react_chat / chat 都会用它），传 None 恢复默认 Gemini。"""
+    global _llm_factory
+    _llm_factory = factory
+
+
+def _gemini_backend():
+    # google.genai 光 import 就要几百毫秒：第一次真正用到 Gemini 时才加载
+    from agentlab.models.gemini_genai import GeminiGenAIClient
+
+    global _llm_router
+    fallbacks = [m.strip() for m in settings.GEMINI_FALLBACK_MODELS.split(",") if m.strip()]
+    if not fallbacks:
+        return GeminiGenAIClient()
+    if _llm_router is None:
+        primary = GeminiGenAIClient()
+        _llm_router = HedgedRouterClient(
+            [primary] + [GeminiGenAIClient(model=m) for m in fallbacks],
+            hedge_percentile=settings.LLM_HEDGE_PERCENTILE,
+            # 路由器内部 fallback 掉的 429/503 也让共享限流器看到
+            limiter=llm_limiter,
+        )
+    return _llm_router
+
+
+def _llm_backend():
+    global _llm_recorder
+    if _llm_factory is not None:
+        return _llm_factory()
+    if not settings.LLM_RECORD_PATH:
+        return _gemini_backend()
+    if _llm_recorder is None:
+        _llm_recorder = RecordingLLMClient(_gemini_backend(), settings.LLM_RECORD_PATH)
+    return _llm_recorder
+
+
+def make_llm_client(session_id: str, event_bus=None) -> LimitedLLMClient:
+    """每个 job 一个 client，但都挂在同一个限流器上（按 session 公平排队）。"""
+    return LimitedLLMClient(_llm_backend(), llm_limiter, key=session_id, bus=event_bus or bus, session_id=session_id)
+
+_otel_ready = False
+
+
+def create_app() -> FastAPI:
+    """
+    组装 FastAPI 应用：初始化 OTel（进程内只做一次）、挂路由、装 instrumentation 和 /metrics gauge。
+    uvicorn 可以用 `--factory agentlab.app:create_app`；`agentlab.app:app` 也照样能用（第一次访问时才创建）。
+    """
+    global _otel_ready
+    # instrumentation 只在真正建 app 时才 import
+    from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+
+    if not _otel_ready:
+        setup_otel("agentlab")
+        _otel_ready = True
+    logger.info("Starting AgentLab...")
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app: FastAPI):
+        # 启动 / 关停钩子挂在这个 app 实例上：create_app() 调几次都不会在共享 router 上越积越多
+        probe = asyncio.create_task(metrics.loop_lag_probe(), name="metrics:loop_lag")
+        app.state.loop_lag_probe = probe
+        _resume_checkpointed_runs()
+        try:
+            yield
+        finally:
+            probe.cancel()
+            if _checkpoints is not None:
+                _checkpoints.close()
+
+    app = FastAPI(title="AgentLab", version="0.1.0", lifespan=lifespan)
+    app.include_router(router)
+    FastAPIInstrumentor.instrument_app(app)
+    # ✅ 新增：/metrics 的抓取时 gauge（队列深度、线程池、任务数、限流器）
+    metrics.install_runtime_gauges(bus=bus, tm=tm, limiter=llm_limiter)
 
+    return app
 
-@app.get("/")
+
+def _resume_checkpointed_runs() -> None:
+    # 上一个进程被打断的 ReAct run：从各自最后完成的步骤接着跑
+    if not settings.CHECKPOINT_RESUME_ON_STARTUP:
+        return
+    checkpoints = _checkpoint_store()
+    if checkpoints is None:
+        return
+    for p in checkpoints.pending():
+        r, _ = _resume_react(p["session_id"])
+        logger.info("resume checkpointed run session=%s run=%s step=%s -> %s", p["session_id"], p["run_id"], p["step"], r)
+
+
+def __getattr__(name: str):
+    # `from agentlab.app import app` / `uvicorn agentlab.app:app`：第一次访问时创建默认 app 并缓存
+    if name == "app":
+        app = globals()["app"] = create_app()
+        return app
+    # 以前是模块级单例：保留按属性访问（第一次访问时才创建）
+    lazy = {"memory": _memory_store, "checkpoints": _checkpoint_store, "vector_memory": _vector_index, "batches": _batch_manager}
+    if name in lazy:
+        return lazy[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@router.get("/")
 def root():
     return {"name": "AgentLab", "env": settings.APP_ENV, "hint": "Try /health /docs"}
 
-@app.get("/health")
+@router.get("/health")
 def health():
-    return {"ok": True, "env": settings.APP_ENV}
+    return {
+        "ok": True,
+        "env": settings.APP_ENV,
+        "llm_limiter": llm_limiter.stats(),
+        "trace_sampling": sampling_stats(),
+    }
+
+@router.get("/metrics")
+async def get_metrics(format: str = "prometheus"):
+    """Prometheus 文本格式；?format=json 给人看（直方图折成 p50/p95/p99）。"""
+    if format == "json":
+        return metrics.registry.snapshot()
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+@router.get("/llm/backends")
+def llm_backends():
+    """各后端延迟直方图（p50/p95/p99）与对冲命中统计，用来调对冲阈值。"""
+    if _llm_router is None:
+        return {"hedging": False, "backends": {}}
+    return {"hedging": True, "hedge_percentile": _llm_router.hedge_percentile, "backends": _llm_router.stats()}
+
+# ✅ 新增：/admin/* 只对带 X-Admin-Token 的请求开放；没配 ADMIN_TOKEN 时当作不存在
+def _require_admin(x_admin_token: Optional[str] = Header(default=None)) -> None:
+    if not settings.ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token.encode(), settings.ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="invalid admin token")
+
+# ✅ 新增：手动重建向量记忆的 IVF 分桶（自动建桶见 VECTOR_IVF_MIN_ROWS）；训练在线程池里跑，不挡写入和检索
+@router.post("/admin/vector_memory/build_ivf", dependencies=[Depends(_require_admin)])
+async def vector_memory_build_ivf(n_lists: Optional[int] = None):
+    index = _vector_index()
+    t0 = time.perf_counter()
+    rows = await asyncio.to_thread(index.build_ivf, n_lists)
+    return {
+        "result": "built" if rows else "empty",
+        "rows": rows,
+        "count": index.count,
+        "elapsed_ms": round((time.perf_counter() - t0) * 1000, 1),
+    }
+
+# ✅ 新增：按需采样 profiling（可只看某个 session，结束后下载 folded-stack 画火焰图）
+@router.post("/admin/profile/start", dependencies=[Depends(_require_admin)])
+async def profile_start(
+    session_id: Optional[str] = None,
+    duration_s: float = 30.0,
+    interval_ms: float = 5.0,
+    mode: str = "cpu",
+):
+    """mode=cpu 只采正在执行的栈；mode=wall 另外展开该 session 挂起协程在 await 什么。"""
+    try:
+        p = profiler.start_profile(session_id=session_id, duration_s=duration_s, interval_ms=interval_ms, mode=mode)
+    except (ValueError, RuntimeError) as e:
+        return {"result": "rejected", "error": str(e)}
+    return {"result": "started", "profile": p.summary(top=0)}
+
+@router.post("/admin/profile/{profile_id}/stop", dependencies=[Depends(_require_admin)])
+async def profile_stop(profile_id: str):
+    p = profiler.get_profile(profile_id)
+    if p is None:
+        return {"result": "not_found"}
+    p.stop()
+    return {"result": "stopping"}
+
+@router.get("/admin/profile", dependencies=[Depends(_require_admin)])
+def profile_list():
+    return {"profiles": profiler.list_profiles()}
+
+@router.get("/admin/profile/{profile_id}", dependencies=[Depends(_require_admin)])
+def profile_get(profile_id: str, top: int = 15):
+    p = profiler.get_profile(profile_id)
+    if p is None:
+        return {"result": "not_found"}
+    return p.summary(top=top)
+
+@router.get("/admin/profile/{profile_id}/folded", dependencies=[Depends(_require_admin)])
+def profile_folded(profile_id: str):
+    """flamegraph.pl / speedscope 可直接打开的 folded-stack 文本。"""
+    p = profiler.get_profile(profile_id)
+    if p is None:
+        return {"result": "not_found"}
+    return PlainTextResponse(
+        p.folded(),
+        headers={"Content-Disposition": f'attachment; filename="profile-{p.id}.folded"'},
+    )
 
 # ✅ 新增：SSE 事件订阅（Day4 核心）
-@app.get("/session/{session_id}/events")
+@router.get("/session/{session_id}/events")
 async def sse_events(session_id: str):
     async def gen():
         yield {"event": "runtime", "data": json.dumps({"type": "see_connection", "session_id": session_id}, ensure_ascii=False),"id": str(time.time_ns()),}
@@ -59,15 +317,41 @@ async def sse_events(session_id: str):
     return EventSourceResponse(gen())
 
 # ✅ 可选：WebSocket 推事件（你如果之后做 Studio 更方便）
-@app.websocket("/ws/{session_id}")
+@router.websocket("/ws/{session_id}")
 async def ws(session_id: str, ws: WebSocket):
     await ws.accept()
-    q = bus.get_queue(session_id)
-    while True:
-        ev = await q.get()
+    # 走 subscribe（而不是直接读队列），WS 连接也算订阅者
+    async for ev in bus.subscribe(session_id):
         await ws.send_json(ev)
 
-@app.post("/session/{session_id}/start_demo")
+# ✅ 新增：多路复用 WS 网关：一条连接订阅多个 session（批量帧 + ack 流控），还能发 start / cancel / status
+def _gw_session_id(msg: dict) -> str:
+    sid = msg.get("session_id")
+    if not isinstance(sid, str) or not sid:
+        raise GatewayError("session_id is required")
+    return sid
+
+def _gw_start(msg: dict) -> dict:
+    fields = {k: v for k, v in msg.items() if k in ChatRequest.model_fields and k not in ("wait", "deadline_s")}
+    return {"result": _start_react(_gw_session_id(msg), ChatRequest(**fields))}
+
+async def _gw_cancel(msg: dict) -> dict:
+    return {"result": await _cancel_session(_gw_session_id(msg))}
+
+_gw_handlers = {
+    "start": _gw_start,
+    "cancel": _gw_cancel,
+    "status": lambda msg: tm.get_status(_gw_session_id(msg)),
+}
+
+@router.websocket("/ws")
+async def ws_gateway(ws: WebSocket, sessions: str = "", window: int = 1024):
+    """sessions：连上就订阅的 session（逗号分隔）；window：未 ack 事件上限（0 = 不等 ack）。协议见 runtime/ws_gateway.py。"""
+    await ws.accept()
+    conn = GatewayConnection(ws, bus, _gw_handlers, window=window)
+    await conn.serve([s for s in sessions.split(",") if s])
+
+@router.post("/session/{session_id}/start_demo")
 async def start_demo(session_id: str):
     """
     启动一个长任务：每 0.1s 跑一次，总共 300 次。
@@ -93,11 +377,11 @@ async def start_demo(session_id: str):
     return {"result": r}
 
 # ✅ 新增：真正的 Gemini 流式 chat（Day4 重点）
-@app.post("/session/{session_id}/chat")
+@router.post("/session/{session_id}/chat")
 async def chat(session_id: str, req: ChatRequest):
     async def job(token):
         await bus.publish(session_id, {"type": "run_start", "kind": "chat"})
-        client = GeminiGenAIClient()
+        client = make_llm_client(session_id)
 
         messages = []
         if req.system:
@@ -107,11 +391,12 @@ async def chat(session_id: str, req: ChatRequest):
         try:
             await bus.publish(session_id, {"type": "llm_start", "model": client.model})
 
-            async for chunk in client.stream(messages):
-                await token.checkpoint()  # ✅ 关键：每次输出前检查是否取消
-                await bus.publish(session_id, {"type": "llm_delta", "text": chunk})
+            with capture_usage() as usage:
+                async for chunk in client.stream(messages):
+                    await token.checkpoint()  # ✅ 关键：每次输出前检查是否取消
+                    await bus.publish(session_id, {"type": "llm_delta", "text": chunk})
 
-            await bus.publish(session_id, {"type": "llm_done"})
+            await bus.publish(session_id, {"type": "llm_done", "usage": usage.total.to_dict()})
             await bus.publish(session_id, {"type": "run_done", "kind": "chat"})
 
         except asyncio.CancelledError:
@@ -124,20 +409,39 @@ async def chat(session_id: str, req: ChatRequest):
     r = tm.start(session_id, job)
     return {"result": r}
 
-@app.post("/session/{session_id}/cancel")
-async def cancel(session_id: str):
+async def _cancel_session(session_id: str) -> str:
     # 先告诉前端：已请求取消（UI 可立刻变 stop 状态）
     await bus.publish(session_id, {"type": "cancel_called"})
     r = tm.cancel(session_id)
-    return {"result": r}
+    # 批量工具调用不占 TaskManager 槽位，单独登记，这里一起取消
+    bulk = _bulk_tokens.get(session_id)
+    if bulk:
+        for t in bulk:
+            t.cancel()
+        if r == "not_found":
+            r = "cancelling"
+    return r
 
-@app.get("/session/{session_id}/status")
+@router.post("/session/{session_id}/cancel")
+async def cancel(session_id: str):
+    return {"result": await _cancel_session(session_id)}
+
+@router.get("/session/{session_id}/status")
 def status(session_id: str):
     return tm.get_status(session_id)
 
-@app.get("/tools")
-def list_tools():
-    return {
+@router.get("/session/{session_id}/memory")
+async def get_memory(session_id: str, limit: int = 20):
+    return {"session_id": session_id, "total": _memory_store().count(session_id), "messages": await _memory_store().recent(session_id, limit)}
+
+@router.delete("/session/{session_id}/memory")
+async def clear_memory(session_id: str):
+    await _memory_store().clear(session_id)
+    return {"result": "cleared"}
+
+def _tools_json() -> bytes:
+    return json.dumps({
+        "version": tool_reg.version,
         "tools": [
             {
                 "name": t.name,
@@ -145,12 +449,18 @@ def list_tools():
                 "input_schema": t.input_schema,
                 "timeout_s": t.timeout_s,
                 "max_retries": t.retry.max_retries,
+                "max_concurrency": t.max_concurrency,
             }
             for t in tool_reg.list()
-        ]
-    }
+        ],
+    }, ensure_ascii=False).encode("utf-8")
+
+@router.get("/tools")
+def list_tools():
+    # 序列化好的 body 按注册表 version 缓存，注册表不变就不重复构造 / 编码
+    return Response(content=tool_reg.cached("tools_json", _tools_json), media_type="application/json")
 
-@app.post("/session/{session_id}/tool/{tool_name}")
+@router.post("/session/{session_id}/tool/{tool_name}")
 async def call_tool(session_id: str, tool_name: str, args: dict = Body(default={})):
     async def job(token):
         try:
@@ -168,43 +478,366 @@ async def call_tool(session_id: str, tool_name: str, args: dict = Body(default={
 
     r = tm.start(session_id, job)
     return {"result": r}
-@app.post("/session/{session_id}/react_chat")
-async def react_chat(session_id: str, req: ChatRequest):
+# ✅ 新增：批量工具调用：直接并发走 ToolRunner，结果同步返回（或 NDJSON 流），不经 TaskManager / SSE
+_bulk_tokens: dict[str, set[CancellationToken]] = {}
+
+
+@router.post("/session/{session_id}/tools/bulk")
+async def call_tools_bulk(session_id: str, req: BulkToolRequest, request: Request):
+    """
+    POST /session/{id}/cancel 会取消该 session 上进行中的批量调用；客户端断开同样会取消剩下的调用
+    （流式：响应写不出去时；非流式：轮询连接状态）。单批最多 BULK_MAX_CALLS 个调用。
+    """
+    if len(req.calls) > settings.BULK_MAX_CALLS:
+        return {"result": "rejected", "error": f"too many calls ({len(req.calls)} > {settings.BULK_MAX_CALLS})"}
+    token = CancellationToken()
+    _bulk_tokens.setdefault(session_id, set()).add(token)
+    target_bus = bus if req.events else null_bus
+
+    def _done() -> None:
+        tokens = _bulk_tokens.get(session_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                _bulk_tokens.pop(session_id, None)
+
+    results = tool_runner.run_many(
+        session_id=session_id, calls=req.calls, token=token, bus=target_bus, concurrency=req.concurrency,
+    )
+    if req.stream:
+        async def gen():
+            try:
+                async for r in results:
+                    yield json.dumps(r, ensure_ascii=False, default=str) + "\n"
+            finally:
+                await results.aclose()
+                _done()
+        return StreamingResponse(gen(), media_type="application/x-ndjson")
+
+    async def _watch_disconnect() -> None:
+        while not await request.is_disconnected():
+            await asyncio.sleep(0.5)
+        token.cancel()
+
+    t0 = time.perf_counter()
+    out: list = [None] * len(req.calls)
+    watcher = asyncio.create_task(_watch_disconnect())
+    try:
+        async for r in results:
+            out[r["index"]] = r
+    finally:
+        watcher.cancel()
+        await results.aclose()
+        _done()
+    ok = sum(1 for r in out if r and r.get("ok"))
+    return {
+        "ok": ok,
+        "failed": len(out) - ok,
+        "cancelled": token.cancelled,
+        "elapsed_ms": round((time.perf_counter() - t0) * 1000, 1),
+        "results": out,
+    }
+
+
+def _recall_scope(session_id: str) -> Optional[str]:
+    # 长期记忆默认只在本 session 内召回；RECALL_SCOPE=global 时跨 session（单租户部署）
+    return None if settings.RECALL_SCOPE == "global" else session_id
+
+
+def _start_react(session_id: str, req: ChatRequest, ev_bus=None, resume: Optional[dict] = None) -> str:
+    """
+    按 req 在 TaskManager 里启动一次 react / plan / fanout run（HTTP 和 WS 网关共用）。
+    react 模式每步写 checkpoint；resume 是 checkpoints.load() 的结果时从它最后完成的步骤续跑。
+    """
+    ev_bus = ev_bus or bus
+    tool_reg.normalize_names(req.tools)  # 有未知工具直接抛 ValueError，不启动 run
     parent_ctx = otel_context.get_current()
+    ckpt = None
+    checkpoints = _checkpoint_store()
+    if checkpoints is not None and req.mode == "react":
+        ckpt = checkpoints.run(
+            session_id,
+            req.model_dump(exclude={"wait", "deadline_s"}),
+            run_id=resume["run_id"] if resume else None,
+        )
     async def job(token):
-        logger.info(f"JOB STARTED {session_id}")
+        logger.info("react job started session=%s", session_id)
         token_handle = attach(parent_ctx)
+        t_start = time.perf_counter()
+        stats: dict = {}
         try:
-            with tracer.start_as_current_span("agent.run", attributes={"session_id": session_id, "kind": "react_chat"}):
-                await bus.publish(session_id, {"type": "react_user_input", "prompt": req.prompt, "system": req.system})
-                await bus.publish(session_id, {"type": "run_start", "kind": "react_chat"})
+            with tracer.start_as_current_span("agent.run", attributes={"session_id": session_id, "kind": "react_chat", "mode": req.mode}):
+                await ev_bus.publish(session_id, {"type": "react_user_input", "prompt": req.prompt, "system": req.system})
+                await ev_bus.publish(session_id, {"type": "run_start", "kind": "react_chat"})
                 try:
-                    client = GeminiGenAIClient()
-
-                    final_text = await run_react(
-                        session_id=session_id,
-                        llm=client,
-                        registry=tool_reg,
-                        runner=tool_runner,
-                        bus=bus,
-                        token=token,
-                        user_prompt=req.prompt,
-                        user_system=req.system,
-                        max_steps=6,
-                    )
+                    client = make_llm_client(session_id, ev_bus)
+                    # 续跑时历史已经在 checkpoint 的上下文里
+                    history = await _memory_store().recent(session_id) if req.use_memory and resume is None else []
+
+                    if req.mode == "plan":
+                        final_text = await run_plan_execute(
+                            session_id=session_id,
+                            llm=client,
+                            registry=tool_reg,
+                            runner=tool_runner,
+                            bus=ev_bus,
+                            token=token,
+                            user_prompt=req.prompt,
+                            user_system=req.system,
+                            history=history,
+                            tool_names=req.tools,
+                            stats=stats,
+                        )
+                    elif req.mode == "fanout":
+                        final_text = await run_fanout(
+                            session_id=session_id,
+                            llm=client,
+                            registry=tool_reg,
+                            runner=tool_runner,
+                            bus=ev_bus,
+                            token=token,
+                            user_prompt=req.prompt,
+                            user_system=req.system,
+                            tool_names=req.tools,
+                            stats=stats,
+                        )
+                    else:
+                        final_text = await run_react(
+                            session_id=session_id,
+                            llm=client,
+                            registry=tool_reg,
+                            runner=tool_runner,
+                            bus=ev_bus,
+                            token=token,
+                            user_prompt=req.prompt,
+                            user_system=req.system,
+                            max_steps=6,
+                            history=history,
+                            recall=_vector_index().scoped(_recall_scope(session_id)) if req.use_memory else None,
+                            recall_k=settings.RECALL_K,
+                            recall_token_budget=settings.RECALL_TOKEN_BUDGET,
+                            stats=stats,
+                            tool_names=req.tools,
+                            checkpoint=ckpt,
+                            resume=resume,
+                        )
+
+                    if req.use_memory:
+                        await _memory_store().append(session_id, [
+                            {"role": "user", "content": req.prompt},
+                            {"role": "assistant", "content": final_text},
+                        ])
+                        await _vector_index().add_async(
+                            [f"Q: {req.prompt}\nA: {final_text}"],
+                            [{"session_id": session_id}],
+                            scope=session_id,
+                        )
 
                     # 把最终答案也通过事件流发出去（给 UI/终端显示）
-                    await bus.publish(session_id, {"type": "final", "text": final_text})
-                    await bus.publish(session_id, {"type": "run_done", "kind": "react_chat"})
+                    await ev_bus.publish(session_id, {"type": "final", "text": final_text})
+                    await ev_bus.publish(session_id, {"type": "run_done", "kind": "react_chat"})
+                    if ckpt is not None:
+                        ckpt.finish()
+                    stats["elapsed_ms"] = (time.perf_counter() - t_start) * 1000
+                    return {
+                        "text": final_text,
+                        "stats": {k: round(v, 1) if isinstance(v, float) else v for k, v in stats.items()},
+                    }
 
                 except asyncio.CancelledError:
-                    await bus.publish(session_id, {"type": "cancelled", "kind": "react_chat"})
+                    await ev_bus.publish(session_id, {"type": "cancelled", "kind": "react_chat"})
+                    # 用户取消 / 超预算才丢弃 checkpoint；token 没取消说明是进程关停打断的，留着下次续跑
+                    if ckpt is not None and token.cancelled:
+                        ckpt.finish()
                     raise
                 except Exception as e:
-                    await bus.publish(session_id, {"type": "error", "kind": "react_chat", "error": str(e)})
+                    await ev_bus.publish(session_id, {"type": "error", "kind": "react_chat", "error": str(e)})
+                    if ckpt is not None:
+                        ckpt.finish()
                     raise
         finally:
             detach(token_handle)
 
-    r = tm.start(session_id, job)
-    return {"result": r}
+    return tm.start(session_id, job)
+
+
+def _resume_react(session_id: str) -> tuple[str, int | None]:
+    """从 checkpoint 续跑该 session 被打断的 ReAct run，返回 (TaskManager 启动结果, 续跑起点步骤)。"""
+    checkpoints = _checkpoint_store()
+    state = checkpoints.load(session_id) if checkpoints is not None else None
+    if state is None:
+        return "not_found", None
+    try:
+        r = _start_react(session_id, ChatRequest(**state["request"]), resume=state)
+    except ValueError as e:
+        # 请求本身已不合法（比如工具被注销了）：这个 checkpoint 续不了，丢掉
+        logger.warning("drop checkpoint session=%s: %s", session_id, e)
+        checkpoints.run(session_id, {}).finish()
+        return "invalid_checkpoint", None
+    return r, state["step"]
+
+
+@router.post("/session/{session_id}/react_chat")
+async def react_chat(session_id: str, req: ChatRequest):
+    # 同步等结果时没人订阅就不发事件（省掉几十个事件的构造 / 排队）；有 SSE 订阅者照常推送
+    try:
+        r = _start_react(session_id, req, QuietBus(bus) if req.wait else bus)
+    except ValueError as e:
+        return {"result": "invalid_request", "error": str(e)}
+    if not req.wait or r != "started":
+        return {"result": r}
+    # 同步模式：POST 直接等到结果；超过 deadline_s 取消这次 run
+    st = await tm.wait(session_id, timeout=req.deadline_s)
+    if st.get("status") == "running":
+        tm.cancel(session_id)
+        await tm.wait(session_id, timeout=1.0)
+        return {"result": "deadline_exceeded", "deadline_s": req.deadline_s}
+    return {"result": st.get("status"), "error": st.get("error"), **(st.get("result") or {}), "usage": st.get("usage")}
+
+
+@router.post("/session/{session_id}/resume")
+async def resume_react(session_id: str):
+    """手动续跑被打断的 ReAct run（启动时没自动续跑，或者当时 session 正忙）。"""
+    r, step = _resume_react(session_id)
+    return {"result": r, "from_step": step}
+
+
+@router.get("/checkpoints")
+def list_checkpoints():
+    checkpoints = _checkpoint_store()
+    if checkpoints is None:
+        return {"enabled": False, "pending": []}
+    return {"enabled": True, "pending": checkpoints.pending(), **checkpoints.stats()}
+
+
+@router.get("/session/{session_id}/result")
+async def session_result(session_id: str, timeout: float = 30.0):
+    """长轮询：run 还在跑就最多等 timeout 秒（不会取消它），结束后返回最终回答和统计。"""
+    st = await tm.wait(session_id, timeout=max(0.0, min(timeout, 300.0)))
+    if not st.get("exists"):
+        return {"result": "not_found"}
+    if st["status"] == "running":
+        return {"result": "pending", "usage": st.get("usage")}
+    return {"result": st["status"], "error": st.get("error"), **(st.get("result") or {}), "usage": st.get("usage")}
+
+
+# ✅ 新增：批量任务（夜间评测 / 回填）：不走 SSE、不占 TaskManager 的 session 槽，结果按完成顺序写 NDJSON
+
+
+async def _run_batch_item(job: BatchJob, item: dict, token) -> str:
+    sid = f"batch:{job.id}:{item['index']}"
+    # 先过 job 自己的速率上限，再到共享限流器排队（整个 job 一个 key，不挤占交互会话）
+    client = RateCappedLLMClient(LimitedLLMClient(_llm_backend(), llm_limiter, key=f"batch:{job.id}"), job.rate)
+    # 每条一个独立 trace（否则 10 万条都挂在提交请求的 HTTP span 下面）
+    with tracer.start_as_current_span(
+        "agent.run",
+        context=Context(),
+        attributes={"session_id": sid, "kind": "batch", "mode": "react", "batch.job_id": job.id},
+    ):
+        return await run_react(
+            session_id=sid,
+            llm=client,
+            registry=tool_reg,
+            runner=tool_runner,
+            bus=null_bus,
+            token=token,
+            user_prompt=item["prompt"],
+            user_system=item.get("system") or job.meta.get("system"),
+            max_steps=int(job.meta.get("max_steps") or 6),
+        )
+
+
+def _batch_manager() -> BatchManager:
+    """批量任务（输入 / 结果落盘在 BATCH_DIR）。"""
+    global _batches
+    if _batches is None:
+        _batches = BatchManager(settings.BATCH_DIR, _run_batch_item, max_concurrency=settings.BATCH_MAX_CONCURRENCY)
+    return _batches
+
+
+def _batch_response(job: BatchJob, stream: bool):
+    if stream:
+        return StreamingResponse(
+            job.follow(0), media_type="application/x-ndjson", headers={"X-Batch-Job-Id": job.id}
+        )
+    return {"result": "started", **job.status_dict()}
+
+
+@router.post("/batch")
+async def create_batch(req: BatchRequest):
+    try:
+        job = await _batch_manager().create(
+            [*req.prompts, *req.items],
+            concurrency=req.concurrency,
+            rate_per_s=req.rate_per_s,
+            system=req.system,
+            max_steps=req.max_steps,
+            job_id=req.job_id,
+        )
+    except ValueError as e:
+        return {"result": "rejected", "error": str(e)}
+    return _batch_response(job, req.stream)
+
+
+@router.post("/batch/ndjson")
+async def create_batch_ndjson(
+    request: Request,
+    concurrency: int = 16,
+    rate_per_s: float = 0.0,
+    system: Optional[str] = None,
+    max_steps: int = 6,
+    stream: bool = False,
+    job_id: Optional[str] = None,
+):
+    """流式上传：请求体每行一个 JSON（字符串或 {"prompt", "id"?, "system"?}），边收边落盘。"""
+    async def _lines():
+        buf = b""
+        async for chunk in request.stream():
+            buf += chunk
+            *lines, buf = buf.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+        if buf.strip():
+            yield json.loads(buf)
+
+    try:
+        job = await _batch_manager().create(
+            _lines(), concurrency=concurrency, rate_per_s=rate_per_s, system=system, max_steps=max_steps, job_id=job_id,
+        )
+    except ValueError as e:
+        return {"result": "rejected", "error": str(e)}
+    return _batch_response(job, stream)
+
+
+@router.get("/batch")
+def list_batches():
+    return {"jobs": _batch_manager().list()}
+
+
+@router.get("/batch/{job_id}")
+def batch_status(job_id: str):
+    job = _batch_manager().get(job_id)
+    if job is None:
+        return {"result": "not_found"}
+    return job.status_dict()
+
+
+@router.get("/batch/{job_id}/results")
+async def batch_results(job_id: str, offset: int = 0):
+    """按完成顺序的 NDJSON 结果；任务还在跑会一直跟随到结束。断线后带 offset=已收条数 接着收。"""
+    job = _batch_manager().get(job_id)
+    if job is None:
+        return {"result": "not_found"}
+    return StreamingResponse(job.follow(offset), media_type="application/x-ndjson")
+
+
+@router.post("/batch/{job_id}/cancel")
+async def batch_cancel(job_id: str):
+    return {"result": _batch_manager().cancel(job_id)}
+
+
+@router.post("/batch/{job_id}/resume")
+async def batch_resume(job_id: str, retry_failed: bool = True):
+    """跳过 results.jsonl 里已成功的条目，只跑剩下的（取消后 / 进程重启后）；retry_failed=false 时失败的也不重跑。"""
+    return {"result": _batch_manager().resume(job_id, retry_failed=retry_failed)}
@@ -7,5 +7,43 @@ load_dotenv()
 class Settings:
     APP_ENV: str = os.getenv("APP_ENV", "dev")
     LOG_LEVEL: str = os.getenv("LOG_LEVEL", "DEBUG")
+    # LLM 出站限流（所有会话共享，AIMD 自适应）
+    LLM_INITIAL_CONCURRENCY: int = int(os.getenv("LLM_INITIAL_CONCURRENCY", "4"))
+    LLM_MAX_CONCURRENCY: int = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+    LLM_TPM_LIMIT: int = int(os.getenv("LLM_TPM_LIMIT", "0"))  # 0 = 不做 TPM 记账
+    # 每个 session 累计 LLM token 上限（prompt + completion），到了就拒绝 / 取消 run；0 = 不限
+    SESSION_TOKEN_BUDGET: int = int(os.getenv("SESSION_TOKEN_BUDGET", "0"))
+    # TaskManager 最多记多少个 session 的用量 / 最后状态（LRU 淘汰不在跑的）
+    TASK_MAX_SESSIONS: int = int(os.getenv("TASK_MAX_SESSIONS", "10000"))
+    # 对冲 / fallback：逗号分隔的备用模型，为空则只用 GEMINI_MODEL
+    GEMINI_FALLBACK_MODELS: str = os.getenv("GEMINI_FALLBACK_MODELS", "")
+    LLM_HEDGE_PERCENTILE: float = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))
+    # 多轮会话记忆
+    MEMORY_DIR: str = os.getenv("MEMORY_DIR", "data/memory")
+    MEMORY_RECENT_TURNS: int = int(os.getenv("MEMORY_RECENT_TURNS", "10"))
+    MEMORY_RETENTION_TURNS: int = int(os.getenv("MEMORY_RETENTION_TURNS", "0"))  # 0 = 不裁剪
+    # 长期记忆（向量检索，注入 ReAct system prompt）
+    VECTOR_MEMORY_DIR: str = os.getenv("VECTOR_MEMORY_DIR", "data/vector_memory")
+    RECALL_K: int = int(os.getenv("RECALL_K", "5"))  # 0 = 不检索
+    # 条数到这个量就在后台自动训练 IVF 倒排分桶（暴力扫描在 ~1M 条时每次查询要读 ~512MB）；0 = 不自动建
+    VECTOR_IVF_MIN_ROWS: int = int(os.getenv("VECTOR_IVF_MIN_ROWS", "100000"))
+    # 建桶后新增的（要暴力扫的）尾部超过已建桶条数的这个比例就重新训练
+    VECTOR_IVF_RETRAIN_RATIO: float = float(os.getenv("VECTOR_IVF_RETRAIN_RATIO", "0.2"))
+    RECALL_TOKEN_BUDGET: int = int(os.getenv("RECALL_TOKEN_BUDGET", "400"))
+    # session：只召回本 session 写入的记忆；global：所有 session 共享（只适合单租户）
+    RECALL_SCOPE: str = os.getenv("RECALL_SCOPE", "session")
+    # 录制真实 LLM 交互（gzip JSONL），用于离线回放做性能回归；为空则不录
+    LLM_RECORD_PATH: str = os.getenv("LLM_RECORD_PATH", "")
+    # 批量任务（/batch）：输入 / 结果落盘目录，单个 job 的并发上限
+    BATCH_DIR: str = os.getenv("BATCH_DIR", "data/batches")
+    BATCH_MAX_CONCURRENCY: int = int(os.getenv("BATCH_MAX_CONCURRENCY", "256"))
+    # /tools/bulk 单次请求的调用数上限（更大的批走 /batch）
+    BULK_MAX_CALLS: int = int(os.getenv("BULK_MAX_CALLS", "10000"))
+    # ReAct run 的步骤级 checkpoint（重启 / 部署后续跑）：落盘目录（为空则关闭），启动时是否自动续跑
+    CHECKPOINT_DIR: str = os.getenv("CHECKPOINT_DIR", "data/checkpoints")
+    CHECKPOINT_COMPACT_EVERY: int = int(os.getenv("CHECKPOINT_COMPACT_EVERY", "16"))
+    CHECKPOINT_RESUME_ON_STARTUP: bool = os.getenv("CHECKPOINT_RESUME_ON_STARTUP", "1") != "0"
+    # /admin/* 管理接口（profiler 等）的访问令牌，请求头 X-Admin-Token；为空则管理接口整体关闭
+    ADMIN_TOKEN: str = os.getenv("ADMIN_TOKEN", "")
 
 settings = Settings()
\ No newline at end of file
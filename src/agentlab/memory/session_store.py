@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import re
+import struct
+import threading
+import time
+from typing import Deque, Dict, List, Optional
+
+from agentlab.types import Message
+import logging
+logger = logging.getLogger(__name__)
+
+# 索引每条 12 字节：日志内 offset(u64) + 行长度(u32)，第 i 条消息的位置 = idx[i*12:(i+1)*12]
+_IDX = struct.Struct("<QI")
+_SAFE_RE = re.compile(r"^[\w.-]{1,64}$")
+
+
+class SessionMemoryStore:
+    """
+    多轮会话记忆（按 session 持久化）：
+    - <root>/<sid>.jsonl：append-only 日志，每行一条 Message（带 ts）
+    - <root>/<sid>.idx  ：紧凑定长索引，读最近 N 条只需读索引尾部 + 一次 seek，不扫全量历史
+    - 进程内 LRU 缓存最近窗口：同一个 session 连续对话时不再读盘
+    - retention_turns：日志只保留最近 N 轮，超出一定比例后整体重写压缩（摊销成本）
+    """
+
+    def __init__(
+        self,
+        root: str = "data/memory",
+        *,
+        recent_turns: int = 10,
+        retention_turns: Optional[int] = None,
+        max_cached_sessions: int = 1024,
+    ) -> None:
+        self.root = root
+        self.recent_messages = recent_turns * 2  # 一轮 = user + assistant
+        self.retention_messages = retention_turns * 2 if retention_turns else None
+        self.max_cached_sessions = max_cached_sessions
+        self._cache: "collections.OrderedDict[str, Deque[Message]]" = collections.OrderedDict()
+        self._counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    # ---------- 路径 ----------
+
+    def _base(self, session_id: str) -> str:
+        name = session_id if _SAFE_RE.match(session_id) else hashlib.sha1(session_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, name)
+
+    # ---------- 对外 API（async，文件 IO 放线程池） ----------
+
+    async def append(self, session_id: str, messages: List[Message]) -> None:
+        if not messages:
+            return
+        await asyncio.to_thread(self._append_sync, session_id, messages)
+
+    async def recent(self, session_id: str, limit: Optional[int] = None) -> List[Message]:
+        """最近 limit 条消息（默认 recent_turns 轮）。命中缓存时不碰磁盘。"""
+        limit = self.recent_messages if limit is None else limit
+        cached = self._cache.get(session_id)
+        if cached is not None and (limit <= len(cached) or len(cached) == self._counts.get(session_id, -1)):
+            self._cache.move_to_end(session_id)
+            return list(cached)[-limit:] if limit else []
+        msgs = await asyncio.to_thread(self._load_tail_sync, session_id, max(limit, self.recent_messages))
+        return msgs[-limit:] if limit else []
+
+    async def clear(self, session_id: str) -> None:
+        await asyncio.to_thread(self._clear_sync, session_id)
+
+    def count(self, session_id: str) -> int:
+        """日志中的消息条数（读索引文件大小，O(1)）。"""
+        if session_id in self._counts:
+            return self._counts[session_id]
+        try:
+            return os.path.getsize(self._base(session_id) + ".idx") // _IDX.size
+        except FileNotFoundError:
+            return 0
+
+    # ---------- 同步实现 ----------
+
+    def _append_sync(self, session_id: str, messages: List[Message]) -> None:
+        base = self._base(session_id)
+        now = time.time()
+        with self._lock:
+            prev = self._counts[session_id] if session_id in self._counts else self.count(session_id)
+            with open(base + ".jsonl", "ab") as log, open(base + ".idx", "ab") as idx:
+                offset = log.tell()
+                idx_buf = bytearray()
+                log_buf = bytearray()
+                for m in messages:
+                    line = json.dumps({**m, "ts": now}, ensure_ascii=False).encode("utf-8") + b"\n"
+                    idx_buf += _IDX.pack(offset + len(log_buf), len(line))
+                    log_buf += line
+                log.write(log_buf)
+                idx.write(idx_buf)
+            self._counts[session_id] = prev + len(messages)
+
+            cached = self._cache.get(session_id)
+            if cached is not None:
+                cached.extend(messages)
+
+            if self.retention_messages and self._counts[session_id] > self.retention_messages * 1.5:
+                self._compact_locked(session_id)
+
+    def _load_tail_sync(self, session_id: str, n: int) -> List[Message]:
+        base = self._base(session_id)
+        with self._lock:
+            try:
+                with open(base + ".idx", "rb") as idx:
+                    idx.seek(0, os.SEEK_END)
+                    total = idx.tell() // _IDX.size
+                    take = min(n, total)
+                    idx.seek((total - take) * _IDX.size)
+                    raw_idx = idx.read(take * _IDX.size)
+            except FileNotFoundError:
+                total, take, raw_idx = 0, 0, b""
+
+            msgs: List[Message] = []
+            if take:
+                first_off, _ = _IDX.unpack_from(raw_idx, 0)
+                last_off, last_len = _IDX.unpack_from(raw_idx, (take - 1) * _IDX.size)
+                # 最近的 N 条在日志里是连续的：一次 seek + 一次 read
+                with open(base + ".jsonl", "rb") as log:
+                    log.seek(first_off)
+                    blob = log.read(last_off + last_len - first_off)
+                for line in blob.splitlines():
+                    try:
+                        rec = json.loads(line)
+                    except Exception:
+                        continue
+                    rec.pop("ts", None)
+                    msgs.append(rec)
+
+            self._counts[session_id] = total
+            self._cache[session_id] = collections.deque(msgs, maxlen=max(self.recent_messages, n))
+            self._cache.move_to_end(session_id)
+            while len(self._cache) > self.max_cached_sessions:
+                self._cache.popitem(last=False)
+        return msgs
+
+    def _compact_locked(self, session_id: str) -> None:
+        """只保留最近 retention 条：写临时文件后原子替换，日志和索引一起重建。"""
+        base = self._base(session_id)
+        keep = self.retention_messages or 0
+        with open(base + ".idx", "rb") as idx:
+            raw = idx.read()
+        total = len(raw) // _IDX.size
+        start = max(0, total - keep)
+        if start == 0:
+            return
+        first_off, _ = _IDX.unpack_from(raw, start * _IDX.size)
+        with open(base + ".jsonl", "rb") as log:
+            log.seek(first_off)
+            blob = log.read()
+        new_idx = bytearray()
+        for i in range(start, total):
+            off, length = _IDX.unpack_from(raw, i * _IDX.size)
+            new_idx += _IDX.pack(off - first_off, length)
+        with open(base + ".jsonl.tmp", "wb") as f:
+            f.write(blob)
+        with open(base + ".idx.tmp", "wb") as f:
+            f.write(new_idx)
+        os.replace(base + ".jsonl.tmp", base + ".jsonl")
+        os.replace(base + ".idx.tmp", base + ".idx")
+        self._counts[session_id] = total - start
+        logger.info("compacted memory session=%s kept=%d dropped=%d", session_id, total - start, start)
+
+    def _clear_sync(self, session_id: str) -> None:
+        base = self._base(session_id)
+        with self._lock:
+            for ext in (".jsonl", ".idx"):
+                try:
+                    os.remove(base + ext)
+                except FileNotFoundError:
+                    pass
+            self._cache.pop(session_id, None)
+            self._counts.pop(session_id, None)
@@ -0,0 +1,399 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Embedder(ABC):
+    """文本 -> 向量。实现必须返回 L2 归一化的 float32 矩阵 (n, dim)，这样内积就是余弦相似度。"""
+
+    dim: int
+
+    @abstractmethod
+    def embed(self, texts: Sequence[str]) -> np.ndarray: ...
+
+
+_WORD_RE = re.compile(r"[a-z0-9_]+|[一-鿿]")
+
+
+class HashingEmbedder(Embedder):
+    """
+    本地确定性 embedding（特征哈希）：英文按词、中文按单字 + 相邻二元组，crc32 映射到桶并带符号。
+    不依赖模型/网络，同样的文本永远得到同样的向量；语义能力有限，生产可以换成真正的 embedding 模型。
+    """
+
+    def __init__(self, dim: int = 128) -> None:
+        self.dim = dim
+
+    def _features(self, text: str) -> List[str]:
+        toks = _WORD_RE.findall(text.lower())
+        feats = list(toks)
+        feats += [a + b for a, b in zip(toks, toks[1:])]
+        return feats
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, t in enumerate(texts):
+            for f in self._features(t):
+                h = zlib.crc32(f.encode("utf-8"))
+                out[i, h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return out / norms
+
+
+def _scope_key(scope: str) -> int:
+    # 0 留给不属于任何 scope 的行（老数据 / 全局记忆）
+    return zlib.crc32(scope.encode("utf-8")) or 1
+
+
+class _Storage(NamedTuple):
+    """三个按行对齐的 memmap；扩容时整体换一个新的（单次赋值），并发读者拿到的要么全旧要么全新。"""
+
+    vecs: np.ndarray
+    offsets: np.ndarray
+    scopes: np.ndarray
+
+
+class VectorMemoryIndex:
+    """
+    长期记忆向量索引（单文件矩阵 + memmap）：
+    - <root>/vectors.f32：float32 矩阵 (capacity, dim)，np.memmap 映射，容量不够时翻倍扩容
+    - <root>/meta.jsonl + offsets.u64：每行一条记忆的文本和元数据，按行号随机访问
+    - <root>/scopes.u32：每行所属 scope（一般是 session_id）的哈希；带 scope 检索时先按它过滤，
+      不同 session / 租户的记忆互相召回不到
+    - <root>/state.json：已写入条数（写完向量和元数据后才更新，崩溃时多写的尾部会被忽略）
+    - search()：批量 query 一次矩阵乘，分块 + argpartition 取 top-k，内存占用与总条数无关
+    - 并发：写入串行（_lock）；检索在 to_thread 的多个线程里不加锁跑，读的是 count 和 _storage / _ivf 的快照
+    - build_ivf()：条数很大时（~1M）暴力扫描受内存带宽限制（单核几十 ms），可离线训练倒排分桶（IVF），
+      查询只扫 nprobe 个桶 + 建桶之后新增的尾部，单核降到毫秒级（近似检索，召回率随 nprobe 提升）
+    - 自动建桶：ivf_min_rows > 0 时，写入后条数到了 ivf_min_rows、或建桶后新增的尾部超过已建桶条数的
+      ivf_retrain_ratio，就在后台线程里重新 build_ivf（同时只跑一个，训练期间不挡写入和检索）
+    """
+
+    CHUNK_ROWS = 262_144
+
+    def __init__(
+        self,
+        root: str,
+        embedder: Optional[Embedder] = None,
+        *,
+        initial_capacity: int = 4096,
+        ivf_min_rows: int = 0,
+        ivf_retrain_ratio: float = 0.2,
+    ) -> None:
+        self.root = root
+        self.embedder = embedder or HashingEmbedder()
+        self.dim = self.embedder.dim
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self.ivf_min_rows = ivf_min_rows
+        self.ivf_retrain_ratio = ivf_retrain_ratio
+        self._ivf_lock = threading.Lock()  # 串行化 build_ivf（训练不持有 _lock）
+        self._ivf_building = False
+        self._vec_path = os.path.join(root, "vectors.f32")
+        self._meta_path = os.path.join(root, "meta.jsonl")
+        self._off_path = os.path.join(root, "offsets.u64")
+        self._scope_path = os.path.join(root, "scopes.u32")
+        self._state_path = os.path.join(root, "state.json")
+        self._ivf_path = os.path.join(root, "ivf.npz")
+
+        self.count = 0
+        self._meta_end = 0
+        if os.path.exists(self._state_path):
+            with open(self._state_path, "r", encoding="utf-8") as f:
+                st = json.load(f)
+            if st.get("dim") != self.dim:
+                raise ValueError(f"index dim {st.get('dim')} != embedder dim {self.dim}")
+            self.count = int(st.get("count", 0))
+            self._meta_end = int(st.get("meta_end", 0))
+        capacity = max(initial_capacity, self.count)
+        if os.path.exists(self._vec_path):
+            capacity = max(capacity, os.path.getsize(self._vec_path) // (4 * self.dim))
+        self._storage = self._open(capacity)
+
+        # IVF：centroids (n_lists, dim)；list_rows 按桶拼接的行号；list_offsets[i]:list_offsets[i+1] 是第 i 个桶；
+        # count 是建桶时的条数（和桶放在同一个 dict 里整体替换）
+        self._ivf: Optional[Dict[str, Any]] = None
+        if os.path.exists(self._ivf_path):
+            with np.load(self._ivf_path) as z:
+                self._ivf = {k: z[k] for k in ("centroids", "list_rows", "list_offsets")}
+                self._ivf["count"] = int(z["count"])
+
+    @property
+    def capacity(self) -> int:
+        return len(self._storage.vecs)
+
+    @property
+    def ivf_count(self) -> int:
+        ivf = self._ivf
+        return ivf["count"] if ivf is not None else 0
+
+    # ---------- 存储 ----------
+
+    def _map(self, path: str, dtype: Any, capacity: int, row_bytes: int, shape: tuple) -> np.memmap:
+        mode = "r+" if os.path.exists(path) else "w+"
+        if mode == "r+" and os.path.getsize(path) < capacity * row_bytes:
+            with open(path, "r+b") as f:
+                f.truncate(capacity * row_bytes)
+        return np.memmap(path, dtype=dtype, mode=mode, shape=shape)
+
+    def _open(self, capacity: int) -> _Storage:
+        return _Storage(
+            vecs=self._map(self._vec_path, np.float32, capacity, self.dim * 4, (capacity, self.dim)),
+            offsets=self._map(self._off_path, np.uint64, capacity, 8, (capacity,)),
+            scopes=self._map(self._scope_path, np.uint32, capacity, 4, (capacity,)),
+        )
+
+    def _ensure_capacity(self, need: int) -> None:
+        # 调用方持有 _lock；旧 memmap 不主动关闭，正在检索的线程用完后随引用释放
+        if need <= self.capacity:
+            return
+        cap = self.capacity
+        while cap < need:
+            cap *= 2
+        for arr in self._storage:
+            arr.flush()
+        self._storage = self._open(cap)
+
+    def _write_state(self) -> None:
+        tmp = self._state_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"count": self.count, "dim": self.dim, "meta_end": self._meta_end}, f)
+        os.replace(tmp, self._state_path)
+
+    # ---------- 写入 ----------
+
+    def add(
+        self,
+        texts: Sequence[str],
+        metas: Optional[Sequence[Dict[str, Any]]] = None,
+        scope: Optional[str] = None,
+    ) -> List[int]:
+        """增量写入一批记忆，返回行号；scope（如 session_id）给了的话只有同 scope 的检索能召回。"""
+        if not texts:
+            return []
+        metas = metas or [{} for _ in texts]
+        if scope is not None:
+            metas = [{**m, "scope": scope} for m in metas]
+        vecs = self.embedder.embed(texts)
+        with self._lock:
+            start = self.count
+            self._ensure_capacity(start + len(texts))
+            st = self._storage
+            st.vecs[start:start + len(texts)] = vecs
+            st.scopes[start:start + len(texts)] = _scope_key(scope) if scope is not None else 0
+            with open(self._meta_path, "ab") as f:
+                # 以 state.json 为准：截掉上次崩溃时多写的孤儿行
+                f.truncate(self._meta_end)
+                pos = self._meta_end
+                for i, (t, m) in enumerate(zip(texts, metas)):
+                    line = json.dumps({"text": t, "ts": time.time(), **m}, ensure_ascii=False).encode("utf-8") + b"\n"
+                    st.offsets[start + i] = pos
+                    f.write(line)
+                    pos += len(line)
+            self._meta_end = pos
+            for arr in st:
+                arr.flush()
+            self.count = start + len(texts)
+            self._write_state()
+        self.maybe_build_ivf()
+        return list(range(start, start + len(texts)))
+
+    def needs_ivf(self) -> bool:
+        """条数到了 ivf_min_rows，且还没建桶 / 建桶后新增的尾部太长（尾部每次查询都要暴力扫）。"""
+        if self.ivf_min_rows <= 0 or self.count < self.ivf_min_rows:
+            return False
+        built = self.ivf_count
+        return built == 0 or self.count - built > built * self.ivf_retrain_ratio
+
+    def maybe_build_ivf(self) -> bool:
+        """需要的话在后台线程里 build_ivf，返回这次是否启动了构建。"""
+        with self._ivf_lock:
+            if self._ivf_building or not self.needs_ivf():
+                return False
+            self._ivf_building = True
+
+        def _run() -> None:
+            try:
+                self.build_ivf()
+            except Exception:
+                logger.exception("background IVF build failed")
+            finally:
+                self._ivf_building = False
+
+        threading.Thread(target=_run, name="vector-ivf-build", daemon=True).start()
+        return True
+
+    # ---------- 查询 ----------
+
+    def _meta(self, rows: Sequence[int]) -> List[Dict[str, Any]]:
+        out: List[Dict[str, Any]] = []
+        if not rows:
+            return out
+        offsets = self._storage.offsets
+        with open(self._meta_path, "rb") as f:
+            for r in rows:
+                f.seek(int(offsets[r]))
+                out.append(json.loads(f.readline()))
+        return out
+
+    @staticmethod
+    def _merge_topk(best_s: np.ndarray, best_i: np.ndarray, scores: np.ndarray, rows: np.ndarray, k: int):
+        """把一块候选 (b, m) 合并进当前 top-k。rows 可以是 (m,) 共享行号或 (b, m)。"""
+        kk = min(k, scores.shape[1])
+        if kk == 0:
+            return best_s, best_i
+        part = np.argpartition(scores, -kk, axis=1)[:, -kk:]
+        part_s = np.take_along_axis(scores, part, axis=1)
+        part_i = rows[part] if rows.ndim == 1 else np.take_along_axis(rows, part, axis=1)
+        cand_s = np.concatenate([best_s, part_s], axis=1)
+        cand_i = np.concatenate([best_i, part_i], axis=1)
+        keep = np.argpartition(cand_s, -k, axis=1)[:, -k:]
+        return np.take_along_axis(cand_s, keep, axis=1), np.take_along_axis(cand_i, keep, axis=1)
+
+    def search_vectors(
+        self, queries: np.ndarray, k: int = 5, nprobe: int = 8, scope: Optional[str] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        批量 top-k 余弦检索：queries (b, dim) 已归一化。
+        返回 (scores (b, k'), rows (b, k'))，按分数降序；k' = min(k, count)。
+        有 IVF 时只扫 nprobe 个最近的桶 + 建桶后新增的行；否则分块暴力扫描。
+        给了 scope 时其它 scope 的行分数记为 -inf（凑不满 k 的位置也是 -inf，行号 -1）。
+        """
+        # 先读 count 再拿快照：count 只在向量写完后才增加，快照里一定有前 n 行
+        n = self.count
+        st = self._storage
+        ivf = self._ivf
+        skey = _scope_key(scope) if scope is not None else None
+        b = queries.shape[0]
+        k = min(k, n)
+        if k == 0:
+            return np.zeros((b, 0), np.float32), np.zeros((b, 0), np.int64)
+        q = np.ascontiguousarray(queries, dtype=np.float32)
+        best_s = np.full((b, k), -np.inf, dtype=np.float32)
+        best_i = np.full((b, k), -1, dtype=np.int64)
+
+        scan_from = 0
+        if ivf is not None and ivf["count"] <= n:
+            cents, rows_all, offs = ivf["centroids"], ivf["list_rows"], ivf["list_offsets"]
+            probe = np.argpartition(q @ cents.T, -min(nprobe, len(cents)), axis=1)[:, -min(nprobe, len(cents)):]
+            for qi in range(b):
+                rows = np.concatenate([rows_all[offs[c]:offs[c + 1]] for c in probe[qi]])
+                if rows.size == 0:
+                    continue
+                rows.sort()  # 按行号顺序访问 memmap，减少随机 IO
+                scores = st.vecs[rows] @ q[qi]
+                if skey is not None:
+                    scores[st.scopes[rows] != skey] = -np.inf
+                s1, i1 = self._merge_topk(best_s[qi:qi + 1], best_i[qi:qi + 1], scores[None, :], rows.astype(np.int64), k)
+                best_s[qi], best_i[qi] = s1[0], i1[0]
+            scan_from = ivf["count"]
+
+        for lo in range(scan_from, n, self.CHUNK_ROWS):
+            hi = min(n, lo + self.CHUNK_ROWS)
+            scores = q @ st.vecs[lo:hi].T  # (b, chunk)
+            if skey is not None:
+                scores[:, st.scopes[lo:hi] != skey] = -np.inf
+            best_s, best_i = self._merge_topk(best_s, best_i, scores, np.arange(lo, hi, dtype=np.int64), k)
+
+        order = np.argsort(-best_s, axis=1)
+        best_s = np.take_along_axis(best_s, order, axis=1)
+        best_i = np.take_along_axis(best_i, order, axis=1)
+        return best_s, best_i
+
+    def build_ivf(self, n_lists: Optional[int] = None, *, sample: int = 65_536, iters: int = 8, seed: int = 0) -> int:
+        """
+        离线训练倒排分桶（球面 k-means）：采样训练中心，再分块把所有行分配到最近中心，返回建桶的条数。
+        只在拿 count / 存储快照时短暂持有写锁（已写入的行不会再变），训练期间写入和检索照常；
+        之后新增的行不在桶里，查询时按尾部暴力扫描；尾部变大后重新 build 即可（ivf_min_rows 开了会自动做）。
+        """
+        with self._lock:
+            n = self.count
+            vecs = self._storage.vecs
+        if n == 0:
+            return 0
+        n_lists = n_lists or max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+        train = np.asarray(vecs[np.sort(rng.choice(n, size=min(sample, n), replace=False))])
+        cents = train[rng.choice(len(train), size=min(n_lists, len(train)), replace=False)].copy()
+        for _ in range(iters):
+            assign = np.argmax(train @ cents.T, axis=1)
+            for c in range(len(cents)):
+                members = train[assign == c]
+                if len(members):
+                    v = members.sum(axis=0)
+                    cents[c] = v / (np.linalg.norm(v) or 1.0)
+        assign_all = np.empty(n, dtype=np.int32)
+        for lo in range(0, n, self.CHUNK_ROWS):
+            hi = min(n, lo + self.CHUNK_ROWS)
+            assign_all[lo:hi] = np.argmax(vecs[lo:hi] @ cents.T, axis=1)
+        list_rows = np.argsort(assign_all, kind="stable").astype(np.int64)
+        list_offsets = np.zeros(len(cents) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign_all, minlength=len(cents)), out=list_offsets[1:])
+        with self._ivf_lock:
+            if self.ivf_count >= n:
+                return self.ivf_count  # 并发的另一次构建更新
+            tmp = self._ivf_path + ".tmp.npz"
+            np.savez(tmp, centroids=cents, list_rows=list_rows, list_offsets=list_offsets, count=np.int64(n))
+            os.replace(tmp, self._ivf_path)
+            self._ivf = {"centroids": cents, "list_rows": list_rows, "list_offsets": list_offsets, "count": n}
+        logger.info("built IVF lists=%d rows=%d", len(cents), n)
+        return n
+
+    def search(
+        self, queries: Sequence[str], k: int = 5, min_score: float = 0.0, scope: Optional[str] = None,
+    ) -> List[List[Dict[str, Any]]]:
+        """批量文本检索，每个 query 返回 [{"score", "text", ...meta}]；scope 不为 None 时只在该 scope 里找。"""
+        if not queries:
+            return []
+        scores, rows = self.search_vectors(self.embedder.embed(queries), k, scope=scope)
+        out: List[List[Dict[str, Any]]] = []
+        for srow, rrow in zip(scores, rows):
+            keep = [(float(s), int(r)) for s, r in zip(srow, rrow) if s > min_score]
+            metas = self._meta([r for _, r in keep])
+            hits = [{"score": round(s, 4), **m} for (s, _), m in zip(keep, metas)]
+            if scope is not None:
+                hits = [h for h in hits if h.get("scope") == scope]  # 哈希撞了也不会串
+            out.append(hits)
+        return out
+
+    async def recall(
+        self, query: str, k: int = 5, min_score: float = 0.05, scope: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """给 run_react 用的异步接口：检索放线程池，不阻塞 event loop。"""
+        hits = await asyncio.to_thread(self.search, [query], k, min_score, scope)
+        return hits[0] if hits else []
+
+    async def add_async(
+        self,
+        texts: Sequence[str],
+        metas: Optional[Sequence[Dict[str, Any]]] = None,
+        scope: Optional[str] = None,
+    ) -> List[int]:
+        return await asyncio.to_thread(self.add, texts, metas, scope)
+
+    def scoped(self, scope: Optional[str]) -> "ScopedRecall":
+        """绑定 scope 的只读视图（run_react 的 recall 参数用）；scope=None 即全局检索。"""
+        return ScopedRecall(self, scope)
+
+
+class ScopedRecall:
+    def __init__(self, index: VectorMemoryIndex, scope: Optional[str]) -> None:
+        self.index = index
+        self.scope = scope
+
+    async def recall(self, query: str, k: int = 5, min_score: float = 0.05) -> List[Dict[str, Any]]:
+        return await self.index.recall(query, k, min_score, scope=self.scope)
@@ -1,8 +1,112 @@
 from abc import ABC, abstractmethod
-from typing import AsyncIterator, List
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
 from agentlab.types import Message
 
+
+class LLMOverloadedError(RuntimeError):
+    """上游返回 429/503（配额耗尽 / 过载）。限流器据此收缩并发窗口，而不是各自盲目 sleep。"""
+
+
+def estimate_tokens(messages: List[Message]) -> int:
+    """粗略估算 token 数（约 4 字符 / token），只用于限流记账，不追求精确。"""
+    chars = sum(len(m.get("content") or "") for m in messages)
+    return chars // 4 + 1
+
+
+@dataclass
+class Usage:
+    """一次（或累计多次）LLM 调用的用量。estimated=True 表示后端没报用量，是按字符估的。"""
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+    ttft_ms: Optional[float] = None  # 流式首 chunk 耗时（不含限流排队）；累计时取第一次
+    calls: int = 1
+    estimated: bool = False
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, other: "Usage") -> None:
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.cached_tokens += other.cached_tokens
+        self.calls += other.calls
+        self.estimated = self.estimated or other.estimated
+        if self.ttft_ms is None:
+            self.ttft_ms = other.ttft_ms
+
+    def to_dict(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "total_tokens": self.total_tokens,
+            "calls": self.calls,
+        }
+        if self.ttft_ms is not None:
+            out["ttft_ms"] = round(self.ttft_ms, 1)
+        if self.estimated:
+            out["estimated"] = True
+        return out
+
+
+class UsageRecorder:
+    """
+    收集当前上下文里的 LLM 用量。可以嵌套：记到子 recorder 的用量同时累加到所有祖先
+    （react.step -> 一次 run -> 整个 session）。on_record 在每次累加后调用（预算检查用）。
+    """
+
+    def __init__(self, parent: Optional["UsageRecorder"] = None, on_record: Optional[Callable[[], None]] = None) -> None:
+        self.parent = parent
+        self.on_record = on_record
+        self.total = Usage(calls=0)  # 只留累计值：session 级的 recorder 会活很久
+
+    def record(self, usage: Usage) -> None:
+        self.total.add(usage)
+        if self.parent is not None:
+            self.parent.record(usage)
+        if self.on_record is not None:
+            self.on_record()
+
+
+_usage_recorder: ContextVar[Optional[UsageRecorder]] = ContextVar("llm_usage_recorder", default=None)
+
+
+def current_usage_recorder() -> Optional[UsageRecorder]:
+    return _usage_recorder.get()
+
+
+def record_usage(usage: Usage) -> None:
+    """LLMClient 实现拿到后端报告的用量后调用；没有人在收集时什么都不做。"""
+    rec = _usage_recorder.get()
+    if rec is not None:
+        rec.record(usage)
+
+
+@contextmanager
+def capture_usage(recorder: Optional[UsageRecorder] = None) -> Iterator[UsageRecorder]:
+    """
+    在这个 with 块里（包括其中创建的子 task）发生的 LLM 调用用量都记到返回的 recorder 上，
+    并继续累加到外层 recorder。
+    """
+    rec = recorder or UsageRecorder(parent=_usage_recorder.get())
+    tok = _usage_recorder.set(rec)
+    try:
+        yield rec
+    finally:
+        _usage_recorder.reset(tok)
+
+
 class LLMClient(ABC):
+    """
+    用量：实现类拿到后端的 token 统计后调用 record_usage(Usage(...))（流式在流结束时报一次）；
+    不报的话由 LimitedLLMClient 按字符估算补上（estimated=True）。
+    """
+
     @abstractmethod
     async def generate(self, messages: List[Message]) -> str: ...
 
@@ -1,15 +1,33 @@
 import asyncio
 import os
+import threading
 from typing import AsyncIterator, List, Optional
 
 from google import genai
+from google.genai import errors as genai_errors
 from google.genai import types
 
-from agentlab.models.base import LLMClient
+from agentlab.models.base import LLMClient, LLMOverloadedError, Usage, record_usage
+from agentlab.observability import profiler
 from agentlab.types import Message
 import logging
 logger = logging.getLogger(__name__)
 
+def _is_overload(e: Exception) -> bool:
+    return isinstance(e, genai_errors.APIError) and getattr(e, "code", None) in (429, 503)
+
+
+def _usage(meta) -> Optional[Usage]:
+    """resp.usage_metadata -> Usage（思考 token 也按输出计费，算进 completion）。"""
+    if meta is None:
+        return None
+    return Usage(
+        prompt_tokens=meta.prompt_token_count or 0,
+        completion_tokens=(meta.candidates_token_count or 0) + (getattr(meta, "thoughts_token_count", None) or 0),
+        cached_tokens=meta.cached_content_token_count or 0,
+    )
+
+
 class GeminiGenAIClient(LLMClient):
     """
     Google GenAI SDK (Gemini Developer API):
@@ -51,54 +69,74 @@ class GeminiGenAIClient(LLMClient):
     async def generate(self, messages: List[Message]) -> str:
         contents, config = self._to_contents_and_config(messages)
 
-        def _call() -> str:
-            resp = self.client.models.generate_content(
-                model=self.model,
-                contents=contents,
-                config=config,
-            )
-            return resp.text or ""
+        task_name = profiler.current_task_name()
 
-        return await asyncio.to_thread(_call)
+        def _call():
+            with profiler.tagged_thread(task_name):
+                return self.client.models.generate_content(
+                    model=self.model,
+                    contents=contents,
+                    config=config,
+                )
+
+        try:
+            resp = await asyncio.to_thread(_call)
+        except genai_errors.APIError as e:
+            # 429/503 统一转成 LLMOverloadedError，交给上层共享限流器处理
+            if _is_overload(e):
+                raise LLMOverloadedError(f"Gemini overloaded: {e!r}") from e
+            raise
+        usage = _usage(resp.usage_metadata)
+        if usage is not None:
+            record_usage(usage)
+        return resp.text or ""
 
     async def stream(self, messages: List[Message]) -> AsyncIterator[str]:
         contents, config = self._to_contents_and_config(messages)
 
         q: asyncio.Queue[Optional[str]] = asyncio.Queue()
-
-        def _producer(max_retries: int = 4, base_delay: float = 0.6):
-            attempt = 0
-            while True:
-                try:
-                    resp_stream = self.client.models.generate_content_stream(
-                        model=self.model,
-                        contents=contents,
-                        config=config,
-                    )
-                    for chunk in resp_stream:
-                        txt = getattr(chunk, "text", None)
-                        if txt:
-                            q.put_nowait(("token", txt))
-                    q.put_nowait(("done", None))
-                    return
-
-                except genai_errors.ServerError as e:
-                    # 503 过载：退避重试
-                    msg = str(e)
-                    if "503" in msg and attempt < max_retries:
-                        delay = base_delay * (2 ** attempt) + random.uniform(0, 0.25)
-                        time.sleep(delay)
-                        attempt += 1
-                        logger.info(f"Gemini stream failed {attempt} times, retrying in {delay:.2f} seconds...")
-                        continue
-                    q.put_nowait(("error", f"Gemini stream failed: {e!r}"))
-                    return
-
-                except Exception as e:
-                    q.put_nowait(("error", f"Gemini stream failed: {e!r}"))
-                    return
-
-        prod_future = asyncio.get_running_loop().run_in_executor(None, _producer)
+        loop = asyncio.get_running_loop()
+        # 消费方提前退出（取消 / 对冲输了 / 调用方不读了）时置位：生产者在下一个 chunk 处停下并关掉上游流
+        stop = threading.Event()
+
+        def _put(item) -> None:
+            # 生产者在线程池里，必须经 call_soon_threadsafe 投递，否则可能唤醒不了 event loop
+            if not stop.is_set():
+                loop.call_soon_threadsafe(q.put_nowait, item)
+
+        task_name = profiler.current_task_name()
+
+        def _producer():
+            with profiler.tagged_thread(task_name):
+                _produce()
+
+        def _produce():
+            # 不在这里盲目 sleep 重试：过载直接上报，由 LimitedLLMClient 统一降窗、排队后重试
+            try:
+                resp_stream = self.client.models.generate_content_stream(
+                    model=self.model,
+                    contents=contents,
+                    config=config,
+                )
+                meta = None
+                for chunk in resp_stream:
+                    if stop.is_set():
+                        close = getattr(resp_stream, "close", None)
+                        if close is not None:
+                            close()
+                        return
+                    txt = getattr(chunk, "text", None)
+                    if txt:
+                        _put(("token", txt))
+                    # 用量是累计值，最后一个 chunk 上的最全
+                    meta = getattr(chunk, "usage_metadata", None) or meta
+                _put(("done", _usage(meta)))
+            except Exception as e:
+                kind = "overload" if _is_overload(e) else "error"
+                _put((kind, f"Gemini stream failed: {e!r}"))
+
+        prod_future = loop.run_in_executor(None, _producer)
+        finished = False
 
         try:
             while True:
@@ -106,9 +144,17 @@ class GeminiGenAIClient(LLMClient):
                 if kind == "token" and payload is not None:
                     yield payload
                 elif kind == "done":
+                    if payload is not None:
+                        record_usage(payload)
+                    finished = True
                     break
+                elif kind == "overload":
+                    raise LLMOverloadedError(payload)
                 else:
                     raise RuntimeError(payload or "Unknown streaming error")
         finally:
-            # 回收后台 future
-            await prod_future
+            stop.set()
+            if finished:
+                # 正常读完：生产者马上就退出，回收后台 future
+                await prod_future
+            # 否则不等上游流读完（可能还要好几秒）：生产者看到 stop 后自己退出
@@ -0,0 +1,379 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import time
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+from opentelemetry import trace
+
+from agentlab.models.base import (
+    LLMClient,
+    LLMOverloadedError,
+    Usage,
+    UsageRecorder,
+    capture_usage,
+    estimate_tokens,
+    record_usage,
+)
+from agentlab.observability.metrics import LLM_CALLS, LLM_LATENCY, LLM_QUEUE_WAIT, LLM_TOKENS, LLM_TTFT
+from agentlab.types import Message
+import logging
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveLimiter:
+    """
+    所有会话共享的 LLM 出站并发限流器（AIMD）：
+    - 成功：窗口加性增长（每满一个窗口的成功请求 +increase_step）
+    - 429/503：窗口乘性收缩，并全局暂停 cooldown，所有会话一起退避
+    - 延迟明显高于基线：轻微收缩，提前避开过载
+    - 排队按 key（session_id）轮转出队，单个会话刷请求不会饿死其他会话
+    - 可选 TPM（每分钟 token）记账，超额时排队等待窗口滑出
+    """
+
+    def __init__(
+        self,
+        *,
+        initial_limit: float = 4,
+        min_limit: float = 1,
+        max_limit: float = 32,
+        increase_step: float = 1.0,
+        decrease_factor: float = 0.5,
+        latency_tolerance: float = 2.0,
+        cooldown_s: float = 0.5,
+        max_cooldown_s: float = 8.0,
+        tpm_limit: Optional[int] = None,
+    ) -> None:
+        self.min_limit = float(min_limit)
+        self.max_limit = float(max_limit)
+        self.limit = min(max(float(initial_limit), self.min_limit), self.max_limit)
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.cooldown_s = cooldown_s
+        self.max_cooldown_s = max_cooldown_s
+        self.tpm_limit = tpm_limit
+
+        self.inflight = 0
+        # key -> 该会话的等待者（future, 申请的 token 数）
+        self._waiters: "collections.OrderedDict[str, Deque[Tuple[asyncio.Future, int]]]" = collections.OrderedDict()
+        self._tpm_window: Deque[Tuple[float, int]] = collections.deque()
+        self._tpm_used = 0
+        self._paused_until = 0.0
+        self._consecutive_overloads = 0
+        self._baseline_latency_s: Optional[float] = None
+        self._last_decrease = 0.0
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+        # 统计
+        self.granted = 0
+        self.overloads = 0
+
+    # ---------- 对外 API ----------
+
+    @property
+    def queued(self) -> int:
+        return sum(len(d) for d in self._waiters.values())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": round(self.limit, 2),
+            "inflight": self.inflight,
+            "queued": self.queued,
+            "tpm_used": self._tpm_used if self.tpm_limit else None,
+            "granted": self.granted,
+            "overloads": self.overloads,
+        }
+
+    async def acquire(self, key: str, tokens: int = 0) -> float:
+        """拿到一个出站名额，返回排队等待秒数（立即拿到则为 0）。"""
+        now = time.monotonic()
+        if not self._waiters and self._can_grant(now, tokens):
+            self._grant(now, tokens)
+            return 0.0
+
+        loop = asyncio.get_running_loop()
+        fut: asyncio.Future = loop.create_future()
+        self._waiters.setdefault(key, collections.deque()).append((fut, tokens))
+        t0 = time.monotonic()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # 已经分到名额但调用方被取消：把名额还回去
+                self.release(outcome="cancelled")
+            else:
+                self._remove_waiter(key, fut)
+            raise
+        return time.monotonic() - t0
+
+    def release(self, *, latency_s: Optional[float] = None, outcome: str = "ok") -> None:
+        """归还名额并根据结果调整窗口。outcome: ok / overload / error / cancelled"""
+        self.inflight = max(0, self.inflight - 1)
+        now = time.monotonic()
+
+        if outcome == "overload":
+            self._on_overload(now)
+
+        elif outcome == "ok":
+            self._consecutive_overloads = 0
+            if latency_s is not None and self._latency_too_high(latency_s) and now - self._last_decrease >= self.cooldown_s:
+                self.limit = max(self.min_limit, self.limit * 0.9)
+                self._last_decrease = now
+            else:
+                self.limit = min(self.max_limit, self.limit + self.increase_step / max(self.limit, 1.0))
+
+        self._dispatch()
+
+    def note_overload(self) -> None:
+        """
+        不占名额的过载信号：名额内部已经被消化掉的 429/503（比如路由器换了个后端重试成功）
+        也要让窗口收缩、全局退避，否则限流器永远看不到后端过载。
+        """
+        self._on_overload(time.monotonic())
+
+    def add_tokens(self, tokens: int) -> None:
+        """请求完成后补记 completion token（acquire 时只知道 prompt 估算值）。"""
+        if self.tpm_limit and tokens > 0:
+            self._record_tokens(time.monotonic(), tokens)
+
+    # ---------- 内部 ----------
+
+    def _on_overload(self, now: float) -> None:
+        self.overloads += 1
+        self._consecutive_overloads += 1
+        # 同一个冷却期内只降一次窗，避免一波 503 把窗口直接打到底
+        if now - self._last_decrease >= self.cooldown_s:
+            self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+            self._last_decrease = now
+        pause = min(self.cooldown_s * (2 ** (self._consecutive_overloads - 1)), self.max_cooldown_s)
+        self._paused_until = max(self._paused_until, now + pause)
+        logger.info("LLM overloaded, limit=%.2f pause=%.2fs", self.limit, pause)
+
+    def _latency_too_high(self, latency_s: float) -> bool:
+        base = self._baseline_latency_s
+        if base is None:
+            self._baseline_latency_s = latency_s
+            return False
+        # 基线跟踪“近期最低延迟”：快速下探，缓慢上浮
+        self._baseline_latency_s = min(latency_s, base * 0.95 + latency_s * 0.05)
+        return latency_s > base * self.latency_tolerance
+
+    def _trim_tpm(self, now: float) -> None:
+        while self._tpm_window and now - self._tpm_window[0][0] >= 60.0:
+            _, n = self._tpm_window.popleft()
+            self._tpm_used -= n
+
+    def _record_tokens(self, now: float, tokens: int) -> None:
+        self._tpm_window.append((now, tokens))
+        self._tpm_used += tokens
+
+    def _can_grant(self, now: float, tokens: int) -> bool:
+        if now < self._paused_until:
+            return False
+        if self.inflight >= max(int(self.limit), 1):
+            return False
+        if self.tpm_limit:
+            self._trim_tpm(now)
+            # 单个超大请求也要能通过（窗口为空时放行），否则会永久卡死
+            if self._tpm_used and self._tpm_used + tokens > self.tpm_limit:
+                return False
+        return True
+
+    def _grant(self, now: float, tokens: int) -> None:
+        self.inflight += 1
+        self.granted += 1
+        if self.tpm_limit and tokens:
+            self._record_tokens(now, tokens)
+
+    def _remove_waiter(self, key: str, fut: asyncio.Future) -> None:
+        d = self._waiters.get(key)
+        if not d:
+            return
+        for item in d:
+            if item[0] is fut:
+                d.remove(item)
+                break
+        if not d:
+            self._waiters.pop(key, None)
+
+    def _dispatch(self) -> None:
+        """按 key 轮转唤醒等待者，直到窗口/暂停/TPM 不允许为止。"""
+        now = time.monotonic()
+        while self._waiters:
+            key, d = next(iter(self._waiters.items()))
+            fut, tokens = d[0]
+            if fut.done():
+                d.popleft()
+                if not d:
+                    self._waiters.pop(key, None)
+                continue
+            if not self._can_grant(now, tokens):
+                self._schedule_wakeup(now)
+                return
+            d.popleft()
+            self._grant(now, tokens)
+            fut.set_result(None)
+            # 轮转：该 key 还有等待者则挪到队尾
+            self._waiters.pop(key)
+            if d:
+                self._waiters[key] = d
+
+    def _schedule_wakeup(self, now: float) -> None:
+        """暂停或 TPM 满时，没有 release 也要能按时恢复出队。"""
+        if self._wakeup is not None:
+            return
+        delay = 0.0
+        if now < self._paused_until:
+            delay = self._paused_until - now
+        elif self.tpm_limit and self._tpm_window and self.inflight < max(int(self.limit), 1):
+            delay = 60.0 - (now - self._tpm_window[0][0])
+        else:
+            return  # 窗口满：等 release 触发
+
+        def _fire() -> None:
+            self._wakeup = None
+            self._dispatch()
+
+        self._wakeup = asyncio.get_running_loop().call_later(max(delay, 0.001), _fire)
+
+
+def is_overload_error(e: BaseException) -> bool:
+    if isinstance(e, LLMOverloadedError):
+        return True
+    # 只认结构化的状态码；不在错误文本里找 "429"/"503"，免得 id、token 数里的数字误判
+    return getattr(e, "code", None) in (429, 503)
+
+
+class LimitedLLMClient(LLMClient):
+    """
+    给任意 LLMClient 套上共享限流器：
+    - 调用前按 session 排队拿名额，排队耗时写入 span 属性并发 llm_queue_wait 事件
+    - 过载错误交给限流器降窗 + 全局暂停，然后重新排队（流式只在首个 chunk 之前重试）
+    - 用量：每次成功调用向外层 recorder 报一条 Usage（后端报的优先，没报按字符估），流式带上 TTFT；
+      TPM 记账也用这个输出 token 数
+    """
+
+    def __init__(
+        self,
+        inner: LLMClient,
+        limiter: AdaptiveLimiter,
+        *,
+        key: str,
+        bus: Any = None,
+        session_id: Optional[str] = None,
+        max_overload_retries: int = 3,
+    ) -> None:
+        self.inner = inner
+        self.limiter = limiter
+        self.key = key
+        self.bus = bus
+        self.session_id = session_id or key
+        self.max_overload_retries = max_overload_retries
+        self.model = getattr(inner, "model", None)
+
+    async def _acquire(self, messages: List[Message]) -> None:
+        waited = await self.limiter.acquire(self.key, estimate_tokens(messages))
+        LLM_QUEUE_WAIT.observe(waited)
+        wait_ms = int(waited * 1000)
+        span = trace.get_current_span()
+        if span.is_recording():  # chat 之类没有自己 span 的 job，当前 span 可能是已结束的 HTTP span
+            span.set_attribute("llm.queue_wait_ms", wait_ms)
+        if waited > 0 and self.bus is not None:
+            await self.bus.publish(self.session_id, {
+                "type": "llm_queue_wait",
+                "wait_ms": wait_ms,
+                "limit": round(self.limiter.limit, 2),
+                "queued": self.limiter.queued,
+            })
+
+    async def generate(self, messages: List[Message]) -> str:
+        attempt = 0
+        while True:
+            await self._acquire(messages)
+            t0 = time.monotonic()
+            usage = UsageRecorder()  # 只收这一次调用的（并发的其它调用报不到这里）
+            try:
+                with capture_usage(usage):
+                    text = await self.inner.generate(messages)
+            except asyncio.CancelledError:
+                self.limiter.release(outcome="cancelled")
+                LLM_CALLS.inc("generate", "cancelled")
+                raise
+            except Exception as e:
+                if is_overload_error(e):
+                    self.limiter.release(outcome="overload")
+                    LLM_CALLS.inc("generate", "overload")
+                    if attempt < self.max_overload_retries:
+                        attempt += 1
+                        continue
+                    raise
+                self.limiter.release(outcome="error")
+                LLM_CALLS.inc("generate", "error")
+                raise
+            latency = time.monotonic() - t0
+            self.limiter.release(latency_s=latency, outcome="ok")
+            LLM_CALLS.inc("generate", "ok")
+            LLM_LATENCY.observe(latency, "generate")
+            self.limiter.add_tokens(self._report_usage(usage, messages, len(text), None))
+            return text
+
+    async def stream(self, messages: List[Message]) -> AsyncIterator[str]:
+        attempt = 0
+        while True:
+            await self._acquire(messages)
+            t0 = time.monotonic()
+            emitted = 0
+            ttft: Optional[float] = None
+            outcome = "error"
+            usage = UsageRecorder()
+            it = self.inner.stream(messages).__aiter__()
+            try:
+                while True:
+                    # recorder 只在取下一个 chunk 期间生效，yield 出去时不能留在调用方的上下文里
+                    with capture_usage(usage):
+                        try:
+                            chunk = await it.__anext__()
+                        except StopAsyncIteration:
+                            break
+                    if ttft is None:
+                        ttft = time.monotonic() - t0
+                        LLM_TTFT.observe(ttft)
+                    emitted += len(chunk)
+                    yield chunk
+                outcome = "ok"
+            except (asyncio.CancelledError, GeneratorExit):
+                outcome = "cancelled"
+                raise
+            except Exception as e:
+                if is_overload_error(e):
+                    outcome = "overload"
+                    if emitted == 0 and attempt < self.max_overload_retries:
+                        attempt += 1
+                        continue
+                raise
+            finally:
+                latency = time.monotonic() - t0 if outcome == "ok" else None
+                self.limiter.release(latency_s=latency, outcome=outcome)
+                LLM_CALLS.inc("stream", outcome)
+                if latency is not None:
+                    LLM_LATENCY.observe(latency, "stream")
+            self.limiter.add_tokens(self._report_usage(usage, messages, emitted, ttft))
+            return
+
+    @staticmethod
+    def _report_usage(usage: UsageRecorder, messages: List[Message], out_chars: int, ttft_s: Optional[float]) -> int:
+        """把这一次调用的用量报给外层 recorder，返回输出 token 数（TPM 记账用）。"""
+        if usage.total.calls:
+            u = usage.total
+            u.calls = 1
+        else:
+            u = Usage(prompt_tokens=estimate_tokens(messages), completion_tokens=out_chars // 4, estimated=True)
+        if ttft_s is not None:
+            u.ttft_ms = ttft_s * 1000
+        LLM_TOKENS.inc("prompt", n=u.prompt_tokens)
+        LLM_TOKENS.inc("completion", n=u.completion_tokens)
+        LLM_TOKENS.inc("cached", n=u.cached_tokens)
+        record_usage(u)
+        return u.completion_tokens
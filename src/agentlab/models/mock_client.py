@@ -1,14 +1,33 @@
 import asyncio
-from typing import AsyncIterator, List
+from typing import AsyncIterator, List, Optional
 from agentlab.models.base import LLMClient
 from agentlab.types import Message
 import os
 
 class MockLLMClient(LLMClient):
-    def __init__(self, delay_s: float = 0.02) -> None:
+    """
+    delay_s:   流式每个字符之间的间隔
+    latency_s: 注入的响应延迟（generate 返回前 / stream 首字符前），用于测试对冲、限流
+    fail:      注入的异常，每次调用都抛出
+    """
+    def __init__(
+        self,
+        delay_s: float = 0.02,
+        *,
+        latency_s: float = 0.0,
+        fail: Optional[Exception] = None,
+        model: str = "mock",
+    ) -> None:
         self.delay_s = delay_s
+        self.latency_s = latency_s
+        self.fail = fail
+        self.model = model
 
     async def generate(self, messages: List[Message]) -> str:
+        if self.latency_s:
+            await asyncio.sleep(self.latency_s)
+        if self.fail is not None:
+            raise self.fail
         last = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "")
         return f"[mock] you said: {last}"
 
@@ -0,0 +1,246 @@
+from __future__ import annotations
+
+import asyncio
+import atexit
+import collections
+import gzip
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional
+
+from agentlab.models.base import LLMClient, LLMOverloadedError
+from agentlab.models.limiter import is_overload_error
+from agentlab.types import Message
+
+FORMAT = "agentlab-llm-recording"
+VERSION = 1
+
+
+class ReplayMissError(RuntimeError):
+    """回放时找不到对应请求的录制（strict 模式）。"""
+
+
+def request_hash(kind: str, messages: List[Message]) -> str:
+    """请求指纹：调用类型 + 每条消息的 role/content（忽略 meta 等无关字段）。"""
+    canon = json.dumps(
+        {"k": kind, "m": [[m.get("role"), m.get("content") or ""] for m in messages]},
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canon.encode("utf-8")).hexdigest()[:32]
+
+
+class RecordingLLMClient(LLMClient):
+    """
+    录制包装：透传给 inner，同时把每次 generate/stream 记下来：
+    - h：请求指纹；k：generate / stream
+    - c：输出 chunk 列表（generate 只有一个）
+    - g：每个 chunk 之前的间隔（ms），第一个就是首 chunk 延迟
+    - e：异常（repr），o=1 表示过载类错误
+    文件是 gzip 压缩的 JSONL（第一行是 header）。loop 线程里只做一次 put_nowait，
+    序列化 / gzip 压缩 / 写文件都在后台线程：一次取空队列整批写、整批 flush 一次。
+    队列满了丢弃并计数（dropped），绝不让 LLM 调用等录制；close() 会先把队列写完。
+    """
+
+    def __init__(self, inner: LLMClient, path: str, *, queue_size: int = 10_000) -> None:
+        self.inner = inner
+        self.path = path
+        self.model = getattr(inner, "model", None)
+        self.dropped = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        new = not os.path.exists(path)
+        # 追加模式下 gzip 会写成多 member，标准 gzip 读取会自动拼接
+        self._f = gzip.open(path, "at", encoding="utf-8")
+        self._q: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(maxsize=queue_size)
+        self._closed = False
+        if new:
+            self._write({"format": FORMAT, "version": VERSION, "created": time.time(), "model": self.model})
+        self._thread = threading.Thread(target=self._writer, name="llm-recorder", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _write(self, rec: Dict[str, Any]) -> None:
+        try:
+            self._q.put_nowait(rec)
+        except queue.Full:
+            self.dropped += 1
+
+    def _writer(self) -> None:
+        while True:
+            batch = [self._q.get()]
+            while True:
+                try:
+                    batch.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            lines = [json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n" for r in batch if r is not None]
+            try:
+                if lines:
+                    self._f.write("".join(lines))
+                    # 每批一次 sync flush：进程被直接杀掉也只丢最后一批
+                    self._f.flush()
+            except (OSError, ValueError):
+                pass  # 录制失败不影响业务
+            for _ in batch:
+                self._q.task_done()
+            if stop:
+                return
+
+    def flush(self) -> None:
+        """等队列里已有的记录都写进文件（测试 / 压测脚本结束前用）。"""
+        if not self._closed:
+            self._q.join()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._q.put(None)  # 队列满时等 writer 腾出位置，保证已入队的记录都写完
+        self._thread.join()
+        self._f.close()
+
+    def _record(self, kind: str, h: str, chunks: List[str], gaps: List[float], err: Optional[BaseException]) -> None:
+        rec: Dict[str, Any] = {"h": h, "k": kind, "c": chunks, "g": [round(x, 2) for x in gaps]}
+        if err is not None:
+            rec["e"] = repr(err)
+            if is_overload_error(err):
+                rec["o"] = 1
+        self._write(rec)
+
+    async def generate(self, messages: List[Message]) -> str:
+        h = request_hash("generate", messages)
+        t0 = time.perf_counter()
+        try:
+            text = await self.inner.generate(messages)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._record("generate", h, [], [(time.perf_counter() - t0) * 1000], e)
+            raise
+        self._record("generate", h, [text], [(time.perf_counter() - t0) * 1000], None)
+        return text
+
+    async def stream(self, messages: List[Message]) -> AsyncIterator[str]:
+        h = request_hash("stream", messages)
+        chunks: List[str] = []
+        gaps: List[float] = []
+        last = time.perf_counter()
+        err: Optional[BaseException] = None
+        done = False
+        try:
+            async for chunk in self.inner.stream(messages):
+                now = time.perf_counter()
+                chunks.append(chunk)
+                gaps.append((now - last) * 1000)
+                last = now
+                yield chunk
+            done = True
+        except Exception as e:
+            err = e
+            gaps.append((time.perf_counter() - last) * 1000)
+            raise
+        finally:
+            # 被取消 / 消费方提前关闭的流不记录（不是完整的一次调用）
+            if done or err is not None:
+                self._record("stream", h, chunks, gaps, err)
+
+
+def load_recording(path: str) -> List[Dict[str, Any]]:
+    records: List[Dict[str, Any]] = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue  # 崩溃截断的最后一行
+                if "format" in rec:
+                    continue
+                records.append(rec)
+        except EOFError:
+            pass  # 录制进程没有正常 close，缺 gzip trailer；已 flush 的内容照常可读
+    return records
+
+
+class ReplayLLMClient(LLMClient):
+    """
+    回放录制：按请求指纹找到对应录制，按原始（或缩放后的）时序吐出 chunk。
+    - speed：1.0 原速；100 表示 100 倍速；0 表示不等待
+    - 同一指纹录了多次按顺序依次回放；loop=True 时用完从头循环（压测多个 session 复用一份录制）
+    - strict=False 时指纹没命中就按同类型调用的录制顺序兜底（prompt 里有时间戳等不稳定内容时有用）
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        speed: float = 1.0,
+        strict: bool = True,
+        loop: bool = False,
+        model: str = "replay",
+    ) -> None:
+        self.speed = speed
+        self.strict = strict
+        self.loop = loop
+        self.model = model
+        self.records = load_recording(path)
+        self._by_hash: Dict[str, List[Dict[str, Any]]] = collections.defaultdict(list)
+        self._cursor: Dict[str, int] = collections.defaultdict(int)
+        self._by_kind: Dict[str, Deque[Dict[str, Any]]] = collections.defaultdict(collections.deque)
+        for rec in self.records:
+            self._by_hash[rec["h"]].append(rec)
+            self._by_kind[rec["k"]].append(rec)
+        self.hits = 0
+        self.misses = 0
+
+    def _next(self, kind: str, messages: List[Message]) -> Dict[str, Any]:
+        h = request_hash(kind, messages)
+        recs = self._by_hash.get(h)
+        if recs:
+            i = self._cursor[h]
+            if i < len(recs) or self.loop:
+                self._cursor[h] = i + 1
+                self.hits += 1
+                return recs[i % len(recs)]
+        self.misses += 1
+        if self.strict or not self._by_kind.get(kind):
+            raise ReplayMissError(f"no recording for {kind} request {h}")
+        rec = self._by_kind[kind].popleft()
+        if self.loop:
+            self._by_kind[kind].append(rec)
+        return rec
+
+    async def _sleep_ms(self, ms: float) -> None:
+        if self.speed > 0 and ms > 0:
+            await asyncio.sleep(ms / 1000.0 / self.speed)
+
+    @staticmethod
+    def _raise(rec: Dict[str, Any]) -> None:
+        msg = f"replayed error: {rec['e']}"
+        if rec.get("o"):
+            raise LLMOverloadedError(msg)
+        raise RuntimeError(msg)
+
+    async def generate(self, messages: List[Message]) -> str:
+        rec = self._next("generate", messages)
+        await self._sleep_ms(sum(rec.get("g") or [0]))
+        if "e" in rec:
+            self._raise(rec)
+        return "".join(rec.get("c") or [])
+
+    async def stream(self, messages: List[Message]) -> AsyncIterator[str]:
+        rec = self._next("stream", messages)
+        gaps = rec.get("g") or []
+        for i, chunk in enumerate(rec.get("c") or []):
+            await self._sleep_ms(gaps[i] if i < len(gaps) else 0)
+            yield chunk
+        if "e" in rec:
+            self._raise(rec)
@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence
+
+from opentelemetry import trace
+
+from agentlab.models.base import LLMClient
+from agentlab.observability.latency import LatencyHistogram
+from agentlab.types import Message
+import logging
+logger = logging.getLogger(__name__)
+
+
+class HedgedRouterClient(LLMClient):
+    """
+    多后端路由 + 对冲请求（hedged request）：
+    - 先发给 primary；超过 primary 的 p{hedge_percentile} 延迟仍未返回，就对下一个后端发对冲请求
+    - 谁先给出正常结果用谁，其余取消
+    - 某个后端直接报错时，立刻 fallback 到下一个后端（不等对冲阈值）
+    - 每个后端分别记录 generate 延迟和 stream 首 chunk 延迟的直方图，用来自动调整对冲阈值
+    - 传了 limiter 时，被 fallback 消化掉的 429/503 也报给它（note_overload），限流器照样降窗退避；
+      最后抛出去的那个错误由外层 LimitedLLMClient 自己上报，不重复计
+    """
+
+    def __init__(
+        self,
+        backends: Sequence[LLMClient],
+        *,
+        names: Optional[Sequence[str]] = None,
+        hedge_percentile: float = 0.95,
+        min_samples: int = 20,
+        default_hedge_delay_s: float = 2.0,
+        min_hedge_delay_s: float = 0.05,
+        limiter: Any = None,  # 可选 AdaptiveLimiter
+    ) -> None:
+        if not backends:
+            raise ValueError("HedgedRouterClient needs at least one backend")
+        self.backends = list(backends)
+        self.names = list(names) if names else [
+            str(getattr(b, "model", None) or f"backend{i}") for i, b in enumerate(self.backends)
+        ]
+        if len(self.names) != len(self.backends):
+            raise ValueError("names must match backends")
+        self.hedge_percentile = hedge_percentile
+        self.min_samples = min_samples
+        self.default_hedge_delay_s = default_hedge_delay_s
+        self.min_hedge_delay_s = min_hedge_delay_s
+        self.limiter = limiter
+        self.model = getattr(self.backends[0], "model", None) or self.names[0]
+
+        self.latency: Dict[str, Dict[str, LatencyHistogram]] = {
+            n: {"generate": LatencyHistogram(), "stream_first_chunk": LatencyHistogram()} for n in self.names
+        }
+        self.counters: Dict[str, Dict[str, int]] = {n: {"wins": 0, "errors": 0, "hedges": 0} for n in self.names}
+
+    def hedge_delay(self, idx: int, kind: str) -> float:
+        """对冲阈值：样本不足用默认值，否则取该后端对应分位数。"""
+        h = self.latency[self.names[idx]][kind]
+        if h.count < self.min_samples:
+            return self.default_hedge_delay_s
+        p = h.percentile(self.hedge_percentile) or self.default_hedge_delay_s
+        return max(self.min_hedge_delay_s, p)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            n: {
+                **self.counters[n],
+                **{k: h.snapshot() for k, h in self.latency[n].items()},
+            }
+            for n in self.names
+        }
+
+    async def _race(self, kind: str, start_one) -> Any:
+        """
+        通用竞速逻辑：start_one(idx) 返回一个 awaitable（generate 结果或首个 chunk）。
+        返回 (winner_idx, result, 仍在跑的败者 tasks)。
+        """
+        tasks: Dict[asyncio.Task, int] = {}
+        started_at: Dict[int, float] = {}
+        next_idx = 0
+        last_err: Optional[BaseException] = None
+
+        def _launch() -> None:
+            nonlocal next_idx
+            idx = next_idx
+            next_idx += 1
+            started_at[idx] = time.monotonic()
+            tasks[asyncio.ensure_future(start_one(idx))] = idx
+            if idx > 0:
+                self.counters[self.names[idx]]["hedges"] += 1
+
+        _launch()
+        try:
+            while tasks:
+                newest = max(tasks.values())
+                timeout = self.hedge_delay(newest, kind) if next_idx < len(self.backends) else None
+                done, _ = await asyncio.wait(set(tasks), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 超过阈值仍未返回：对冲到下一个后端
+                    logger.info("hedging %s to %s after %.3fs", kind, self.names[next_idx], timeout)
+                    _launch()
+                    continue
+                for t in done:
+                    idx = tasks.pop(t)
+                    name = self.names[idx]
+                    if t.cancelled():
+                        continue
+                    err = t.exception()
+                    if err is None:
+                        self.latency[name][kind].record(time.monotonic() - started_at[idx])
+                        self.counters[name]["wins"] += 1
+                        span = trace.get_current_span()
+                        if span.is_recording():
+                            span.set_attribute("llm.backend", name)
+                            span.set_attribute("llm.hedged", next_idx > 1)
+                        return idx, t.result(), tasks
+                    if last_err is not None:
+                        self._note_overload(last_err)  # 上一个错误已经被后面的后端接住了
+                    last_err = err
+                    self.counters[name]["errors"] += 1
+                    logger.info("backend %s failed on %s: %r", name, kind, err)
+                if last_err is not None and (tasks or next_idx < len(self.backends)):
+                    # 还有后端在跑 / 可以 fallback：这个错误不会抛给调用方，由这里报给限流器
+                    self._note_overload(last_err)
+                    last_err = None
+                # 有后端失败：立即 fallback，不等对冲阈值
+                if not tasks and next_idx < len(self.backends):
+                    _launch()
+        except BaseException:
+            for t in tasks:
+                t.cancel()
+            raise
+        assert last_err is not None
+        raise last_err
+
+    def _note_overload(self, err: BaseException) -> None:
+        from agentlab.models.limiter import is_overload_error  # limiter -> metrics -> router，顶层 import 会循环
+
+        if self.limiter is not None and is_overload_error(err):
+            self.limiter.note_overload()
+
+    async def generate(self, messages: List[Message]) -> str:
+        async def _one(idx: int) -> str:
+            return await self.backends[idx].generate(messages)
+
+        _, text, losers = await self._race("generate", _one)
+        for t in losers:
+            t.cancel()
+        return text
+
+    async def stream(self, messages: List[Message]) -> AsyncIterator[str]:
+        iters: Dict[int, AsyncIterator[str]] = {}
+
+        async def _first(idx: int) -> Optional[str]:
+            it = self.backends[idx].stream(messages).__aiter__()
+            iters[idx] = it
+            try:
+                return await it.__anext__()
+            except StopAsyncIteration:
+                return None  # 空流也算正常结果
+            except BaseException:
+                # 失败 / 被取消的候选在自己的 task 里关掉生成器（此时它已不在 __anext__ 里）
+                await _aclose(it)
+                raise
+
+        winner: Optional[int] = None
+        try:
+            winner, first, losers = await self._race("stream_first_chunk", _first)
+            for t in losers:
+                t.cancel()
+            # 每个非 winner 的生成器都要关：已经结束的候选（先失败的 / 空流）就地关，
+            # 还在跑的败者在后台等它退出再关，首个 chunk 不能被慢后端的收尾拖住
+            running = set(losers.values())
+            for idx, it in iters.items():
+                if idx != winner and idx not in running:
+                    await _aclose(it)
+            if losers:
+                _spawn_cleanup(list(losers), [iters[idx] for idx in running if idx in iters])
+            if first is not None:
+                yield first
+                async for chunk in iters[winner]:
+                    yield chunk
+        finally:
+            # winner 确定前出错 / 被取消时，候选各自在 _first 里关掉了生成器；这里只管 winner
+            if winner is not None:
+                await _aclose(iters[winner])
+
+
+# 后台收尾任务的强引用（否则可能被 GC 提前回收）
+_cleanup_tasks: "set[asyncio.Task]" = set()
+
+
+async def _aclose(it: AsyncIterator[str]) -> None:
+    aclose = getattr(it, "aclose", None)
+    if aclose is not None:
+        try:
+            await aclose()
+        except Exception:
+            pass
+
+
+def _spawn_cleanup(losers: Any, iters: List[AsyncIterator[str]]) -> None:
+    async def _cleanup() -> None:
+        # 等败者真正退出，才能安全 aclose 它们的生成器（正在 __anext__ 的生成器不能 aclose）
+        await asyncio.gather(*losers, return_exceptions=True)
+        for it in iters:
+            await _aclose(it)
+
+    t = asyncio.create_task(_cleanup(), name="router:stream_cleanup")
+    _cleanup_tasks.add(t)
+    t.add_done_callback(_cleanup_tasks.discard)
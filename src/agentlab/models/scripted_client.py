@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import math
+import random
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from agentlab.models.base import LLMClient
+from agentlab.types import Message
+
+
+@dataclass
+class LatencySpec:
+    """
+    延迟分布（秒）：
+    - fixed:       value
+    - uniform:     [low, high]
+    - exponential: 均值 mean
+    - lognormal:   中位数 median，形状 sigma（长尾，最接近真实 LLM 延迟）
+    解析字符串形式："fixed:0.2" / "uniform:0.1,0.5" / "exp:0.3" / "lognormal:0.4,0.6"
+    """
+    kind: str = "fixed"
+    a: float = 0.0
+    b: float = 0.0
+
+    @classmethod
+    def parse(cls, spec: str) -> "LatencySpec":
+        kind, _, rest = spec.partition(":")
+        nums = [float(x) for x in rest.split(",") if x.strip()] if rest else []
+        kind = {"exp": "exponential"}.get(kind, kind)
+        if kind not in ("fixed", "uniform", "exponential", "lognormal"):
+            raise ValueError(f"unknown latency kind: {kind}")
+        return cls(kind, nums[0] if nums else 0.0, nums[1] if len(nums) > 1 else 0.0)
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            return self.a
+        if self.kind == "uniform":
+            return rng.uniform(self.a, self.b)
+        if self.kind == "exponential":
+            return rng.expovariate(1.0 / self.a) if self.a > 0 else 0.0
+        # lognormal：a=中位数, b=sigma
+        return rng.lognormvariate(math.log(self.a), self.b) if self.a > 0 else 0.0
+
+
+@dataclass
+class ToolCallScript:
+    """一次 ReAct 对话里模型依次发起的工具调用，调用完后给 final。"""
+    calls: List[Dict[str, Any]] = field(default_factory=list)  # [{"tool_name": "calc", "args": {...}}]
+    final: str = "done"
+
+
+class ScriptedLLMClient(LLMClient):
+    """
+    可编排的 mock LLM，用于压测和回归：
+    - 能输出合法的 ReAct / plan JSON：按消息里已有的 Observation 数决定该走到脚本的第几步（无状态，
+      多个 session 并发共用一个实例也不会串）
+    - generate 延迟、流式首 chunk 延迟、chunk 间隔分别可配分布
+    - 流式按 chunk_size 字符切分 final 文本
+    """
+
+    def __init__(
+        self,
+        *,
+        script: Optional[ToolCallScript] = None,
+        latency: LatencySpec = LatencySpec(),
+        first_chunk_latency: Optional[LatencySpec] = None,
+        chunk_interval: LatencySpec = LatencySpec(),
+        chunk_size: int = 8,
+        stream_text: Optional[str] = None,
+        seed: Optional[int] = None,
+        model: str = "scripted",
+    ) -> None:
+        self.script = script or ToolCallScript()
+        self.latency = latency
+        self.first_chunk_latency = first_chunk_latency or latency
+        self.chunk_interval = chunk_interval
+        self.chunk_size = max(1, chunk_size)
+        self.stream_text = stream_text
+        self.rng = random.Random(seed)
+        self.model = model
+        self.calls = 0
+
+    async def _sleep(self, spec: LatencySpec) -> None:
+        d = spec.sample(self.rng)
+        # 0 也让出一次 event loop，模拟真实 IO
+        await asyncio.sleep(max(d, 0.0))
+
+    def _respond(self, messages: List[Message]) -> str:
+        system = next((m.get("content", "") for m in messages if m.get("role") == "system"), "")
+        if '"type":"plan"' in system:
+            nodes = [
+                {"id": f"n{i}", "tool": c["tool_name"], "args": c.get("args", {})}
+                for i, c in enumerate(self.script.calls)
+            ]
+            if not nodes:
+                return json.dumps({"type": "final", "final": self.script.final}, ensure_ascii=False)
+            return json.dumps({"type": "plan", "nodes": nodes}, ensure_ascii=False)
+        if '"subtasks"' in system:
+            last = next((m.get("content", "") for m in reversed(messages) if m.get("role") == "user"), "")
+            return json.dumps({"subtasks": [last]}, ensure_ascii=False)
+
+        step = sum(1 for m in messages if m.get("role") == "user" and str(m.get("content", "")).startswith("Observation:"))
+        if step < len(self.script.calls):
+            c = self.script.calls[step]
+            return json.dumps({"type": "tool", "tool_name": c["tool_name"], "args": c.get("args", {})}, ensure_ascii=False)
+        return json.dumps({"type": "final", "final": self.script.final}, ensure_ascii=False)
+
+    async def generate(self, messages: List[Message]) -> str:
+        self.calls += 1
+        await self._sleep(self.latency)
+        return self._respond(messages)
+
+    async def stream(self, messages: List[Message]) -> AsyncIterator[str]:
+        self.calls += 1
+        text = self.stream_text if self.stream_text is not None else self.script.final
+        await self._sleep(self.first_chunk_latency)
+        for i in range(0, len(text), self.chunk_size):
+            if i:
+                await self._sleep(self.chunk_interval)
+            yield text[i:i + self.chunk_size]
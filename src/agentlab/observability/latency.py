@@ -0,0 +1,51 @@
+"""
+latency.py
+对数分桶延迟直方图：路由器的对冲阈值、/metrics、trace_tree 离线分析共用。
+不依赖任何运行时模块，离线工具 import 它不会拉起模型 / OTel。
+"""
+
+from __future__ import annotations
+
+import bisect
+import math
+from typing import Any, Dict, List, Optional
+
+
+class LatencyHistogram:
+    """对数分桶的延迟直方图（1ms ~ 约 2 分钟，相邻桶 ×1.25），O(1) 内存，用来估计分位数。"""
+
+    _BOUNDS_S: List[float] = [0.001 * (1.25 ** i) for i in range(53)]
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(self._BOUNDS_S) + 1)
+        self.count = 0
+        self.sum_s = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self._BOUNDS_S, seconds)] += 1
+        self.count += 1
+        self.sum_s += seconds
+
+    def percentile(self, q: float) -> Optional[float]:
+        """返回第 q 分位（0~1）所在桶的上界；没有样本返回 None。"""
+        if self.count == 0:
+            return None
+        rank = max(1, math.ceil(q * self.count))
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return self._BOUNDS_S[i] if i < len(self._BOUNDS_S) else self._BOUNDS_S[-1]
+        return self._BOUNDS_S[-1]
+
+    def snapshot(self) -> Dict[str, Any]:
+        def _ms(v: Optional[float]) -> Optional[float]:
+            return round(v * 1000, 1) if v is not None else None
+
+        return {
+            "count": self.count,
+            "mean_ms": _ms(self.sum_s / self.count) if self.count else None,
+            "p50_ms": _ms(self.percentile(0.50)),
+            "p95_ms": _ms(self.percentile(0.95)),
+            "p99_ms": _ms(self.percentile(0.99)),
+        }
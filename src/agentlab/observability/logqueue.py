@@ -0,0 +1,159 @@
+"""
+logqueue.py
+不阻塞 event loop 的日志管线（给 log_config.json 用）：
+
+- QueueListenerHandler：loop 线程里只做一次 put_nowait，格式化和写文件都在后台线程（QueueListener）里做；
+  队列满了直接丢弃并计数，绝不让业务等日志
+- RateLimitFilter：按 (logger, 消息模板) 做令牌桶限速 + 每 N 条采样 1 条，挡住事件风暴时的高频日志；
+  被挡掉的条数在下一条放行的日志上以 suppressed=N 标出
+
+log_config.json 里用 "()" 工厂引用，例如：
+    "handlers": {"queue": {"()": "agentlab.observability.logqueue.QueueListenerHandler", "handlers": ["file"]}}
+    "filters":  {"events": {"()": "agentlab.observability.logqueue.RateLimitFilter", "rate": 20, "burst": 100}}
+"""
+
+from __future__ import annotations
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+_handlers: List["QueueListenerHandler"] = []
+_filters: List["RateLimitFilter"] = []
+
+
+class QueueListenerHandler(logging.handlers.QueueHandler):
+    """
+    handlers 填 dictConfig 里其它 handler 的名字：它们只在后台线程里被调用。
+    名字在第一次写日志时才解析（dictConfig 里 handler 的创建顺序不用操心）。
+    """
+
+    def __init__(self, handlers: List[str], queue_size: int = 10_000, respect_handler_level: bool = True) -> None:
+        super().__init__(queue.Queue(maxsize=queue_size))
+        self.handler_names = list(handlers)
+        self.respect_handler_level = respect_handler_level
+        self.listener: Optional[logging.handlers.QueueListener] = None
+        self.dropped = 0
+        self._start_lock = threading.Lock()
+        _handlers.append(self)
+
+    def _start(self) -> None:
+        with self._start_lock:
+            if self.listener is not None:
+                return
+            targets = []
+            for name in self.handler_names:
+                h = logging._handlers.get(name)  # dictConfig 按名字登记的 handler
+                if h is None:
+                    raise ValueError(f"unknown log handler: {name}")
+                targets.append(h)
+            self.listener = logging.handlers.QueueListener(
+                self.queue, *targets, respect_handler_level=self.respect_handler_level
+            )
+            self.listener.start()
+            atexit.register(self.stop)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 标准 QueueHandler 在这里就 format 并改写 record（在调用方线程里）；这里原样入队，格式化留给后台线程。
+        # 代价：args 里的可变对象如果在入队后被改，日志会反映改后的值
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if self.listener is None:
+            self._start()
+        self.enqueue(self.prepare(record))
+
+    def stop(self) -> None:
+        """停后台线程（会先写完队列里剩下的）。"""
+        with self._start_lock:
+            if self.listener is not None:
+                self.listener.stop()
+                self.listener = None
+
+    def close(self) -> None:
+        self.stop()
+        super().close()
+
+    def stats(self) -> Dict[str, int]:
+        return {"queued": self.queue.qsize(), "dropped": self.dropped}
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    按 (logger 名, 消息模板) 分组：
+    - sample_every=N：每 N 条只放行 1 条（1 = 不采样）
+    - rate / burst：令牌桶，每秒最多 rate 条，允许 burst 的突发（rate=0 = 不限速）
+    只作用于 max_level 及以下的级别（默认 INFO），WARNING 以上永远放行。
+    """
+
+    def __init__(
+        self,
+        name: str = "",
+        rate: float = 0.0,
+        burst: float = 0.0,
+        sample_every: int = 1,
+        max_level: str = "INFO",
+    ) -> None:
+        super().__init__(name)
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.sample_every = max(1, int(sample_every))
+        self.max_level = logging.getLevelName(max_level) if isinstance(max_level, str) else int(max_level)
+        # key -> [tokens, last_ts, seen, suppressed]
+        self._state: Dict[Tuple[str, Any], List[float]] = {}
+        self.suppressed_total = 0
+        _filters.append(self)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.max_level or not super().filter(record):
+            return True
+        msg = record.msg
+        key = (record.name, msg if isinstance(msg, str) else type(msg).__name__)
+        st = self._state.get(key)
+        now = time.monotonic()
+        if st is None:
+            st = self._state[key] = [self.burst, now, 0, 0]
+        st[2] += 1
+        ok = (st[2] - 1) % self.sample_every == 0
+        if ok and self.rate > 0:
+            st[0] = min(self.burst, st[0] + (now - st[1]) * self.rate)
+            st[1] = now
+            if st[0] >= 1:
+                st[0] -= 1
+            else:
+                ok = False
+        if not ok:
+            st[3] += 1
+            self.suppressed_total += 1
+            return False
+        record.suppressed = int(st[3])
+        st[3] = 0
+        return True
+
+
+class SuppressedFormatter(logging.Formatter):
+    """在被限速过的日志后面加上 (suppressed=N)，方便看出中间丢了多少条。"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        s = super().format(record)
+        n = getattr(record, "suppressed", 0)
+        return f"{s} (suppressed={n})" if n else s
+
+
+def stats() -> Dict[str, int]:
+    """当前进程所有队列 handler / 限速 filter 的汇总（/metrics 用）。"""
+    return {
+        "queued": sum(h.queue.qsize() for h in _handlers),
+        "dropped": sum(h.dropped for h in _handlers),
+        "suppressed": sum(f.suppressed_total for f in _filters),
+    }
@@ -0,0 +1,248 @@
+"""
+metrics.py
+进程内指标：计数器 / 直方图在热路径上记录（EventBus.publish、ToolRunner.run、LLM 调用），
+gauge 在抓取时回调计算（队列深度、线程池、任务数），/metrics 输出 Prometheus 文本格式。
+
+记录不加锁：几乎所有记录都发生在 event loop 线程里；少数来自线程池的记录靠 GIL，
+最坏情况是偶尔丢一次自增，对监控指标可以接受，换来热路径上只有一次 dict 查找 + 加法。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import math
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from agentlab.observability.latency import LatencyHistogram
+from agentlab.observability import logqueue
+
+LabelValues = Tuple[str, ...]
+GaugeFn = Callable[[], Iterable[Tuple[LabelValues, float]]]
+
+
+def _fmt_labels(names: Sequence[str], values: LabelValues, extra: str = "") -> str:
+    parts = [f'{k}="{_escape(v)}"' for k, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(v: Any) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_value(v: float) -> str:
+    if math.isinf(v):
+        return "+Inf" if v > 0 else "-Inf"
+    return repr(float(v)) if isinstance(v, float) and not v.is_integer() else str(int(v))
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, n: float = 1) -> None:
+        v = self.values
+        v[label_values] = v.get(label_values, 0) + n
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for lv, val in sorted(self.values.items()):
+            out.append(f"{self.name}{_fmt_labels(self.labels, lv)} {_fmt_value(val)}")
+        return out
+
+    def snapshot(self) -> Dict[str, float]:
+        return {",".join(lv) or "_": val for lv, val in self.values.items()}
+
+
+class UpDownCounter(Counter):
+    """可增可减（在途数之类）。"""
+
+    def dec(self, *label_values: str, n: float = 1) -> None:
+        self.inc(*label_values, n=-n)
+
+    def render(self) -> List[str]:
+        out = super().render()
+        out[1] = f"# TYPE {self.name} gauge"
+        return out
+
+
+class Histogram:
+    """按 label 分组的对数分桶直方图（桶边界同 LatencyHistogram：1ms 起 ×1.25），单位秒。"""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.values: Dict[LabelValues, LatencyHistogram] = {}
+
+    def observe(self, seconds: float, *label_values: str) -> None:
+        h = self.values.get(label_values)
+        if h is None:
+            h = self.values[label_values] = LatencyHistogram()
+        h.record(seconds)
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        bounds = LatencyHistogram._BOUNDS_S
+        for lv, h in sorted(self.values.items()):
+            cum = 0
+            for i, c in enumerate(h.counts):
+                cum += c
+                le = 'le="%s"' % (_fmt_value(bounds[i]) if i < len(bounds) else "+Inf")
+                # 空桶照样输出：Prometheus 要求同一直方图的桶边界固定
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, lv, le)} {cum}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, lv)} {_fmt_value(h.sum_s)}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, lv)} {h.count}")
+        return out
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {",".join(lv) or "_": h.snapshot() for lv, h in self.values.items()}
+
+
+class Gauge:
+    """抓取时回调取值，热路径零开销。"""
+
+    def __init__(self, name: str, help: str, fn: GaugeFn, labels: Sequence[str] = ()) -> None:
+        self.name, self.help, self.labels, self.fn = name, help, tuple(labels), fn
+
+    def _collect(self) -> List[Tuple[LabelValues, float]]:
+        try:
+            return list(self.fn())
+        except Exception:
+            return []
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for lv, val in self._collect():
+            out.append(f"{self.name}{_fmt_labels(self.labels, lv)} {_fmt_value(val)}")
+        return out
+
+    def snapshot(self) -> Dict[str, float]:
+        return {",".join(lv) or "_": val for lv, val in self._collect()}
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Any] = {}
+
+    def _add(self, metric: Any) -> Any:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def updown(self, name: str, help: str, labels: Sequence[str] = ()) -> UpDownCounter:
+        return self._add(UpDownCounter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = ()) -> Histogram:
+        return self._add(Histogram(name, help, labels))
+
+    def gauge(self, name: str, help: str, fn: GaugeFn, labels: Sequence[str] = ()) -> Gauge:
+        """同名 gauge 重复注册时以最后一次为准（app 重新装配时回调会换）。"""
+        g = Gauge(name, help, fn, labels)
+        self._metrics[name] = g
+        return g
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for m in self._metrics.values():
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {name: m.snapshot() for name, m in self._metrics.items()}
+
+
+registry = MetricsRegistry()
+
+# ---------- 热路径指标（各模块 import 后直接记录） ----------
+
+EVENTS_PUBLISHED = registry.counter("agentlab_events_published_total", "EventBus 发布的事件数（rate() 得到每秒）", ["type"])
+TOOL_DURATION = registry.histogram("agentlab_tool_duration_seconds", "单次工具调用（每次尝试）耗时", ["tool"])
+TOOL_CALLS = registry.counter("agentlab_tool_calls_total", "工具调用尝试次数", ["tool", "outcome"])
+TOOL_INFLIGHT = registry.updown("agentlab_tool_inflight", "正在执行的工具调用数", ["tool"])
+LLM_LATENCY = registry.histogram("agentlab_llm_latency_seconds", "LLM 调用耗时（拿到名额之后，不含排队）", ["kind"])
+LLM_TTFT = registry.histogram("agentlab_llm_ttft_seconds", "流式调用首个 chunk 延迟（不含排队）")
+LLM_QUEUE_WAIT = registry.histogram("agentlab_llm_queue_wait_seconds", "LLM 限流器排队耗时")
+LLM_CALLS = registry.counter("agentlab_llm_calls_total", "LLM 调用次数", ["kind", "outcome"])
+LLM_TOKENS = registry.counter("agentlab_llm_tokens_total", "LLM token 用量（后端没报时为估算值）", ["kind"])
+LOOP_LAG = registry.histogram("agentlab_event_loop_lag_seconds", "event loop 延迟（定时探针的超时量）")
+
+_last_loop_lag = [0.0]
+
+
+async def loop_lag_probe(interval: float = 0.25) -> None:
+    """常驻探针：sleep(interval) 实际多睡了多久就是 loop 被占住的时间。"""
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - t0 - interval)
+        _last_loop_lag[0] = lag
+        LOOP_LAG.observe(lag)
+
+
+def default_executor_stats(loop: Optional[asyncio.AbstractEventLoop] = None) -> Dict[str, int]:
+    """默认线程池（asyncio.to_thread / run_in_executor(None)）的线程数、上限和排队任务数。"""
+    loop = loop or asyncio.get_event_loop()
+    ex = getattr(loop, "_default_executor", None)
+    if ex is None:
+        return {"threads": 0, "max_workers": 0, "queued": 0}
+    return {
+        "threads": len(getattr(ex, "_threads", ())),
+        "max_workers": int(getattr(ex, "_max_workers", 0)),
+        "queued": ex._work_queue.qsize() if hasattr(ex, "_work_queue") else 0,
+    }
+
+
+def install_runtime_gauges(*, bus: Any, tm: Any, limiter: Any = None) -> None:
+    """注册抓取时计算的 gauge（app 装配时调用一次）。"""
+    from agentlab.runtime import ws_gateway  # runtime.events 依赖本模块，放这里避免循环 import
+    registry.gauge(
+        "agentlab_event_loop_lag_last_seconds", "最近一次探针测到的 loop 延迟",
+        lambda: [((), _last_loop_lag[0])],
+    )
+    registry.gauge(
+        "agentlab_eventbus_queue_depth", "各 session 事件队列积压（只列非空队列）",
+        lambda: [((sid,), float(n)) for sid, n in bus.queue_depths().items() if n],
+        ["session"],
+    )
+    registry.gauge(
+        "agentlab_eventbus_sessions", "EventBus 持有的 session 队列数",
+        lambda: [((), float(len(bus.queue_depths())))],
+    )
+
+    def _executor() -> List[Tuple[LabelValues, float]]:
+        st = default_executor_stats()
+        return [((k,), float(v)) for k, v in st.items()]
+
+    registry.gauge("agentlab_default_executor", "默认线程池：threads / max_workers / queued", _executor, ["field"])
+    registry.gauge(
+        "agentlab_tasks", "TaskManager 里各状态的任务数（queued：已提交、loop 还没调度到）",
+        lambda: [((status,), float(n)) for status, n in tm.counts().items()],
+        ["status"],
+    )
+    registry.gauge(
+        "agentlab_asyncio_tasks", "event loop 上的 asyncio 任务总数",
+        lambda: [((), float(len(asyncio.all_tasks())))],
+    )
+    registry.gauge(
+        "agentlab_logging", "异步日志管线：queued / dropped（队列满丢弃）/ suppressed（限速挡掉）",
+        lambda: [((k,), float(v)) for k, v in logqueue.stats().items()],
+        ["field"],
+    )
+    registry.gauge(
+        "agentlab_ws_gateway", "WS 网关：connections / sessions / buffered / unacked / dropped",
+        lambda: [((k,), float(v)) for k, v in ws_gateway.stats().items()],
+        ["field"],
+    )
+    if limiter is not None:
+        registry.gauge(
+            "agentlab_llm_limiter", "LLM 限流器：limit / inflight / queued",
+            lambda: [((k,), float(limiter.stats()[k])) for k in ("limit", "inflight", "queued")],
+            ["field"],
+        )
@@ -1,8 +1,12 @@
 from __future__ import annotations
 
 import json
+import logging
 import os
-from typing import Sequence
+import queue
+import threading
+import time
+from typing import Any, BinaryIO, Dict, List, Optional, Sequence, Tuple
 
 from opentelemetry import trace
 from opentelemetry.sdk.resources import Resource
@@ -13,58 +17,360 @@ from opentelemetry.sdk.trace.export import (
     SpanExportResult,
 )
 
+from agentlab.observability.sampling import TailSamplingSpanProcessor
+from agentlab.observability.segments import check_codec, compress_segment, last_seq, rotated_name, segment_paths
+from agentlab.observability.trace_index import TraceIndex, default_index_path
+
 try:
-    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    import orjson
 except Exception:
-    OTLPSpanExporter = None  # type: ignore
+    orjson = None  # type: ignore
+
+
+def _dumps(rec: Dict[str, Any]) -> bytes:
+    """一行 JSONL；装了 orjson 就用它（快几倍），否则标准库紧凑格式。"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(rec, option=orjson.OPT_APPEND_NEWLINE)
+        except TypeError:
+            pass  # orjson 不认识的属性类型，交给标准库兜底
+    return (json.dumps(rec, ensure_ascii=False, separators=(",", ":"), default=str) + "\n").encode("utf-8")
+
+logger = logging.getLogger(__name__)
 
 
 class JsonlFileSpanExporter(SpanExporter):
-    """把 spans 以 JSONL（每行一个 JSON）写入文件，方便 grep / 之后做分析。"""
+    """
+    把 spans 以 JSONL（每行一个 JSON）写入文件，方便 grep / 之后做分析。
+    - 长期持有一个带缓冲的文件句柄，每批拼好一次 write（BatchSpanProcessor 线程里不反复 open/close）
+    - 按大小（max_bytes）/ 时间（max_age_s）轮转：活跃文件改名成带时间戳的分段，轮转只发生在批之间，
+      分段总是整行结束，索引里的偏移原样有效
+    - 轮转出去的分段在后台线程里分块压缩（gzip / zstd），并按 retention_segments / retention_bytes 删除最老的
+    - 给了 index_path 时维护 SQLite 索引（trace_id -> 字节偏移），trace_tree 查询不用扫全文件；
+      索引写入在单独的线程里按提交顺序做（积压的多批合成一个事务），导出线程只管写文件；
+      force_flush 会等索引追上
+    """
 
-    def __init__(self, path: str) -> None:
+    def __init__(
+        self,
+        path: str,
+        index_path: Optional[str] = None,
+        *,
+        max_bytes: int = 256 << 20,
+        max_age_s: float = 0,
+        compress: Optional[str] = "gzip",
+        retention_segments: int = 20,
+        retention_bytes: int = 0,
+        buffer_bytes: int = 1 << 20,
+    ) -> None:
         self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        self.compress = check_codec(compress)
+        self.retention_segments = retention_segments
+        self.retention_bytes = retention_bytes
+        self.buffer_bytes = buffer_bytes
         os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.index: Optional[TraceIndex] = None
+        if index_path:
+            self.index = TraceIndex(index_path)
+            self._catch_up()
+
+        self._lock = threading.Lock()
+        self._seq = last_seq(path)
+        self._f: Optional[BinaryIO] = None
+        self._size = 0
+        self._opened_at = 0.0
+        # 后台维护线程：压缩 + 保留策略，不占导出线程
+        self._maint: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._maint_thread = threading.Thread(target=self._maintenance_loop, name="trace-segments", daemon=True)
+        self._maint_thread.start()
+        # 索引线程：add / replace / drop 按提交顺序执行（轮转改名一定排在改名前那些 add 之后）；
+        # 有界队列，索引跟不上时导出线程在这里等（BatchSpanProcessor 自己的队列满了会丢 span，不会卡业务）
+        self._idx_q: "queue.Queue[Optional[Tuple[Any, ...]]]" = queue.Queue(maxsize=256)
+        self._idx_thread: Optional[threading.Thread] = None
+        if self.index is not None:
+            self._idx_thread = threading.Thread(target=self._index_loop, name="trace-index", daemon=True)
+            self._idx_thread.start()
+
+    def _catch_up(self, max_bytes: int = 64 << 20) -> None:
+        """补上索引之前写入的部分；差太多就不在启动路径上做，提示用一次性命令补。"""
+        if not os.path.exists(self.path):
+            return
+        gap = os.path.getsize(self.path) - self.index.indexed_bytes(self.path)
+        if gap <= max_bytes:
+            self.index.index_file(self.path)
+        else:
+            logger.warning(
+                "trace index is %d MB behind %s, run `python -m agentlab.observability.trace_index %s` to catch up",
+                gap >> 20, self.path, self.path,
+            )
+
+    # ---------- 写入 ----------
+
+    def _open(self) -> BinaryIO:
+        if self._f is None:
+            self._f = open(self.path, "ab", buffering=self.buffer_bytes)
+            self._size = self._f.tell()
+            self._opened_at = time.monotonic()
+        return self._f
+
+    def _should_rotate(self, incoming: int) -> bool:
+        if self._size == 0:
+            return False
+        if self.max_bytes and self._size + incoming > self.max_bytes:
+            return True
+        return bool(self.max_age_s) and time.monotonic() - self._opened_at >= self.max_age_s
+
+    def _rotate(self) -> None:
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        self._seq += 1
+        rotated = rotated_name(self.path, self._seq)
+        os.replace(self.path, rotated)
+        if self.index is not None:
+            self._idx_q.put(("replace", self.path, rotated, None, None))
+        self._maint.put(rotated)
+
+    @staticmethod
+    def _record(sp: ReadableSpan) -> Dict[str, Any]:
+        ctx = sp.get_span_context()
+        return {
+            "name": sp.name,
+            "trace_id": f"{ctx.trace_id:032x}",
+            "span_id": f"{ctx.span_id:016x}",
+            "parent_span_id": f"{sp.parent.span_id:016x}" if sp.parent else None,
+            "start_time_ns": sp.start_time,
+            "end_time_ns": sp.end_time,
+            "status": str(sp.status.status_code),
+            "attributes": dict(sp.attributes) if sp.attributes else {},
+            # events / links 如果你想要也可以加，但先保持简洁
+        }
 
     def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
-        with open(self.path, "a", encoding="utf-8") as f:
-            for sp in spans:
-                if sp.name.startswith("GET /session/{session_id}/events"):
-                    continue
-                ctx = sp.get_span_context()
-                rec = {
-                    "name": sp.name,
-                    "trace_id": f"{ctx.trace_id:032x}",
-                    "span_id": f"{ctx.span_id:016x}",
-                    "parent_span_id": f"{sp.parent.span_id:016x}" if sp.parent else None,
-                    "start_time_ns": sp.start_time,
-                    "end_time_ns": sp.end_time,
-                    "status": str(sp.status.status_code),
-                    "attributes": dict(sp.attributes) if sp.attributes else {},
-                    # events / links 如果你想要也可以加，但先保持简洁
-                }
-                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        lines: List[bytes] = []
+        records: List[Dict[str, Any]] = []
+        for sp in spans:
+            if sp.name.startswith("GET /session/{session_id}/events"):
+                continue
+            rec = self._record(sp)
+            lines.append(_dumps(rec))
+            records.append(rec)
+        if not lines:
+            return SpanExportResult.SUCCESS
+
+        payload = b"".join(lines)
+        with self._lock:
+            if self._should_rotate(len(payload)):
+                self._rotate()
+            f = self._open()
+            start = self._size
+            f.write(payload)
+            # 只 flush 到 OS（不 fsync）：trace_tree 按索引 seek 时能读到，代价是一次 write 系统调用
+            f.flush()
+            self._size += len(payload)
+            end = self._size
+            if self.index is not None:
+                entries = []
+                offset = start
+                for line, rec in zip(lines, records):
+                    entries.append((offset, len(line), rec))
+                    offset += len(line)
+                # 在锁内入队：和 _rotate 入队的改名保持先后顺序
+                self._idx_q.put(("add", self.path, entries, end))
         return SpanExportResult.SUCCESS
 
-    def shutdown(self) -> None:
-        return
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        """刷文件并等索引队列写完；超过 timeout_millis 返回 False（BatchSpanProcessor 靠这个上界）。"""
+        deadline = time.monotonic() + timeout_millis / 1000.0
+        if not self._lock.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            return False
+        try:
+            if self._f is not None:
+                self._f.flush()
+        finally:
+            self._lock.release()
+        if self._idx_thread is not None:
+            return self._wait_indexed(deadline)
+        return True
+
+    def _wait_indexed(self, deadline: float) -> bool:
+        # Queue.join() 不带超时：按它的实现在 all_tasks_done 上带超时地等
+        q = self._idx_q
+        with q.all_tasks_done:
+            while q.unfinished_tasks:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                q.all_tasks_done.wait(left)
+        return True
+
+    # ---------- 索引 ----------
+
+    def _index_loop(self) -> None:
+        while True:
+            ops = [self._idx_q.get()]
+            # 把积压的都取出来：相邻的 add 合成一个事务，SQLite 提交次数随积压下降
+            while len(ops) < 256:
+                try:
+                    ops.append(self._idx_q.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                pending: Optional[List[Any]] = None  # [path, entries, end]
+                for op in ops:
+                    if op is None:
+                        break
+                    if op[0] == "add" and pending is not None and pending[0] == op[1]:
+                        pending[1].extend(op[2])
+                        pending[2] = op[3]
+                        continue
+                    if pending is not None:
+                        self._index_apply(("add", *pending))
+                        pending = None
+                    if op[0] == "add":
+                        pending = [op[1], list(op[2]), op[3]]
+                    else:
+                        self._index_apply(op)
+                if pending is not None:
+                    self._index_apply(("add", *pending))
+            finally:
+                for _ in ops:
+                    self._idx_q.task_done()
+            if None in ops:
+                self.index.close()  # 连接是线程本地的：关掉本线程的
+                return
+
+    def _index_apply(self, op: Tuple[Any, ...]) -> None:
+        try:
+            if op[0] == "add":
+                self.index.add(op[1], op[2], op[3])
+            elif op[0] == "replace":
+                self.index.replace_file(op[1], op[2], codec=op[3], blocks=op[4])
+            elif op[0] == "drop":
+                self.index.drop_file(op[1])
+        except Exception:
+            # 索引坏了不影响落盘，之后用 trace_index 命令补建即可
+            logger.exception("trace index %s failed", op[0])
+
+    # ---------- 压缩 / 保留 ----------
+
+    def _maintenance_loop(self) -> None:
+        while True:
+            rotated = self._maint.get()
+            if rotated is None:
+                return
+            try:
+                self._compress(rotated)
+                self._apply_retention()
+            except Exception:
+                logger.exception("trace segment maintenance failed for %s", rotated)
+
+    def _compress(self, rotated: str) -> None:
+        if not self.compress or not os.path.exists(rotated):
+            return
+        dst, blocks = compress_segment(rotated, self.compress)
+        if self.index is not None:
+            self._idx_q.put(("replace", rotated, dst, self.compress, blocks))
+
+    def _apply_retention(self) -> None:
+        rotated = [p for p in segment_paths(self.path) if p != self.path]
+        drop: List[str] = []
+        if self.retention_segments and len(rotated) > self.retention_segments:
+            drop = rotated[: len(rotated) - self.retention_segments]
+            rotated = rotated[len(drop):]
+        if self.retention_bytes:
+            sizes = [os.path.getsize(p) for p in rotated]
+            total = sum(sizes)
+            i = 0
+            while total > self.retention_bytes and i < len(rotated):
+                drop.append(rotated[i])
+                total -= sizes[i]
+                i += 1
+        for p in drop:
+            os.remove(p)
+            if self.index is not None:
+                self._idx_q.put(("drop", p))
+            logger.info("trace segment %s removed by retention policy", p)
+
+    def shutdown(self, timeout_millis: int = 30000) -> None:
+        # 两个后台线程共用一个截止时间：整个 shutdown 最多等 timeout_millis
+        deadline = time.monotonic() + timeout_millis / 1000.0
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+        self._maint.put(None)
+        self._maint_thread.join(timeout=max(0.0, deadline - time.monotonic()))
+        if self._idx_thread is not None:
+            try:
+                self._idx_q.put(None, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                logger.warning("trace index queue still full at shutdown; pending index writes dropped")
+            self._idx_thread.join(timeout=max(0.0, deadline - time.monotonic()))
+        if self.index is not None:
+            self.index.close()
+
+
+# setup_otel 配了尾部采样时指向它（/health 之类可以读 stats）
+tail_sampler: Optional[TailSamplingSpanProcessor] = None
+
+
+def sampling_stats() -> Optional[Dict[str, Any]]:
+    return tail_sampler.stats() if tail_sampler is not None else None
 
 
 def setup_otel(service_name: str = "agentlab") -> None:
     """初始化 OpenTelemetry Tracing（默认写文件，可选 OTLP）。"""
+    global tail_sampler
     resource = Resource.create({"service.name": service_name})
 
     provider = TracerProvider(resource=resource)
     trace.set_tracer_provider(provider)
+    processors: List[BatchSpanProcessor] = []
 
     # ✅ 1) 默认：写到文件（替代 ConsoleSpanExporter，终端不再刷屏）
-    provider.add_span_processor(
-        BatchSpanProcessor(JsonlFileSpanExporter("logs/traces.jsonl"))
+    #    TRACE_INDEX=0 关掉 SQLite 索引（默认开，索引在 logs/traces.index.sqlite）
+    #    TRACE_MAX_MB / TRACE_ROTATE_S 控制轮转，TRACE_COMPRESS=gzip|zstd|none，
+    #    TRACE_RETENTION_SEGMENTS / TRACE_RETENTION_MB 控制保留（0 = 不限）
+    path = "logs/traces.jsonl"
+    index_path = default_index_path(path) if os.getenv("TRACE_INDEX", "1") != "0" else None
+    exporter = JsonlFileSpanExporter(
+        path,
+        index_path=index_path,
+        max_bytes=int(os.getenv("TRACE_MAX_MB", "256")) << 20,
+        max_age_s=float(os.getenv("TRACE_ROTATE_S", "0")),
+        compress=os.getenv("TRACE_COMPRESS", "gzip"),
+        retention_segments=int(os.getenv("TRACE_RETENTION_SEGMENTS", "20")),
+        retention_bytes=int(os.getenv("TRACE_RETENTION_MB", "0")) << 20,
+    )
+    # 队列 / 批放大：高峰期每秒上万 span 时不丢，导出线程一次写一大批
+    processors.append(
+        BatchSpanProcessor(exporter, max_queue_size=65536, max_export_batch_size=4096, schedule_delay_millis=1000)
     )
 
     # ✅ 2) 可选：OTLP exporter（如果你配置了 OTEL_EXPORTER_OTLP_ENDPOINT）
+    #    exporter 包只在配置了 endpoint 时才 import（protobuf / requests 不进启动路径）
     endpoint = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
-    if endpoint and OTLPSpanExporter:
-        provider.add_span_processor(
-            BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint))
+    if endpoint:
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        except Exception:
+            logger.warning("OTEL_EXPORTER_OTLP_ENDPOINT is set but the OTLP exporter is not installed")
+        else:
+            processors.append(BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint)))
+
+    # ✅ 3) 可选：尾部采样（TRACE_SAMPLE_RATE < 1 时开启）：出错 / 超过 TRACE_SLOW_MS 的 run 全留，其余按比例留
+    sample_rate = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+    if sample_rate < 1.0:
+        tail_sampler = TailSamplingSpanProcessor(
+            processors,
+            sample_rate=sample_rate,
+            slow_ms=float(os.getenv("TRACE_SLOW_MS", "10000")),
+            max_buffered_spans=int(os.getenv("TRACE_SAMPLE_MAX_SPANS", "100000")),
         )
+        provider.add_span_processor(tail_sampler)
+    else:
+        for p in processors:
+            provider.add_span_processor(p)
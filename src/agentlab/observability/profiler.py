@@ -0,0 +1,322 @@
+"""
+profiler.py
+按需开启的采样 profiler（管理接口 /admin/profile/*），可以只看某个 session：
+
+- 后台线程每 interval 取一次 sys._current_frames()：
+  · event loop 线程：读当前正在执行的 asyncio task，按 task 名（session:{sid} / session:{sid}:agent:a1 /
+    session:{sid}:plan:n1 ...）归属到 session，栈顶加上 task 名
+  · 线程池线程：sync 工具 / Gemini 流式桥接的生产者在进入线程时打上发起它的 task 名（tagged_thread），
+    同样能按 session 过滤
+- mode="wall" 时还会遍历该 session 所有挂起的 task，沿 cr_await 链展开协程栈：看“在等什么”，
+  而不只是“在算什么”
+- 结果是 folded-stack 文本（flamegraph.pl / speedscope 直接打开）
+
+没开 profiling 时：没有线程、没有 hook，打标签处只多一次全局布尔判断。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+# 有 profile 在跑时为 True；打标签的热路径只看这个
+active = False
+# 线程 id -> 发起它的 task 名（只在 active 时写入）
+_thread_tags: Dict[int, str] = {}
+
+
+def current_task_name() -> Optional[str]:
+    """在 event loop 里调用：当前 task 名（给线程池任务打标签用）。"""
+    if not active:
+        return None
+    try:
+        t = asyncio.current_task()
+    except RuntimeError:
+        return None
+    return t.get_name() if t is not None else None
+
+
+@contextmanager
+def tagged_thread(task_name: Optional[str]) -> Iterator[None]:
+    """在线程池线程里包住实际工作，profile 时这段栈归属到 task_name 对应的 session。"""
+    if not active or not task_name:
+        yield
+        return
+    tid = threading.get_ident()
+    _thread_tags[tid] = task_name
+    try:
+        yield
+    finally:
+        _thread_tags.pop(tid, None)
+
+
+def _session_of(task_name: Optional[str]) -> Optional[str]:
+    if not task_name or not task_name.startswith("session:"):
+        return None
+    return task_name[len("session:"):].split(":", 1)[0]
+
+
+def _frame_label(frame: Any) -> str:
+    code = frame.f_code
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+
+
+def _thread_stack(frame: Any) -> List[str]:
+    """线程当前栈，根在前。"""
+    out: List[str] = []
+    while frame is not None:
+        out.append(_frame_label(frame))
+        frame = frame.f_back
+    out.reverse()
+    return out
+
+
+def _coro_stack(coro: Any) -> List[str]:
+    """挂起协程沿 cr_await / ag_await / gi_yieldfrom 展开，外层在前。"""
+    out: List[str] = []
+    seen = 0
+    while coro is not None and seen < 256:
+        seen += 1
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "ag_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is not None:
+            out.append(_frame_label(frame))
+        nxt = getattr(coro, "cr_await", None)
+        if nxt is None:
+            nxt = getattr(coro, "ag_await", None)
+        if nxt is None:
+            nxt = getattr(coro, "gi_yieldfrom", None)
+        if nxt is None and hasattr(coro, "get_coro"):  # await 了另一个 Task
+            break
+        coro = nxt
+    return out
+
+
+def _current_task(loop: asyncio.AbstractEventLoop, loop_frame: Any) -> Optional[asyncio.Task]:
+    """
+    从采样线程找 loop 当前在跑的 task（asyncio.current_task 只能在 loop 线程里调）。
+    用公开 API：loop 线程栈上哪一帧是某个 task 最外层协程的帧，就是它在跑。
+    """
+    if loop_frame is None:
+        return None
+    on_stack = set()
+    frame = loop_frame
+    while frame is not None:
+        on_stack.add(id(frame))
+        frame = frame.f_back
+    try:
+        tasks = list(asyncio.all_tasks(loop))
+    except RuntimeError:
+        return None  # 迭代时集合被 loop 线程改了，这次当作没采到
+    for t in tasks:
+        coro = t.get_coro()
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is not None and id(frame) in on_stack:
+            return t
+    return None
+
+
+class Profile:
+    def __init__(
+        self,
+        *,
+        loop: asyncio.AbstractEventLoop,
+        loop_thread_id: int,
+        session_id: Optional[str],
+        duration_s: float,
+        interval_s: float,
+        mode: str,
+        out_dir: Optional[str] = None,
+    ) -> None:
+        self.id = uuid.uuid4().hex[:12]
+        self.loop = loop
+        self.loop_thread_id = loop_thread_id
+        self.session_id = session_id
+        self.duration_s = duration_s
+        self.interval_s = interval_s
+        self.mode = mode
+        self.out_dir = out_dir
+        self.path: Optional[str] = None
+        self.started_at = time.time()
+        self.ended_at: Optional[float] = None
+        self.samples = 0
+        self.matched = 0
+        self.stacks: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"profiler:{self.id}", daemon=True)
+
+    # ---------- 采样 ----------
+
+    def _match(self, task_name: Optional[str]) -> bool:
+        return self.session_id is None or _session_of(task_name) == self.session_id
+
+    def _add(self, root: str, frames: List[str]) -> None:
+        key = ";".join([root] + frames)
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.matched += 1
+
+    def _sample(self) -> None:
+        frames = sys._current_frames()
+        self.samples += 1
+        me = threading.get_ident()
+
+        loop_frame = frames.get(self.loop_thread_id)
+        running = _current_task(self.loop, loop_frame)
+        running_name = running.get_name() if running is not None else None
+        if loop_frame is not None:
+            if running is not None and self._match(running_name):
+                stack = _thread_stack(loop_frame)
+                # 去掉 loop 自身的调度栈（run_forever / _run_once / Handle._run），只留 task 的协程部分
+                cut = max((i for i, f in enumerate(stack) if f.startswith("Handle._run ")), default=-1)
+                self._add(f"task {running_name}", stack[cut + 1:])
+            elif running is None and self.session_id is None:
+                self._add("[loop idle]", [])
+
+        for tid, frame in frames.items():
+            if tid in (self.loop_thread_id, me):
+                continue
+            tag = _thread_tags.get(tid)
+            if tag is not None and self._match(tag):
+                self._add(f"thread {tag}", _thread_stack(frame))
+
+        if self.mode == "wall":
+            try:
+                tasks = list(asyncio.all_tasks(self.loop))
+            except RuntimeError:
+                tasks = []  # 迭代时集合被 loop 线程改了，下一次再采
+            for t in tasks:
+                if t is running or t.done():
+                    continue
+                name = t.get_name()
+                if self.session_id is not None and _session_of(name) != self.session_id:
+                    continue
+                if self.session_id is None and _session_of(name) is None:
+                    continue
+                self._add(f"await {name}", _coro_stack(t.get_coro()))
+
+    def _run(self) -> None:
+        deadline = time.monotonic() + self.duration_s
+        try:
+            while not self._stop.is_set() and time.monotonic() < deadline:
+                t0 = time.monotonic()
+                try:
+                    self._sample()
+                except Exception:
+                    pass  # 采样绝不能影响业务
+                self._stop.wait(max(0.0, self.interval_s - (time.monotonic() - t0)))
+        finally:
+            self.ended_at = time.time()
+            _profiles_done(self)
+            if self.out_dir:
+                try:
+                    self.save(self.out_dir)
+                except OSError:
+                    pass
+
+    # ---------- 对外 ----------
+
+    @property
+    def running(self) -> bool:
+        return self.ended_at is None
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def folded(self) -> str:
+        return "".join(f"{k} {v}\n" for k, v in sorted(self.stacks.items()))
+
+    def save(self, out_dir: str) -> str:
+        """结束后落盘 {out_dir}/{id}.folded，进程重启后也能拿去画火焰图。"""
+        os.makedirs(out_dir, exist_ok=True)
+        path = os.path.join(out_dir, f"{self.id}.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.folded())
+        self.path = path
+        return path
+
+    def summary(self, top: int = 15) -> Dict[str, Any]:
+        # 按叶子函数聚合的“自身”样本数，不用火焰图也能一眼看出热点
+        leaf: Dict[str, int] = {}
+        for k, v in self.stacks.items():
+            name = k.rsplit(";", 1)[-1]
+            leaf[name] = leaf.get(name, 0) + v
+        hot = sorted(leaf.items(), key=lambda kv: kv[1], reverse=True)[:top]
+        return {
+            "id": self.id,
+            "session_id": self.session_id,
+            "mode": self.mode,
+            "running": self.running,
+            "started_at": self.started_at,
+            "ended_at": self.ended_at,
+            "duration_s": self.duration_s,
+            "interval_ms": round(self.interval_s * 1000, 2),
+            "samples": self.samples,
+            "matched_samples": self.matched,
+            "distinct_stacks": len(self.stacks),
+            "path": self.path,
+            "top_leaf_frames": [{"frame": f, "samples": n} for f, n in hot],
+        }
+
+
+_lock = threading.Lock()
+_profiles: Dict[str, Profile] = {}
+_MAX_KEPT = 10
+
+
+def _profiles_done(p: Profile) -> None:
+    global active
+    with _lock:
+        active = any(x.running for x in _profiles.values())
+        if not active:
+            _thread_tags.clear()
+
+
+def start_profile(
+    *,
+    session_id: Optional[str] = None,
+    duration_s: float = 30.0,
+    interval_ms: float = 5.0,
+    mode: str = "cpu",
+    max_concurrent: int = 2,
+    out_dir: Optional[str] = "logs/profiles",
+) -> Profile:
+    """在 event loop 线程里调用（需要拿到 loop 和它的线程 id）。"""
+    global active
+    if mode not in ("cpu", "wall"):
+        raise ValueError(f"unknown profile mode: {mode}")
+    with _lock:
+        if sum(1 for p in _profiles.values() if p.running) >= max_concurrent:
+            raise RuntimeError("too many profiles running")
+        p = Profile(
+            loop=asyncio.get_running_loop(),
+            loop_thread_id=threading.get_ident(),
+            session_id=session_id,
+            duration_s=min(max(duration_s, 0.1), 600.0),
+            interval_s=max(interval_ms, 1.0) / 1000.0,
+            mode=mode,
+            out_dir=out_dir,
+        )
+        _profiles[p.id] = p
+        # 只保留最近几个结果
+        for old in [x for x in _profiles.values() if not x.running][:-_MAX_KEPT]:
+            _profiles.pop(old.id, None)
+        active = True
+    p.start()
+    return p
+
+
+def get_profile(profile_id: str) -> Optional[Profile]:
+    return _profiles.get(profile_id)
+
+
+def list_profiles() -> List[Dict[str, Any]]:
+    return [p.summary(top=0) for p in _profiles.values()]
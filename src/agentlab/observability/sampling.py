@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+import collections
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+from opentelemetry.context import Context
+from opentelemetry.sdk.trace import ReadableSpan, Span, SpanProcessor
+from opentelemetry.trace import StatusCode
+
+
+class _TraceBuffer:
+    __slots__ = ("spans", "error", "pending_roots", "max_dur_ns")
+
+    def __init__(self) -> None:
+        self.spans: List[ReadableSpan] = []
+        self.error = False
+        self.pending_roots = 0  # 还没结束的 agent.run 个数
+        self.max_dur_ns = 0
+
+
+class TailSamplingSpanProcessor(SpanProcessor):
+    """
+    尾部采样：按 trace 暂存 span，等整条链路结束再决定要不要交给下游（BatchSpanProcessor 等）导出。
+    - 决策时机：trace 里所有 agent.run 都结束后；没有 agent.run 的 trace（普通 HTTP 请求）在本地根 span
+      结束时决策。react_chat 的 HTTP span 比后台的 agent.run 先结束，所以有 agent.run 在跑时要等它
+    - 保留：有 span 出错、root span 超过 slow_ms，或者按 trace_id 哈希落在 sample_rate 里
+      （按 trace_id 决定而不是随机数：多进程 / 多实例对同一 trace 的决定一致）
+    - 内存有界：总暂存 span 超过 max_buffered_spans、或单个 trace 超过 max_spans_per_trace 时，
+      用当时已知的信息提前决策（出错照样保留）
+    - 决策之后才到的 span（迟到的子任务）按已有决定处理，最近 max_decisions 个决定放在 LRU 里
+    """
+
+    def __init__(
+        self,
+        downstream: Sequence[SpanProcessor],
+        *,
+        sample_rate: float = 0.1,
+        slow_ms: float = 10_000,
+        root_name: str = "agent.run",
+        max_buffered_spans: int = 100_000,
+        max_spans_per_trace: int = 5_000,
+        max_decisions: int = 100_000,
+    ) -> None:
+        self.downstream = list(downstream)
+        self.sample_rate = max(0.0, min(1.0, sample_rate))
+        self.slow_ns = int(slow_ms * 1_000_000)
+        self.root_name = root_name
+        self.max_buffered_spans = max_buffered_spans
+        self.max_spans_per_trace = max_spans_per_trace
+        self.max_decisions = max_decisions
+
+        self._lock = threading.Lock()
+        self._traces: "collections.OrderedDict[int, _TraceBuffer]" = collections.OrderedDict()
+        self._buffered = 0
+        self._decisions: "collections.OrderedDict[int, bool]" = collections.OrderedDict()
+
+        # 统计
+        self.kept_traces = 0
+        self.dropped_traces = 0
+        self.kept_spans = 0
+        self.dropped_spans = 0
+        self.early_decisions = 0
+
+    # ---------- 决策 ----------
+
+    def _sampled(self, trace_id: int) -> bool:
+        # trace_id 低 64 位本身就是随机的，直接当均匀分布用
+        return (trace_id & 0xFFFFFFFFFFFFFFFF) < int(self.sample_rate * 2 ** 64)
+
+    def _decide(self, trace_id: int, buf: _TraceBuffer) -> bool:
+        return buf.error or buf.max_dur_ns >= self.slow_ns or self._sampled(trace_id)
+
+    def _remember(self, trace_id: int, keep: bool) -> None:
+        self._decisions[trace_id] = keep
+        if len(self._decisions) > self.max_decisions:
+            self._decisions.popitem(last=False)
+
+    def _close(self, trace_id: int, buf: _TraceBuffer) -> List[ReadableSpan]:
+        """在锁内调用：结束一个 trace 的暂存，返回要导出的 span（不保留则为空）。"""
+        self._traces.pop(trace_id, None)
+        self._buffered -= len(buf.spans)
+        keep = self._decide(trace_id, buf)
+        self._remember(trace_id, keep)
+        if keep:
+            self.kept_traces += 1
+            self.kept_spans += len(buf.spans)
+            return buf.spans
+        self.dropped_traces += 1
+        self.dropped_spans += len(buf.spans)
+        return []
+
+    # ---------- SpanProcessor ----------
+
+    def on_start(self, span: Span, parent_context: Optional[Context] = None) -> None:
+        if span.name == self.root_name:
+            tid = span.get_span_context().trace_id
+            with self._lock:
+                # react_chat 的后台 job 可能在 HTTP span 结束（trace 已按普通请求决策）之后才开始：
+                # 忘掉那个决定，agent.run 子树重新暂存、单独决策
+                self._decisions.pop(tid, None)
+                buf = self._traces.get(tid)
+                if buf is None:
+                    buf = self._traces[tid] = _TraceBuffer()
+                buf.pending_roots += 1
+        for p in self.downstream:
+            p.on_start(span, parent_context=parent_context)
+
+    def on_end(self, span: ReadableSpan) -> None:
+        tid = span.get_span_context().trace_id
+        export: List[ReadableSpan] = []
+        with self._lock:
+            decided = self._decisions.get(tid)
+            if decided is not None and tid not in self._traces:
+                # 决策之后迟到的 span
+                if decided:
+                    self.kept_spans += 1
+                    export = [span]
+                else:
+                    self.dropped_spans += 1
+            else:
+                buf = self._traces.get(tid)
+                if buf is None:
+                    buf = self._traces[tid] = _TraceBuffer()
+                buf.spans.append(span)
+                self._buffered += 1
+                if span.status.status_code == StatusCode.ERROR:
+                    buf.error = True
+                is_root = span.name == self.root_name
+                is_local_root = span.parent is None or span.parent.is_remote
+                if is_root or is_local_root:
+                    if span.end_time and span.start_time:
+                        buf.max_dur_ns = max(buf.max_dur_ns, span.end_time - span.start_time)
+                if is_root:
+                    buf.pending_roots = max(0, buf.pending_roots - 1)
+
+                if (is_root or is_local_root) and buf.pending_roots == 0:
+                    export = self._close(tid, buf)
+                elif len(buf.spans) >= self.max_spans_per_trace:
+                    self.early_decisions += 1
+                    export = self._close(tid, buf)
+
+                # 总量超限：从最老的 trace 开始提前决策
+                while self._buffered > self.max_buffered_spans and self._traces:
+                    old_tid, old_buf = next(iter(self._traces.items()))
+                    self.early_decisions += 1
+                    export.extend(self._close(old_tid, old_buf))
+        for s in export:
+            for p in self.downstream:
+                p.on_end(s)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sample_rate": self.sample_rate,
+            "slow_ms": self.slow_ns / 1_000_000,
+            "buffered_traces": len(self._traces),
+            "buffered_spans": self._buffered,
+            "kept_traces": self.kept_traces,
+            "dropped_traces": self.dropped_traces,
+            "kept_spans": self.kept_spans,
+            "dropped_spans": self.dropped_spans,
+            "early_decisions": self.early_decisions,
+        }
+
+    def shutdown(self) -> None:
+        # 还在暂存的 trace 按现有信息决策后交给下游，再关闭下游
+        with self._lock:
+            pending = list(self._traces.items())
+            export: List[ReadableSpan] = []
+            for tid, buf in pending:
+                export.extend(self._close(tid, buf))
+        for s in export:
+            for p in self.downstream:
+                p.on_end(s)
+        for p in self.downstream:
+            p.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return all(p.force_flush(timeout_millis) for p in self.downstream)
@@ -0,0 +1,121 @@
+"""
+segments.py
+traces.jsonl 轮转后的分段文件：命名、分块压缩、读取。
+
+- 活跃文件：logs/traces.jsonl
+- 轮转后：logs/traces.20251223-192048.000001.jsonl（按文件名排序即时间顺序）
+- 压缩后：...jsonl.gz / ...jsonl.zst，按约 1MB（整行对齐）切块，每块是独立的 gzip member / zstd frame，
+  整个文件仍可以直接 zcat / zstdcat；块表 (原始偏移, 压缩偏移) 存进 trace 索引，
+  按索引查 span 时只解压它所在的那一块。
+"""
+
+from __future__ import annotations
+
+import glob
+import gzip
+import io
+import os
+import re
+import time
+from typing import IO, Iterator, List, Optional, Tuple
+
+try:
+    import zstandard
+except Exception:
+    zstandard = None  # type: ignore
+
+CODEC_EXT = {"gzip": ".gz", "zstd": ".zst"}
+
+
+def codec_of(path: str) -> Optional[str]:
+    for codec, ext in CODEC_EXT.items():
+        if path.endswith(ext):
+            return codec
+    return None
+
+
+def check_codec(codec: Optional[str]) -> Optional[str]:
+    """校验压缩方式；zstd 没装 zstandard 时退回 gzip。"""
+    if not codec or codec == "none":
+        return None
+    if codec not in CODEC_EXT:
+        raise ValueError(f"unknown trace codec: {codec}")
+    if codec == "zstd" and zstandard is None:
+        return "gzip"
+    return codec
+
+
+def rotated_name(path: str, seq: int, ts: Optional[float] = None) -> str:
+    base, ext = os.path.splitext(path)
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(ts if ts is not None else time.time()))
+    return f"{base}.{stamp}.{seq:06d}{ext}"
+
+
+def last_seq(path: str) -> int:
+    """已有分段里最大的序号（进程重启后接着编号，避免同一秒内重名）。"""
+    seqs = [int(m.group(1)) for p in segment_paths(path) if (m := re.search(r"\.(\d{6})\.", os.path.basename(p)))]
+    return max(seqs, default=0)
+
+
+def segment_paths(path: str) -> List[str]:
+    """某个活跃文件对应的所有分段（轮转出去的按时间顺序，最后是活跃文件本身）。"""
+    base, ext = os.path.splitext(path)
+    rotated = sorted(
+        p for p in glob.glob(f"{glob.escape(base)}.*{ext}*")
+        if p != path and (p.endswith(ext) or codec_of(p))
+    )
+    return rotated + ([path] if os.path.exists(path) else [])
+
+
+def compress_block(data: bytes, codec: str) -> bytes:
+    if codec == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    return zstandard.ZstdCompressor(level=3).compress(data)
+
+
+def decompress_block(data: bytes, codec: str) -> bytes:
+    if codec == "gzip":
+        return gzip.decompress(data)
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+def compress_segment(src: str, codec: str, block_bytes: int = 1 << 20) -> Tuple[str, List[Tuple[int, int]]]:
+    """
+    把一个已轮转的分段分块压缩成 src + .gz/.zst，删掉原文件。
+    返回 (新路径, 块表 [(原始偏移, 压缩偏移)])。块边界总在行尾，单行不会跨块。
+    """
+    dst = src + CODEC_EXT[codec]
+    tmp = dst + ".tmp"
+    blocks: List[Tuple[int, int]] = []
+    raw_off = 0
+    with open(src, "rb") as fin, open(tmp, "wb") as fout:
+        while True:
+            chunk = fin.read(block_bytes)
+            if not chunk:
+                break
+            if not chunk.endswith(b"\n"):
+                chunk += fin.readline()
+            blocks.append((raw_off, fout.tell()))
+            fout.write(compress_block(chunk, codec))
+            raw_off += len(chunk)
+    os.replace(tmp, dst)
+    os.remove(src)
+    return dst, blocks
+
+
+def open_segment(path: str) -> IO[bytes]:
+    """按二进制流打开分段（压缩的话透明解压），用于全量扫描。"""
+    codec = codec_of(path)
+    if codec == "gzip":
+        return gzip.open(path, "rb")
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError(f"zstandard is required to read {path}")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True))
+    return open(path, "rb")
+
+
+def iter_lines(paths: List[str]) -> Iterator[bytes]:
+    for p in paths:
+        with open_segment(p) as f:
+            yield from f
@@ -0,0 +1,440 @@
+"""
+trace_index.py
+traces.jsonl 的 SQLite 索引：trace_id -> (文件, 字节偏移, 长度)，外加 trace 时间范围和属性倒排，
+trace_tree 查单个 trace 时直接 seek，不用整文件 json.loads。
+
+- JsonlFileSpanExporter 写文件时顺手把偏移写进索引（增量维护）
+- 轮转 / 压缩后的分段由导出器在轮转时更新路径和块表（见 segments.py），查询照样直接定位
+- 老文件 / 别处拷来的文件用一次性命令建索引（已索引过的部分会跳过，只补新追加的字节）：
+    python -m agentlab.observability.trace_index logs/traces.jsonl
+    python -m agentlab.observability.trace_index logs/traces.jsonl --rebuild
+"""
+
+from __future__ import annotations
+
+import argparse
+import bisect
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from agentlab.observability.segments import codec_of, decompress_block
+
+# 超过这个长度的属性值不进倒排（prompt / 大段输出之类，按值查也没意义）
+MAX_ATTR_VALUE_LEN = 256
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    indexed_bytes INTEGER NOT NULL DEFAULT 0,
+    codec TEXT
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    file_id INTEGER NOT NULL,
+    raw_offset INTEGER NOT NULL,
+    comp_offset INTEGER NOT NULL,
+    PRIMARY KEY (file_id, raw_offset)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS spans (
+    trace_id TEXT NOT NULL,
+    file_id INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    start_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS spans_trace ON spans(trace_id);
+CREATE UNIQUE INDEX IF NOT EXISTS spans_pos ON spans(file_id, offset);
+CREATE TABLE IF NOT EXISTS traces (
+    trace_id TEXT PRIMARY KEY,
+    start_ns INTEGER NOT NULL,
+    end_ns INTEGER NOT NULL,
+    root_name TEXT
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS traces_start ON traces(start_ns);
+CREATE TABLE IF NOT EXISTS attrs (
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    trace_id TEXT NOT NULL,
+    PRIMARY KEY (key, value, trace_id)
+) WITHOUT ROWID;
+"""
+
+
+def default_index_path(jsonl_path: str) -> str:
+    """logs/traces.jsonl -> logs/traces.index.sqlite"""
+    base, _ = os.path.splitext(jsonl_path)
+    return base + ".index.sqlite"
+
+
+def attr_text(value: Any) -> Optional[str]:
+    """属性值统一成文本（字符串原样，其余 JSON），过长或非标量返回 None。"""
+    if isinstance(value, str):
+        text = value
+    elif isinstance(value, (bool, int, float)) or value is None:
+        text = json.dumps(value)
+    else:
+        return None
+    return text if len(text) <= MAX_ATTR_VALUE_LEN else None
+
+
+class TraceIndex:
+    """
+    线程安全：每个线程一个连接（导出线程写、查询方读），WAL 模式下读写互不阻塞。
+    """
+
+    def __init__(self, db_path: str) -> None:
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript(_SCHEMA)
+            cols = {r[1] for r in conn.execute("PRAGMA table_info(files)")}
+            if "codec" not in cols:  # 早期版本建的索引
+                conn.execute("ALTER TABLE files ADD COLUMN codec TEXT")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # ---------- 写入 ----------
+
+    def _file_id(self, conn: sqlite3.Connection, path: str) -> Tuple[int, int]:
+        path = os.path.abspath(path)
+        row = conn.execute("SELECT id, indexed_bytes FROM files WHERE path = ?", (path,)).fetchone()
+        if row:
+            return row[0], row[1]
+        cur = conn.execute("INSERT INTO files(path, indexed_bytes) VALUES (?, 0)", (path,))
+        return int(cur.lastrowid), 0
+
+    def indexed_bytes(self, path: str) -> int:
+        row = self._conn().execute("SELECT indexed_bytes FROM files WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        return int(row[0]) if row else 0
+
+    def add(self, path: str, entries: Sequence[Tuple[int, int, Dict[str, Any]]], end_offset: int) -> None:
+        """
+        记录一批已写入 path 的 span：entries 是 (字节偏移, 行长度, span dict)，
+        end_offset 是这批写完后的文件长度。
+        只有和已索引部分首尾相接时才推进 indexed_bytes；中间有空洞（老数据没索引）时留给
+        index_file 补，重复的行按 (file, offset) 去重，traces / attrs 的更新本身是幂等的。
+        """
+        if not entries:
+            return
+        conn = self._conn()
+        with conn:
+            file_id, indexed = self._file_id(conn, path)
+            self._insert(conn, file_id, entries)
+            if indexed >= entries[0][0]:
+                conn.execute("UPDATE files SET indexed_bytes = ? WHERE id = ?", (max(indexed, end_offset), file_id))
+
+    def _insert(self, conn: sqlite3.Connection, file_id: int, entries: Sequence[Tuple[int, int, Dict[str, Any]]]) -> None:
+        span_rows = []
+        trace_rows: Dict[str, List[Any]] = {}
+        attr_rows = set()
+        for offset, length, rec in entries:
+            tid = rec.get("trace_id")
+            if not tid:
+                continue
+            start = int(rec.get("start_time_ns") or 0)
+            end = int(rec.get("end_time_ns") or start)
+            span_rows.append((tid, file_id, offset, length, start))
+            name = str(rec.get("name", ""))
+            root_name = name if not rec.get("parent_span_id") else None
+            t = trace_rows.get(tid)
+            if t is None:
+                trace_rows[tid] = [start, end, root_name]
+            else:
+                t[0] = min(t[0], start)
+                t[1] = max(t[1], end)
+                t[2] = t[2] or root_name
+            attr_rows.add(("span.name", name, tid))
+            if "ERROR" in str(rec.get("status", "")):
+                attr_rows.add(("span.status", "ERROR", tid))
+            for k, v in (rec.get("attributes") or {}).items():
+                text = attr_text(v)
+                if text is not None:
+                    attr_rows.add((k, text, tid))
+
+        conn.executemany(
+            "INSERT OR IGNORE INTO spans(trace_id, file_id, offset, length, start_ns) VALUES (?, ?, ?, ?, ?)",
+            span_rows,
+        )
+        conn.executemany(
+            """
+            INSERT INTO traces(trace_id, start_ns, end_ns, root_name) VALUES (?, ?, ?, ?)
+            ON CONFLICT(trace_id) DO UPDATE SET
+                start_ns = min(start_ns, excluded.start_ns),
+                end_ns = max(end_ns, excluded.end_ns),
+                root_name = coalesce(root_name, excluded.root_name)
+            """,
+            [(tid, *v) for tid, v in trace_rows.items()],
+        )
+        conn.executemany("INSERT OR IGNORE INTO attrs(key, value, trace_id) VALUES (?, ?, ?)", list(attr_rows))
+
+    def index_file(self, path: str, *, rebuild: bool = False, batch_size: int = 5000) -> int:
+        """
+        增量索引：只解析 indexed_bytes 之后新追加的完整行，返回新索引的 span 数。
+        文件比记录的还短（被截断 / 轮转后新建）时只丢掉这个文件的索引行、从头重建它；
+        其他文件（尤其是没法再重新索引的压缩分段）不受影响。
+        压缩分段只能在轮转时由导出器登记（需要块表），这里不处理。
+        """
+        if codec_of(path):
+            raise ValueError(f"compressed segment {path} must be indexed before compression")
+        conn = self._conn()
+        with conn:
+            file_id, start = self._file_id(conn, path)
+        size = os.path.getsize(path)
+        if rebuild or size < start:
+            with conn:
+                self._forget_file_spans(conn, file_id)
+                conn.execute("UPDATE files SET indexed_bytes = 0 WHERE id = ?", (file_id,))
+            start = 0
+        if size == start:
+            return 0
+
+        n = 0
+        batch: List[Tuple[int, int, Dict[str, Any]]] = []
+        offset = start
+        with open(path, "rb") as f:
+            f.seek(start)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # 写到一半的最后一行，下次再索引
+                length = len(line)
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    rec = None
+                if isinstance(rec, dict):
+                    batch.append((offset, length, rec))
+                offset += length
+                if len(batch) >= batch_size:
+                    n += len(batch)
+                    with conn:
+                        self._insert(conn, file_id, batch)
+                        conn.execute("UPDATE files SET indexed_bytes = ? WHERE id = ?", (offset, file_id))
+                    batch = []
+        n += len(batch)
+        with conn:
+            self._insert(conn, file_id, batch)
+            conn.execute("UPDATE files SET indexed_bytes = ? WHERE id = ?", (offset, file_id))
+        return n
+
+    def replace_file(
+        self,
+        old_path: str,
+        new_path: str,
+        *,
+        codec: Optional[str] = None,
+        blocks: Optional[Sequence[Tuple[int, int]]] = None,
+    ) -> None:
+        """分段被改名 / 压缩后更新路径；压缩时一并登记块表（原始偏移 -> 压缩偏移）。"""
+        conn = self._conn()
+        with conn:
+            row = conn.execute("SELECT id FROM files WHERE path = ?", (os.path.abspath(old_path),)).fetchone()
+            if row is None:
+                return
+            conn.execute(
+                "UPDATE files SET path = ?, codec = ? WHERE id = ?",
+                (os.path.abspath(new_path), codec, row[0]),
+            )
+            if blocks:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO blocks(file_id, raw_offset, comp_offset) VALUES (?, ?, ?)",
+                    [(row[0], r, c) for r, c in blocks],
+                )
+
+    def drop_file(self, path: str) -> None:
+        """保留策略删掉分段时调用：删它的 span / 块表，以及因此不再有 span 的 trace 和属性。"""
+        conn = self._conn()
+        with conn:
+            row = conn.execute("SELECT id FROM files WHERE path = ?", (os.path.abspath(path),)).fetchone()
+            if row is None:
+                return
+            file_id = row[0]
+            self._forget_file_spans(conn, file_id)
+            conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+    @staticmethod
+    def _forget_file_spans(conn: sqlite3.Connection, file_id: int) -> None:
+        """删一个文件的 span / 块表，以及因此不再有 span 的 trace 和属性（调用方负责事务）。"""
+        gone = [r[0] for r in conn.execute("SELECT DISTINCT trace_id FROM spans WHERE file_id = ?", (file_id,))]
+        conn.execute("DELETE FROM spans WHERE file_id = ?", (file_id,))
+        conn.execute("DELETE FROM blocks WHERE file_id = ?", (file_id,))
+        # trace 可能跨分段：只删已经没有任何 span 的（还剩 span 的 trace 时间范围可能偏宽，不影响定位）
+        dead = [(t,) for t in gone if conn.execute("SELECT 1 FROM spans WHERE trace_id = ? LIMIT 1", (t,)).fetchone() is None]
+        conn.executemany("DELETE FROM traces WHERE trace_id = ?", dead)
+        if dead:
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS dead_traces (trace_id TEXT PRIMARY KEY)")
+            conn.execute("DELETE FROM dead_traces")
+            conn.executemany("INSERT OR IGNORE INTO dead_traces VALUES (?)", dead)
+            conn.execute("DELETE FROM attrs WHERE trace_id IN (SELECT trace_id FROM dead_traces)")
+
+    def reset(self) -> List[str]:
+        """
+        清掉所有未压缩文件的索引（进度归零，等 index_file 从头重建），返回这些文件的路径。
+        压缩分段的行保留：它们的块表只能在轮转时由导出器登记，index_file 没法重新索引。
+        """
+        conn = self._conn()
+        with conn:
+            rows = conn.execute("SELECT id, path FROM files WHERE codec IS NULL").fetchall()
+            for file_id, _path in rows:
+                self._forget_file_spans(conn, file_id)
+            conn.execute("UPDATE files SET indexed_bytes = 0 WHERE codec IS NULL")
+        return [path for _id, path in rows]
+
+    # ---------- 查询 ----------
+
+    def locate(self, trace_id: str) -> List[Tuple[str, int, int]]:
+        """trace_id -> [(文件路径, 偏移, 长度)]，按文件、偏移排序（读的时候顺序 seek）。"""
+        rows = self._conn().execute(
+            """
+            SELECT f.path, s.offset, s.length FROM spans s JOIN files f ON f.id = s.file_id
+            WHERE s.trace_id = ? ORDER BY f.path, s.offset
+            """,
+            (trace_id,),
+        ).fetchall()
+        return [(r[0], r[1], r[2]) for r in rows]
+
+    def _block_table(self, path: str) -> Tuple[List[int], List[int]]:
+        rows = self._conn().execute(
+            """
+            SELECT b.raw_offset, b.comp_offset FROM blocks b JOIN files f ON f.id = b.file_id
+            WHERE f.path = ? ORDER BY b.raw_offset
+            """,
+            (path,),
+        ).fetchall()
+        return [r[0] for r in rows], [r[1] for r in rows]
+
+    def read_records(self, trace_id: str) -> Iterator[Dict[str, Any]]:
+        """按索引 seek 读出某个 trace 的所有 span（原始 dict）；压缩分段只解压命中的块。"""
+        current: Optional[str] = None
+        f = None
+        codec: Optional[str] = None
+        raw_offs: List[int] = []
+        comp_offs: List[int] = []
+        cached: Tuple[int, bytes] = (-1, b"")
+        try:
+            for path, offset, length in self.locate(trace_id):
+                if path != current:
+                    if f is not None:
+                        f.close()
+                    if not os.path.exists(path):
+                        current, f = path, None
+                        continue
+                    f = open(path, "rb")
+                    current = path
+                    codec = codec_of(path)
+                    if codec:
+                        raw_offs, comp_offs = self._block_table(path)
+                    cached = (-1, b"")
+                if f is None:
+                    continue
+                if not codec:
+                    f.seek(offset)
+                    data = f.read(length)
+                else:
+                    i = bisect.bisect_right(raw_offs, offset) - 1
+                    if i < 0:
+                        continue
+                    if cached[0] != i:
+                        f.seek(comp_offs[i])
+                        end = comp_offs[i + 1] if i + 1 < len(comp_offs) else None
+                        comp = f.read(end - comp_offs[i]) if end is not None else f.read()
+                        cached = (i, decompress_block(comp, codec))
+                    rel = offset - raw_offs[i]
+                    data = cached[1][rel:rel + length]
+                try:
+                    yield json.loads(data)
+                except ValueError:
+                    continue
+        finally:
+            if f is not None:
+                f.close()
+
+    def find_traces(
+        self,
+        *,
+        start_ns: Optional[int] = None,
+        end_ns: Optional[int] = None,
+        where: Optional[Dict[str, str]] = None,
+        limit: int = 100,
+    ) -> List[Dict[str, Any]]:
+        """
+        时间范围（和 [start_ns, end_ns] 有交集）+ 属性等值条件（全部满足），按开始时间倒序。
+        where 的 key 可以是任意 span 属性，另有 span.name / span.status 两个虚拟属性。
+        """
+        sql = [
+            "SELECT t.trace_id, t.start_ns, t.end_ns, t.root_name,"
+            " (SELECT COUNT(*) FROM spans s WHERE s.trace_id = t.trace_id) FROM traces t"
+        ]
+        cond: List[str] = []
+        params: List[Any] = []
+        for i, (k, v) in enumerate((where or {}).items()):
+            sql.append(f"JOIN attrs a{i} ON a{i}.trace_id = t.trace_id AND a{i}.key = ? AND a{i}.value = ?")
+            params += [k, v]
+        if start_ns is not None:
+            cond.append("t.end_ns >= ?")
+            params.append(start_ns)
+        if end_ns is not None:
+            cond.append("t.start_ns <= ?")
+            params.append(end_ns)
+        if cond:
+            sql.append("WHERE " + " AND ".join(cond))
+        sql.append("ORDER BY t.start_ns DESC LIMIT ?")
+        params.append(limit)
+        rows = self._conn().execute(" ".join(sql), params).fetchall()
+        return [
+            {"trace_id": r[0], "start_ns": r[1], "end_ns": r[2], "root": r[3], "spans": r[4]}
+            for r in rows
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        conn = self._conn()
+        return {
+            "files": [
+                {"path": p, "indexed_bytes": b}
+                for p, b in conn.execute("SELECT path, indexed_bytes FROM files ORDER BY path")
+            ],
+            "spans": conn.execute("SELECT COUNT(*) FROM spans").fetchone()[0],
+            "traces": conn.execute("SELECT COUNT(*) FROM traces").fetchone()[0],
+        }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="为 traces.jsonl 建 / 补 SQLite 索引")
+    ap.add_argument("files", nargs="+", help="要索引的 JSONL 文件")
+    ap.add_argument("--index", default=None, help="索引路径（默认与第一个文件同名 .index.sqlite）")
+    ap.add_argument("--rebuild", action="store_true", help="忽略已有进度，从头重建")
+    args = ap.parse_args()
+
+    idx = TraceIndex(args.index or default_index_path(args.files[0]))
+    paths = list(args.files)
+    if args.rebuild:
+        # 之前索引过的未压缩分段也一起重建（压缩分段的索引 reset 不动）
+        known = {os.path.abspath(p) for p in paths}
+        paths += [p for p in idx.reset() if p not in known and os.path.exists(p)]
+    for path in paths:
+        if codec_of(path):
+            print(f"{path}: skipped (compressed segments are indexed when rotated)")
+            continue
+        n = idx.index_file(path)
+        print(f"{path}: +{n} spans")
+    print(json.dumps(idx.stats(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
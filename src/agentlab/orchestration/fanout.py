@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence
+
+from opentelemetry import trace
+
+from agentlab.models.base import LLMClient, capture_usage, estimate_tokens
+from agentlab.orchestration.react_loop import _account_usage, _extract_json, _init_stats, run_react, stream_final_answer
+from agentlab.runtime.cancel import CancellationToken
+from agentlab.tools.registry import ToolRegistry, ToolRunner
+from agentlab.types import Message
+import logging
+logger = logging.getLogger(__name__)
+
+
+class BudgetExceeded(RuntimeError):
+    pass
+
+
+class SharedBudget:
+    """所有子 agent 共享的总预算：ReAct 步数 + LLM token（token 为估算值）。"""
+
+    def __init__(self, max_steps: int, max_tokens: Optional[int] = None) -> None:
+        self.max_steps = max_steps
+        self.max_tokens = max_tokens
+        self.steps = 0
+        self.tokens = 0
+
+    def consume_step(self) -> None:
+        if self.steps >= self.max_steps:
+            raise BudgetExceeded(f"shared step budget exhausted ({self.max_steps})")
+        self.steps += 1
+
+    def check_tokens(self) -> None:
+        if self.max_tokens is not None and self.tokens >= self.max_tokens:
+            raise BudgetExceeded(f"shared token budget exhausted ({self.max_tokens})")
+
+    def add_tokens(self, n: int) -> None:
+        self.tokens += n
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"steps": self.steps, "max_steps": self.max_steps, "tokens": self.tokens, "max_tokens": self.max_tokens}
+
+
+class BudgetedLLMClient(LLMClient):
+    """子 agent 共用：限制同时在途的 LLM 调用数，并把 token 记到共享预算上。"""
+
+    def __init__(self, inner: LLMClient, budget: SharedBudget, sem: asyncio.Semaphore) -> None:
+        self.inner = inner
+        self.budget = budget
+        self.sem = sem
+        self.model = getattr(inner, "model", None)
+
+    async def generate(self, messages: List[Message]) -> str:
+        self.budget.check_tokens()
+        async with self.sem:
+            text = await self.inner.generate(messages)
+        self.budget.add_tokens(estimate_tokens(messages) + len(text) // 4)
+        return text
+
+    async def stream(self, messages: List[Message]) -> AsyncIterator[str]:
+        self.budget.check_tokens()
+        emitted = 0
+        async with self.sem:
+            async for chunk in self.inner.stream(messages):
+                emitted += len(chunk)
+                yield chunk
+        self.budget.add_tokens(estimate_tokens(messages) + emitted // 4)
+
+
+class TaggedBus:
+    """子 agent 的事件子流：仍发到父 session，但每条都带 agent_id，前端可按 agent 分流展示。"""
+
+    def __init__(self, bus: Any, agent_id: str) -> None:
+        self.bus = bus
+        self.agent_id = agent_id
+
+    async def publish(self, session_id: str, event: Dict[str, Any]) -> None:
+        await self.bus.publish(session_id, {**event, "agent_id": self.agent_id})
+
+
+def build_decompose_prompt(max_agents: int) -> str:
+    return (
+        "你是一个任务拆解器。请把用户的问题拆成若干个可以独立并行研究的子问题。\n"
+        "严格只输出 JSON，不要输出任何额外文本：\n"
+        '{"subtasks":["<子问题1>","<子问题2>"]}\n'
+        f"规则：最多 {max_agents} 个子问题；子问题之间不要互相依赖；问题本身很简单时只输出 1 个。\n"
+    )
+
+
+async def run_fanout(
+    *,
+    session_id: str,
+    llm: Any,
+    registry: ToolRegistry,
+    runner: ToolRunner,
+    bus: Any,
+    token: Any,
+    user_prompt: str,
+    user_system: Optional[str] = None,
+    max_agents: int = 4,
+    max_steps_per_agent: int = 6,
+    max_total_steps: int = 16,
+    max_total_tokens: Optional[int] = None,
+    llm_concurrency: int = 4,
+    tool_names: Optional[Sequence[str]] = None,  # 可选：子 agent 只开放这些工具
+    stats: Optional[Dict[str, Any]] = None,  # 可选：同 run_react，子 agent 的步数 / 调用 / token 汇总进来
+) -> str:
+    """
+    并发子 agent：
+    - 先让 LLM 把问题拆成子问题
+    - 每个子问题一个 run_react，并发执行；共享父取消令牌、总步数/token 预算、LLM 并发上限
+    - 每个子 agent 的事件带 agent_id 发到同一个 session
+    - 最后把子答案合并成最终回答（流式）
+    父任务取消时，看门狗立刻 cancel 所有子任务（不必等子任务走到下一个 checkpoint）。
+    """
+    tracer = trace.get_tracer(__name__)
+    stats = _init_stats(stats)
+    tool_names = registry.normalize_names(tool_names)  # 未知工具在拆解之前就报错
+    budget = SharedBudget(max_total_steps, max_total_tokens)
+    shared_llm = BudgetedLLMClient(llm, budget, asyncio.Semaphore(llm_concurrency))
+    child_stats: List[Dict[str, Any]] = []
+
+    # 1) 拆解
+    await token.checkpoint()
+    t0 = time.perf_counter()
+    with capture_usage() as usage:
+        raw = await shared_llm.generate([
+            {"role": "system", "content": build_decompose_prompt(max_agents)},
+            {"role": "user", "content": user_prompt},
+        ])
+    stats["llm_calls"] += 1
+    stats["llm_ms"] += (time.perf_counter() - t0) * 1000
+    _account_usage(trace.INVALID_SPAN, stats, usage.total, "action")
+    try:
+        subtasks = _extract_json(raw).get("subtasks")
+    except ValueError:
+        subtasks = None
+    if not isinstance(subtasks, list) or not subtasks:
+        subtasks = [user_prompt]  # 拆不出来就退化为单 agent
+    subtasks = [str(s) for s in subtasks][:max_agents]
+    stats["agents"] = len(subtasks)
+    await bus.publish(session_id, {"type": "fanout_plan", "subtasks": subtasks, "budget": budget.snapshot()})
+
+    # 2) 并发执行
+    async def _child(agent_id: str, question: str, child_token: CancellationToken) -> Dict[str, Any]:
+        sub_bus = TaggedBus(bus, agent_id)
+        sub_stats: Dict[str, Any] = {}
+        child_stats.append(sub_stats)
+        t0 = time.time()
+        await sub_bus.publish(session_id, {"type": "subagent_start", "question": question})
+        with tracer.start_as_current_span(
+            "subagent.run",
+            attributes={"session_id": session_id, "agent_id": agent_id},
+        ):
+            try:
+                answer = await run_react(
+                    session_id=session_id,
+                    llm=shared_llm,
+                    registry=registry,
+                    runner=runner,
+                    bus=sub_bus,
+                    token=child_token,
+                    user_prompt=question,
+                    user_system=user_system,
+                    max_steps=max_steps_per_agent,
+                    budget=budget,
+                    tool_names=tool_names,
+                    stats=sub_stats,
+                )
+            except asyncio.CancelledError:
+                await sub_bus.publish(session_id, {"type": "subagent_cancelled"})
+                raise
+            except Exception as e:
+                # 单个子 agent 失败不拖垮整体：带着错误进入合并阶段
+                await sub_bus.publish(session_id, {"type": "subagent_error", "error": str(e)})
+                return {"agent_id": agent_id, "question": question, "ok": False, "error": str(e)}
+        await sub_bus.publish(session_id, {"type": "subagent_done", "duration_ms": int((time.time() - t0) * 1000)})
+        return {"agent_id": agent_id, "question": question, "ok": True, "answer": answer}
+
+    children: List[asyncio.Task] = []
+    for i, q in enumerate(subtasks):
+        agent_id = f"a{i + 1}"
+        child_token = token.child() if isinstance(token, CancellationToken) else CancellationToken()
+        children.append(asyncio.create_task(_child(agent_id, q, child_token), name=f"session:{session_id}:agent:{agent_id}"))
+
+    async def _watchdog() -> None:
+        await token.wait()
+        for t in children:
+            t.cancel()
+
+    watchdog = asyncio.create_task(_watchdog()) if hasattr(token, "wait") else None
+    try:
+        results = await asyncio.gather(*children)
+    except BaseException:
+        for t in children:
+            t.cancel()
+        await asyncio.gather(*children, return_exceptions=True)
+        raise
+    finally:
+        if watchdog is not None:
+            watchdog.cancel()
+        # 子 agent 的统计（失败的也算，跑了多少就是多少）汇总到父 run；ttft 只看合并阶段
+        for sub in child_stats:
+            for k, v in sub.items():
+                if k != "ttft_ms" and k in stats:
+                    stats[k] += v
+
+    await token.checkpoint()
+    await bus.publish(session_id, {"type": "fanout_merge", "ok": sum(r["ok"] for r in results), "total": len(results), "budget": budget.snapshot()})
+    if not any(r["ok"] for r in results):
+        raise RuntimeError(f"all sub-agents failed: {json.dumps(results, ensure_ascii=False)[:500]}")
+
+    # 3) 合并（合并阶段不受子 agent 预算限制，用原始 llm）
+    t0 = time.perf_counter()
+    with capture_usage() as usage:
+        final_text = await stream_final_answer(
+            session_id=session_id,
+            llm=llm,
+            bus=bus,
+            token=token,
+            user_prompt=user_prompt,
+            user_system=user_system,
+            observations=[{"ok": True, "sub_answers": results}],
+        )
+    stats["llm_calls"] += 1
+    stats["llm_ms"] += (time.perf_counter() - t0) * 1000
+    _account_usage(trace.INVALID_SPAN, stats, usage.total, "final")
+    return final_text
@@ -0,0 +1,389 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from opentelemetry import trace
+
+from agentlab.models.base import capture_usage
+from agentlab.orchestration.react_loop import (
+    _account_usage,
+    _extract_json,
+    _init_stats,
+    _tools_summary,
+    stream_final_answer,
+)
+from agentlab.tools.registry import ToolError, ToolRegistry, ToolRunner
+from agentlab.types import Message
+
+# 参数里引用前序节点输出：整串是 "${id.path}" 时保留原类型，嵌在字符串里则做文本替换
+REF_RE = re.compile(r"\$\{([A-Za-z_][\w-]*)((?:\.[\w-]+)*)\}")
+
+
+class PlanError(ValueError):
+    """plan 结构不合法（未知工具 / 依赖不存在 / 有环 / 引用解析失败）。"""
+
+
+@dataclass
+class PlanNode:
+    id: str
+    tool: str
+    args: Dict[str, Any]
+    deps: List[str] = field(default_factory=list)
+
+
+def build_plan_system_prompt(registry: ToolRegistry, tool_names: Optional[Tuple[str, ...]] = None) -> str:
+    """
+    Plan-and-Execute 的“计划协议”：模型一次性输出整个工具调用 DAG。
+    - 计划：{"type":"plan","nodes":[{"id":"a","tool":"calc","args":{...},"deps":[]}, ...]}
+    - 不需要工具：{"type":"final","final":"..."}
+    按注册表 version 缓存（同 build_react_system_prompt）。
+    """
+    return registry.cached(("plan_prompt", tool_names), lambda: _plan_prompt(_tools_summary(registry, tool_names)))
+
+
+def _plan_prompt(tools: str) -> str:
+    return (
+        "你是一个会规划工具调用的智能体。你必须严格按 JSON 输出，不要输出任何额外文本。\n"
+        "请一次性给出完成任务所需的全部工具调用，组成一个有向无环图：\n"
+        '{"type":"plan","nodes":[{"id":"<唯一id>","tool":"<tool>","args":{...},"deps":["<前置节点id>"]}]}\n'
+        "如果不需要任何工具，直接输出：\n"
+        '{"type":"final","final":"<你的最终回答>"}\n'
+        "规则：\n"
+        "1) 只能从工具列表里选择 tool。\n"
+        "2) 互不依赖的节点会被并行执行，尽量拆成可并行的节点。\n"
+        '3) args 中可以用 "${<节点id>}" 或 "${<节点id>.<字段>}" 引用前序节点的工具返回值，'
+        "被引用的节点会自动成为依赖。\n"
+        "4) 不要输出思考过程，不要输出 markdown，只输出 JSON。\n\n"
+        f"可用工具列表：\n{tools}\n"
+    )
+
+
+def _collect_refs(value: Any, out: set[str]) -> None:
+    if isinstance(value, str):
+        for m in REF_RE.finditer(value):
+            out.add(m.group(1))
+    elif isinstance(value, dict):
+        for v in value.values():
+            _collect_refs(v, out)
+    elif isinstance(value, list):
+        for v in value:
+            _collect_refs(v, out)
+
+
+def parse_plan(
+    action: Dict[str, Any],
+    registry: ToolRegistry,
+    known: Optional[set[str]] = None,
+    allowed: Optional[Tuple[str, ...]] = None,
+) -> List[PlanNode]:
+    """
+    校验并解析模型给出的 plan。
+    known：之前轮次已经成功的节点 id（重规划时新 plan 可以直接引用它们的结果）。
+    allowed：这次 run 开放的工具（None = 全部）。
+    """
+    known = known or set()
+    raw_nodes = action.get("nodes")
+    if not isinstance(raw_nodes, list) or not raw_nodes:
+        raise PlanError("plan.nodes must be a non-empty list")
+
+    nodes: Dict[str, PlanNode] = {}
+    for raw in raw_nodes:
+        if not isinstance(raw, dict):
+            raise PlanError(f"plan node must be object, got: {raw!r}")
+        nid, tool, args = raw.get("id"), raw.get("tool"), raw.get("args", {})
+        if not isinstance(nid, str) or not nid:
+            raise PlanError(f"node id must be non-empty string, got: {nid!r}")
+        if nid in nodes or nid in known:
+            raise PlanError(f"duplicate node id: {nid}")
+        if not isinstance(tool, str):
+            raise PlanError(f"node {nid}: tool must be string, got: {tool!r}")
+        try:
+            registry.get(tool)
+        except KeyError as e:
+            raise PlanError(f"node {nid}: {e}") from e
+        if allowed is not None and tool not in allowed:
+            raise PlanError(f"node {nid}: tool not available in this run: {tool}")
+        if not isinstance(args, dict):
+            raise PlanError(f"node {nid}: args must be object, got: {args!r}")
+
+        raw_deps = raw.get("deps") or []
+        if not isinstance(raw_deps, list) or not all(isinstance(d, str) for d in raw_deps):
+            raise PlanError(f"node {nid}: deps must be a list of node ids, got: {raw_deps!r}")
+        deps = set(raw_deps)
+        _collect_refs(args, deps)
+        nodes[nid] = PlanNode(id=nid, tool=tool, args=args, deps=sorted(deps - known))
+
+    for n in nodes.values():
+        for d in n.deps:
+            if d not in nodes:
+                raise PlanError(f"node {n.id} depends on unknown node: {d}")
+
+    # Kahn 拓扑排序检测环
+    indeg = {nid: len(n.deps) for nid, n in nodes.items()}
+    ready = [nid for nid, k in indeg.items() if k == 0]
+    seen = 0
+    while ready:
+        cur = ready.pop()
+        seen += 1
+        for n in nodes.values():
+            if cur in n.deps:
+                indeg[n.id] -= 1
+                if indeg[n.id] == 0:
+                    ready.append(n.id)
+    if seen != len(nodes):
+        raise PlanError("plan contains a dependency cycle")
+
+    return list(nodes.values())
+
+
+def _lookup(results: Dict[str, Any], nid: str, path: str) -> Any:
+    if nid not in results:
+        raise PlanError(f"reference to unfinished node: {nid}")
+    cur = results[nid]
+    for key in [p for p in path.split(".") if p]:
+        if isinstance(cur, dict) and key in cur:
+            cur = cur[key]
+        elif isinstance(cur, list) and key.isdigit() and int(key) < len(cur):
+            cur = cur[int(key)]
+        else:
+            raise PlanError(f"cannot resolve ${{{nid}{path}}}")
+    return cur
+
+
+def resolve_args(value: Any, results: Dict[str, Any]) -> Any:
+    """把 args 里的 ${id.path} 替换成前序节点的真实结果。"""
+    if isinstance(value, str):
+        m = REF_RE.fullmatch(value)
+        if m:
+            return _lookup(results, m.group(1), m.group(2))
+
+        def _sub(mm: re.Match) -> str:
+            v = _lookup(results, mm.group(1), mm.group(2))
+            return v if isinstance(v, str) else json.dumps(v, ensure_ascii=False)
+
+        return REF_RE.sub(_sub, value)
+    if isinstance(value, dict):
+        return {k: resolve_args(v, results) for k, v in value.items()}
+    if isinstance(value, list):
+        return [resolve_args(v, results) for v in value]
+    return value
+
+
+async def execute_plan(
+    *,
+    session_id: str,
+    nodes: List[PlanNode],
+    runner: ToolRunner,
+    bus: Any,
+    token: Any,
+    results: Dict[str, Any],
+    max_parallel: int = 8,
+    stats: Optional[Dict[str, Any]] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    按依赖并发执行 DAG：某节点的依赖全部完成就立刻调度，不按“层”等待。
+    成功结果写入 results[node_id]（工具返回值）。
+    返回 None 表示全部成功；否则返回第一个失败的信息（已在跑的节点会跑完，结果保留给重规划）。
+    stats：可选，累加 tool_calls / tool_errors / tool_ms（节点并发执行，tool_ms 是各节点耗时之和）。
+    """
+    tracer = trace.get_tracer(__name__)
+    pending: Dict[str, PlanNode] = {n.id: n for n in nodes}
+    running: Dict[asyncio.Task, PlanNode] = {}
+    failure: Optional[Dict[str, Any]] = None
+    sem = asyncio.Semaphore(max_parallel)
+
+    async def _run_node(node: PlanNode) -> Any:
+        async with sem:
+            args = resolve_args(node.args, results)
+            await bus.publish(session_id, {"type": "plan_node_start", "node": node.id, "tool": node.tool, "args": args})
+            t0 = time.time()
+            if stats is not None:
+                stats["tool_calls"] += 1
+            with tracer.start_as_current_span(
+                "plan.node",
+                attributes={"session_id": session_id, "plan.node": node.id, "plan.tool": node.tool},
+            ):
+                try:
+                    out = await runner.run(session_id=session_id, tool_name=node.tool, args=args, token=token, bus=bus)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    if stats is not None:
+                        stats["tool_errors"] += 1
+                        stats["tool_ms"] += (time.time() - t0) * 1000
+                    await bus.publish(session_id, {
+                        "type": "plan_node_end", "node": node.id, "tool": node.tool, "ok": False,
+                        "duration_ms": int((time.time() - t0) * 1000), "error": str(e),
+                    })
+                    raise
+            if stats is not None:
+                stats["tool_ms"] += (time.time() - t0) * 1000
+            await bus.publish(session_id, {
+                "type": "plan_node_end", "node": node.id, "tool": node.tool, "ok": True,
+                "duration_ms": int((time.time() - t0) * 1000), "output": out,
+            })
+            return out.get("result")
+
+    try:
+        while pending or running:
+            await token.checkpoint()
+            if failure is None:
+                for nid in [nid for nid, n in pending.items() if all(d in results for d in n.deps)]:
+                    node = pending.pop(nid)
+                    running[asyncio.create_task(_run_node(node), name=f"session:{session_id}:plan:{nid}")] = node
+            if not running:
+                break  # 失败后不再调度，剩余节点交给重规划
+            done, _ = await asyncio.wait(set(running), return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                node = running.pop(t)
+                err = t.exception()
+                if err is None:
+                    results[node.id] = t.result()
+                elif failure is None:
+                    failure = {"node": node.id, "tool": node.tool, "error": str(err)}
+    except BaseException:
+        for t in running:
+            t.cancel()
+        raise
+
+    if failure is None and pending:
+        failure = {"node": None, "error": f"unscheduled nodes: {sorted(pending)}"}
+    return failure
+
+
+async def run_plan_execute(
+    *,
+    session_id: str,
+    llm: Any,
+    registry: ToolRegistry,
+    runner: ToolRunner,
+    bus: Any,
+    token: Any,
+    user_prompt: str,
+    user_system: Optional[str] = None,
+    max_replans: int = 2,
+    max_parallel: int = 8,
+    history: Optional[List[Message]] = None,
+    tool_names: Optional[Sequence[str]] = None,  # 可选：这次 run 只开放这些工具
+    stats: Optional[Dict[str, Any]] = None,  # 可选：同 run_react，steps 记规划轮数
+) -> str:
+    """
+    Plan-and-Execute：
+    - LLM 一次性产出工具调用 DAG
+    - 执行器按依赖并发跑 ToolRunner，引用前序输出
+    - 只有失败时才带着已完成结果重规划
+    - 最后流式生成最终回答
+    正常情况下模型调用次数 = 1（plan）+ 1（final），而不是 ReAct 的 N+1；
+    不需要工具时模型直接给 final，就只有 1 次。
+    """
+    stats = _init_stats(stats)
+    allowed = registry.normalize_names(tool_names)
+    system_prompt = build_plan_system_prompt(registry, allowed)
+    if user_system:
+        system_prompt = system_prompt + "\n用户额外要求：\n" + user_system.strip()
+
+    messages: List[Message] = [
+        {"role": "system", "content": system_prompt},
+        *(history or []),
+        {"role": "user", "content": user_prompt},
+    ]
+    results: Dict[str, Any] = {}
+    direct_final: Optional[str] = None
+    tracer = trace.get_tracer(__name__)
+
+    await bus.publish(session_id, {"type": "plan_start", "max_replans": max_replans})
+
+    for attempt in range(max_replans + 1):
+        await token.checkpoint()
+        stats["steps"] = attempt + 1
+        with tracer.start_as_current_span(
+            "plan.generate",
+            attributes={"session_id": session_id, "plan.attempt": attempt},
+        ) as span:
+            t0 = time.perf_counter()
+            with capture_usage() as usage:
+                raw = await llm.generate(messages)
+            stats["llm_calls"] += 1
+            stats["llm_ms"] += (time.perf_counter() - t0) * 1000
+            _account_usage(span, stats, usage.total, "action")
+        await bus.publish(session_id, {"type": "plan_model_raw", "attempt": attempt, "text": raw})
+        messages.append({"role": "assistant", "content": raw})
+
+        try:
+            action = _extract_json(raw)
+            if action.get("type") == "final":
+                if not results and isinstance(action.get("final"), str):
+                    direct_final = action["final"]  # 一个工具都没跑：模型的回答就是最终回答，不再调一次 LLM
+                break
+            if action.get("type") != "plan":
+                raise PlanError(f"Unknown action type: {action.get('type')!r}")
+            nodes = parse_plan(action, registry, known=set(results), allowed=allowed)
+        except ValueError as e:
+            await bus.publish(session_id, {"type": "plan_parse_error", "attempt": attempt, "error": str(e)})
+            if attempt >= max_replans:
+                raise
+            messages.append({"role": "user", "content": f"Plan invalid: {e}. 请重新输出合法的 plan JSON。"})
+            continue
+
+        await bus.publish(session_id, {
+            "type": "plan_created",
+            "attempt": attempt,
+            "nodes": [{"id": n.id, "tool": n.tool, "args": n.args, "deps": n.deps} for n in nodes],
+        })
+
+        failure = await execute_plan(
+            session_id=session_id,
+            nodes=nodes,
+            runner=runner,
+            bus=bus,
+            token=token,
+            results=results,
+            max_parallel=max_parallel,
+            stats=stats,
+        )
+        if failure is None:
+            break
+
+        await bus.publish(session_id, {"type": "plan_replan", "attempt": attempt, "failure": failure})
+        if attempt >= max_replans:
+            raise ToolError(failure.get("tool") or "plan", f"plan failed after {attempt + 1} attempts: {failure['error']}")
+        messages.append({
+            "role": "user",
+            "content": (
+                f"Execution failed: {json.dumps(failure, ensure_ascii=False)}\n"
+                f"已完成节点结果（可直接用 ${{id}} 引用，不要重复执行）：{json.dumps(results, ensure_ascii=False)}\n"
+                "请只为剩余工作输出新的 plan JSON（节点 id 不要与已完成节点重复），或输出 final。"
+            ),
+        })
+
+    await bus.publish(session_id, {"type": "plan_done", "nodes_done": len(results)})
+
+    if direct_final is not None:
+        # 事件序列和流式生成一致（final_start / final_delta / final_done），前端不用区分
+        final_text = direct_final.strip()
+        await bus.publish(session_id, {"type": "final_start"})
+        await bus.publish(session_id, {"type": "final_delta", "text": final_text})
+        await bus.publish(session_id, {"type": "final_done"})
+        return final_text
+
+    t0 = time.perf_counter()
+    with capture_usage() as usage:
+        final_text = await stream_final_answer(
+            session_id=session_id,
+            llm=llm,
+            bus=bus,
+            token=token,
+            user_prompt=user_prompt,
+            user_system=user_system,
+            observations=[{"ok": True, "plan_results": results}] if results else [],
+            history=history,
+        )
+    stats["llm_calls"] += 1
+    stats["llm_ms"] += (time.perf_counter() - t0) * 1000
+    _account_usage(trace.INVALID_SPAN, stats, usage.total, "final")
+    return final_text
@@ -1,8 +1,10 @@
 from __future__ import annotations
 import json
 import re
-from typing import Any, Dict, List, Optional
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
+from agentlab.models.base import Usage, capture_usage
 from agentlab.types import Message
 from agentlab.tools.registry import ToolRunner, ToolRegistry, ToolError
 from opentelemetry import trace
@@ -24,28 +26,80 @@ def _extract_json(text: str) -> Dict[str, Any]:
     return json.loads(m.group(0))
 
 
-def _tools_summary(registry: ToolRegistry) -> str:
-    """把工具列表总结成给模型看的说明（name/desc/schema 简化）。"""
-    lines = []
-    for t in registry.list():
-        # schema 只展示 properties + required，避免太长
-        props = t.input_schema.get("properties", {})
-        req = t.input_schema.get("required", [])
-        lines.append(
-            f"- {t.name}: {t.description}\n"
-            f"  args.properties={list(props.keys())}, required={req}, timeout={t.timeout_s}s, max_retries={t.retry.max_retries}"
-        )
+def _tools_summary(registry: ToolRegistry, tool_names: Optional[Tuple[str, ...]] = None) -> str:
+    """把工具列表总结成给模型看的说明（name/desc/schema 简化）；按注册表 version 缓存。"""
+    def _build() -> str:
+        lines = []
+        for t in registry.select(tool_names):
+            # schema 只展示 properties + required，避免太长
+            props = t.input_schema.get("properties", {})
+            req = t.input_schema.get("required", [])
+            lines.append(
+                f"- {t.name}: {t.description}\n"
+                f"  args.properties={list(props.keys())}, required={req}, timeout={t.timeout_s}s, max_retries={t.retry.max_retries}"
+            )
+        return "\n".join(lines)
+
+    return registry.cached(("tools_summary", tool_names), _build)
+
+
+def _format_recall(hits: List[Dict[str, Any]], token_budget: int) -> str:
+    """把检索到的长期记忆按相关度拼进 prompt，超过 token 预算（约 4 字符/token）就截断。"""
+    lines: list[str] = []
+    used = 0
+    for h in hits:
+        text = str(h.get("text", "")).strip()
+        if not text:
+            continue
+        cost = len(text) // 4 + 1
+        if used + cost > token_budget:
+            break
+        lines.append(f"- {text}")
+        used += cost
     return "\n".join(lines)
 
 
-def build_react_system_prompt(registry: ToolRegistry) -> str:
+def _init_stats(stats: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """run 级紧凑统计的初值（react / plan / fanout 同一套字段，同步返回结果时用）。"""
+    if stats is None:
+        stats = {}
+    stats.update(
+        steps=0, llm_calls=0, llm_ms=0.0, tool_calls=0, tool_errors=0, tool_ms=0.0,
+        prompt_tokens=0, completion_tokens=0, cached_tokens=0,
+    )
+    return stats
+
+
+def _account_usage(span: Any, stats: Dict[str, Any], usage: Usage, phase: str) -> Dict[str, Any]:
+    """一次 LLM 调用（或一步里的几次）的用量：写进 span 属性、累加到 stats，返回给事件用的 dict。"""
+    if span.is_recording():
+        span.set_attribute("llm.prompt_tokens", usage.prompt_tokens)
+        span.set_attribute("llm.completion_tokens", usage.completion_tokens)
+        span.set_attribute("llm.cached_tokens", usage.cached_tokens)
+        if usage.ttft_ms is not None:
+            span.set_attribute("llm.ttft_ms", round(usage.ttft_ms, 1))
+        if usage.estimated:
+            span.set_attribute("llm.usage_estimated", True)
+    stats["prompt_tokens"] += usage.prompt_tokens
+    stats["completion_tokens"] += usage.completion_tokens
+    stats["cached_tokens"] += usage.cached_tokens
+    if phase == "final" and usage.ttft_ms is not None:
+        stats["ttft_ms"] = usage.ttft_ms
+    return {"type": "llm_usage", "phase": phase, **usage.to_dict()}
+
+
+def build_react_system_prompt(registry: ToolRegistry, tool_names: Optional[Tuple[str, ...]] = None) -> str:
     """
     ReAct 的“动作协议”：
     - 工具调用：{"type":"tool","tool_name":"calc","args":{...}}
     - 最终回答：{"type":"final","final":"..."}
     约束：只输出 JSON，不要多余文本（提升解析稳定性）
+    tool_names：只列出这些工具（registry.normalize_names 的结果）；整段 prompt 按注册表 version 缓存
     """
-    tools = _tools_summary(registry)
+    return registry.cached(("react_prompt", tool_names), lambda: _react_prompt(_tools_summary(registry, tool_names)))
+
+
+def _react_prompt(tools: str) -> str:
     return (
         "你是一个会使用工具的智能体。你必须严格按 JSON 输出，不要输出任何额外文本。\n"
         "当你需要外部计算/信息时，先输出工具调用 JSON：\n"
@@ -72,6 +126,15 @@ async def run_react(
     user_prompt: str,
     user_system: Optional[str] = None,
     max_steps: int = 6,
+    budget: Any = None,       # 可选共享预算（fan-out 子 agent 用，需支持 consume_step()）
+    history: Optional[List[Message]] = None,  # 之前轮次的对话（来自 SessionMemoryStore），接在 system 之后
+    recall: Any = None,       # 可选长期记忆（VectorMemoryIndex，需支持 await recall(query, k)）
+    recall_k: int = 5,
+    recall_token_budget: int = 400,
+    stats: Optional[Dict[str, Any]] = None,  # 可选：运行中填入步数 / 工具调用 / 耗时等紧凑统计（同步返回结果时用）
+    tool_names: Optional[Sequence[str]] = None,  # 可选：这次 run 只开放这些工具（大注册表别把所有工具塞进 prompt）
+    checkpoint: Any = None,   # 可选 RunCheckpoint：每步结束后异步落盘（进程重启后可续跑）
+    resume: Optional[Dict[str, Any]] = None,  # 可选：RunCheckpointStore.load() 的结果，从最后完成的步骤接着跑
 ) -> str:
     """
     最小 ReAct loop：
@@ -79,33 +142,80 @@ async def run_react(
     - tool -> 执行 -> observation 回灌
     - final -> 返回答案
     """
-    system_prompt = build_react_system_prompt(registry)
-    if user_system:
-        # 用户 system 作为附加要求（如“用中文回答”）
-        system_prompt = system_prompt + "\n用户额外要求：\n" + user_system.strip()
-
-    messages: List[Message] = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_prompt},
-    ]
-
-    await bus.publish(session_id, {"type": "react_start", "max_steps": max_steps})
-
+    stats = _init_stats(stats)
+    allowed = registry.normalize_names(tool_names)
     observations: list[dict] = []
+    start_step = 1
+
+    if resume is not None:
+        # 续跑：上下文（含 system prompt / 召回的记忆 / 历史）和 observation 都来自 checkpoint，不重新召回
+        messages: List[Message] = list(resume["messages"])
+        observations = list(resume.get("observations") or [])
+        start_step = int(resume.get("step") or 0) + 1
+        n_hist = int(resume.get("history") or 0)
+        history = messages[1:1 + n_hist]
+        stats["resumed_from_step"] = start_step - 1
+        await bus.publish(session_id, {"type": "react_resumed", "from_step": start_step - 1, "max_steps": max_steps})
+    else:
+        system_prompt = build_react_system_prompt(registry, allowed)
+        if user_system:
+            # 用户 system 作为附加要求（如“用中文回答”）
+            system_prompt = system_prompt + "\n用户额外要求：\n" + user_system.strip()
+
+        if recall is not None and recall_k > 0:
+            hits = await recall.recall(user_prompt, recall_k)
+            recalled = _format_recall(hits, recall_token_budget)
+            if recalled:
+                system_prompt = system_prompt + "\n相关长期记忆（可能有用，仅供参考）：\n" + recalled
+            await bus.publish(session_id, {
+                "type": "memory_recall",
+                "hits": len(hits),
+                "used": recalled.count("\n") + 1 if recalled else 0,
+                "top_score": hits[0]["score"] if hits else None,
+            })
+
+        messages = [
+            {"role": "system", "content": system_prompt},
+            *(history or []),
+            {"role": "user", "content": user_prompt},
+        ]
+        if checkpoint is not None:
+            checkpoint.begin(messages, history=len(history or []))
+
+        await bus.publish(session_id, {"type": "react_start", "max_steps": max_steps, "history": len(history or [])})
+
+    async def _observe(step: int, n_before: int, obs: dict) -> None:
+        # observation 回灌给模型；这一步新增的消息（assistant + observation）整体追加到 checkpoint
+        observations.append(obs)
+        await bus.publish(session_id, {"type": "react_observation", "step": step, "observation": obs})
+        messages.append({"role": "user", "content": f"Observation: {json.dumps(obs, ensure_ascii=False)}"})
+        if checkpoint is not None:
+            checkpoint.step(step, messages[n_before:], obs)
 
     tracer = trace.get_tracer(__name__)
-    for step in range(1, max_steps + 1):
+    for step in range(start_step, max_steps + 1):
         await token.checkpoint()
+        if budget is not None:
+            budget.consume_step()
+        stats["steps"] = step
         await bus.publish(session_id, {"type": "react_step_start", "step": step})
 
         with tracer.start_as_current_span(
             "react.step",
             attributes={"session_id": session_id, "step": step},
-        ):
-            raw = await llm.generate(messages)
+        ) as span:
+            t0 = time.perf_counter()
+            with capture_usage() as usage:
+                raw = await llm.generate(messages)
+            stats["llm_calls"] += 1
+            stats["llm_ms"] += (time.perf_counter() - t0) * 1000
+            # 每步的 prompt 是越滚越长的完整上下文：看 prompt_tokens 随 step 的增长就能发现 prompt 膨胀
+            ev = _account_usage(span, stats, usage.total, "action")
+            await bus.publish(session_id, {**ev, "step": step, "messages": len(messages)})
             await bus.publish(session_id, {"type": "react_model_raw", "step": step, "text": raw})
 
             # 把模型输出也加入上下文（assistant）
+            n_before = len(messages)
             messages.append({"role": "assistant", "content": raw})
 
             try:
@@ -127,8 +237,15 @@ async def run_react(
 
                 await bus.publish(session_id, {"type": "react_tool_selected", "step": step, "tool": tool_name, "args": args})
 
+                if allowed is not None and tool_name not in allowed:
+                    # 选了这次 run 没开放的工具：当作工具失败回灌，让模型换一个
+                    await _observe(step, n_before, {"ok": False, "error": f"tool not available in this run: {tool_name}"})
+                    continue
+
                 # 执行工具（ToolRunner 内部会发 tool_start/tool_end/tool_error）
                 await token.checkpoint()
+                stats["tool_calls"] += 1
+                t0 = time.perf_counter()
                 try:
                     out = await runner.run(
                         session_id=session_id,
@@ -138,32 +255,36 @@ async def run_react(
                         bus=bus,
                     )
                 except ToolError as e:
+                    stats["tool_errors"] += 1
+                    stats["tool_ms"] += (time.perf_counter() - t0) * 1000
                     # 工具失败也作为 observation 回灌，让模型决定怎么办（或直接报错）
-                    obs = {"ok": False, "error": str(e)}
-                    observations.append(obs)
-                    await bus.publish(session_id, {"type": "react_observation", "step": step, "observation": obs})
-                    messages.append({"role": "user", "content": f"Observation: {json.dumps(obs, ensure_ascii=False)}"})
+                    await _observe(step, n_before, {"ok": False, "error": str(e)})
                     continue
 
-                obs = {"ok": True, "tool": tool_name, "output": out}
-                observations.append(obs)
-                await bus.publish(session_id, {"type": "react_observation", "step": step, "observation": obs})
-                messages.append({"role": "user", "content": f"Observation: {json.dumps(obs, ensure_ascii=False)}"})
+                stats["tool_ms"] += (time.perf_counter() - t0) * 1000
+                await _observe(step, n_before, {"ok": True, "tool": tool_name, "output": out})
                 continue
 
             if atype == "final":
                 # final_text = action.get("final", "")
                 # if not isinstance(final_text, str):
                 #     raise ValueError("final must be string")
-                final_text = await stream_final_answer(
-                    session_id=session_id,
-                    llm=llm,
-                    bus=bus,
-                    token=token,
-                    user_prompt=user_prompt,
-                    user_system=user_system,
-                    observations=observations,
-                )
+                t0 = time.perf_counter()
+                with capture_usage() as usage:
+                    final_text = await stream_final_answer(
+                        session_id=session_id,
+                        llm=llm,
+                        bus=bus,
+                        token=token,
+                        user_prompt=user_prompt,
+                        user_system=user_system,
+                        observations=observations,
+                        history=history,
+                    )
+                stats["llm_calls"] += 1
+                stats["llm_ms"] += (time.perf_counter() - t0) * 1000
+                ev = _account_usage(span, stats, usage.total, "final")
+                await bus.publish(session_id, {**ev, "step": step})
                 await bus.publish(session_id, {"type": "react_done", "step": step})
                 return final_text
 
@@ -181,10 +302,12 @@ async def stream_final_answer(
     user_prompt: str,
     user_system: Optional[str],
     observations: List[Dict[str, Any]],
+    history: Optional[List[Message]] = None,
 ) -> str:
     """
     用流式方式生成最终回答（产品体验）。
     observations：ReAct 中累积的工具结果/关键事实
+    history：之前轮次的对话，保证追问（“那再乘 2 呢？”）能接上文
     """
     # 只取最后一次成功 observation（够用且简洁）
     last_obs = observations[-1] if observations else {}
@@ -204,6 +327,7 @@ async def stream_final_answer(
 
     messages = [
         {"role": "system", "content": sys},
+        *(history or []),
         {"role": "user", "content": user},
     ]
 
@@ -0,0 +1,396 @@
+"""
+batch.py
+批量任务（夜间评测 / 回填）：一次提交 N 条 prompt，按固定并发跑完，结果按完成顺序追加成 NDJSON。
+
+- 落盘布局：{root}/{job_id}/input.jsonl（提交的条目，带 index）、results.jsonl（每完成一条追加一行）、meta.json
+- 输入按行流式读，工作协程从有界队列取条目：10 万条也不会一次性进内存
+- 结果写入走带缓冲的文件句柄，同一轮 event loop 内完成的结果合并成一次 flush
+- 可续跑：results.jsonl 里已成功的 index 跳过，取消 / 进程重启后 resume 只跑剩下的（失败的默认重跑，
+  重跑结果追加新行，同一 index 以最后一行为准）
+- job_id 可由客户端指定，但只允许 [A-Za-z0-9_-]{1,64}（它直接拼进落盘路径）
+- 每条不走 SSE：用 NullBus，不建 session 队列、不发事件
+- 并发上限 concurrency + 每秒 LLM 调用上限 rate_per_s（令牌桶），出站仍经共享限流器（按 job 一个 key 公平排队）
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, IO, Iterable, List, Optional, Set
+
+from agentlab.models.base import LLMClient
+from agentlab.runtime.cancel import CancellationToken
+from agentlab.types import Message
+
+JsonDict = Dict[str, Any]
+_JOB_ID_RE = re.compile(r"^[\w-]{1,64}$", re.ASCII)
+# run_item(job, item, token) -> 最终回答
+RunItem = Callable[["BatchJob", JsonDict, CancellationToken], Awaitable[str]]
+
+
+class RateLimiter:
+    """匀速放行：每 1/rate 秒一个，按到达顺序排（不攒突发）。rate<=0 表示不限。"""
+
+    def __init__(self, rate_per_s: float) -> None:
+        self.rate = float(rate_per_s)
+        self._next = 0.0
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        at = max(now, self._next)
+        self._next = at + 1.0 / self.rate
+        if at > now:
+            await asyncio.sleep(at - now)
+
+
+class RateCappedLLMClient(LLMClient):
+    """每次 generate / stream 前先过 RateLimiter（同一个 job 的所有条目共享一个）。"""
+
+    def __init__(self, inner: LLMClient, limiter: RateLimiter) -> None:
+        self.inner = inner
+        self.limiter = limiter
+        self.model = getattr(inner, "model", None)
+
+    async def generate(self, messages: List[Message]) -> str:
+        await self.limiter.acquire()
+        return await self.inner.generate(messages)
+
+    async def stream(self, messages: List[Message]) -> AsyncIterator[str]:
+        await self.limiter.acquire()
+        async for chunk in self.inner.stream(messages):
+            yield chunk
+
+
+def normalize_item(raw: Any) -> JsonDict:
+    """一条输入：字符串当 prompt，或 {"prompt", "id"?, "system"?}。"""
+    if isinstance(raw, str):
+        return {"prompt": raw}
+    if not isinstance(raw, dict) or not isinstance(raw.get("prompt"), str):
+        raise ValueError(f"batch item must be a string or an object with a string 'prompt': {str(raw)[:200]!r}")
+    item = {"prompt": raw["prompt"]}
+    if raw.get("id") is not None:
+        item["id"] = raw["id"]
+    if raw.get("system"):
+        item["system"] = str(raw["system"])
+    return item
+
+
+def valid_job_id(job_id: str) -> bool:
+    return bool(_JOB_ID_RE.match(job_id))
+
+
+class BatchJob:
+    def __init__(self, root: str, job_id: str, meta: JsonDict) -> None:
+        self.id = job_id
+        self.dir = os.path.join(root, job_id)
+        self.meta = meta
+        self.status: str = meta.get("status", "created")  # created/running/done/cancelled/error
+        self.error: Optional[str] = meta.get("error")
+        self.done = 0
+        self.failed = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = meta.get("finished_at")
+        self.rate = RateLimiter(float(meta.get("rate_per_s") or 0))
+        self.token = CancellationToken()
+        self.task: Optional[asyncio.Task] = None
+        self._out: Optional[IO[str]] = None
+        self._flush_scheduled = False
+        self._changed = asyncio.Event()
+
+    # ---------- 路径 / 元数据 ----------
+
+    @property
+    def input_path(self) -> str:
+        return os.path.join(self.dir, "input.jsonl")
+
+    @property
+    def results_path(self) -> str:
+        return os.path.join(self.dir, "results.jsonl")
+
+    @property
+    def total(self) -> int:
+        return int(self.meta.get("total", 0))
+
+    @property
+    def running(self) -> bool:
+        return self.status == "running"
+
+    def save_meta(self) -> None:
+        self.meta.update(status=self.status, error=self.error, finished_at=self.finished_at)
+        tmp = os.path.join(self.dir, "meta.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f, ensure_ascii=False)
+        os.replace(tmp, os.path.join(self.dir, "meta.json"))
+
+    def completed_indices(self, ok_only: bool = False) -> Set[int]:
+        """results.jsonl 里已完成的 index（ok_only=True 只算成功的，续跑时跳过）；末尾写了一半的行忽略。"""
+        done: Set[int] = set()
+        if not os.path.exists(self.results_path):
+            return done
+        with open(self.results_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                try:
+                    rec = json.loads(line)
+                    if not ok_only or rec.get("ok"):
+                        done.add(int(rec["index"]))
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    continue
+        return done
+
+    def status_dict(self) -> JsonDict:
+        elapsed = None
+        if self.started_at is not None:
+            elapsed = round((self.finished_at or time.time()) - self.started_at, 3)
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "total": self.total,
+            "completed": self.done,
+            "failed": self.failed,
+            "concurrency": self.meta.get("concurrency"),
+            "rate_per_s": self.meta.get("rate_per_s"),
+            "elapsed_s": elapsed,
+            "items_per_s": round(self.done / elapsed, 2) if elapsed else None,
+        }
+
+    # ---------- 结果写入 ----------
+
+    def _write_result(self, rec: JsonDict) -> None:
+        if self._out is None:
+            self._out = open(self.results_path, "a", encoding="utf-8", buffering=1 << 16)
+        self._out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        if not self._flush_scheduled:
+            # 同一轮 loop 里完成的结果攒在一起 flush 一次
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def _flush(self) -> None:
+        self._flush_scheduled = False
+        if self._out is not None:
+            self._out.flush()
+        self._notify()
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _close_output(self) -> None:
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+        self._flush_scheduled = False
+        self._notify()
+
+    # ---------- 结果读取（NDJSON 跟随） ----------
+
+    async def follow(self, offset: int = 0) -> AsyncIterator[str]:
+        """
+        从第 offset 条结果开始按完成顺序吐 NDJSON 行；任务还在跑就等新结果，结束后吐完剩下的为止。
+        断线重连时带上已收到的条数即可接着收。
+        """
+        skipped = 0
+        pos = 0
+        while True:
+            changed = self._changed
+            lines: List[str] = []
+            if os.path.exists(self.results_path):
+                with open(self.results_path, "rb") as f:
+                    f.seek(pos)
+                    for raw in f:
+                        if not raw.endswith(b"\n"):
+                            break  # 没写完的行下次再读
+                        pos += len(raw)
+                        if skipped < offset:
+                            skipped += 1
+                            continue
+                        lines.append(raw.decode("utf-8"))
+            for line in lines:
+                yield line
+            if not self.running and not lines:
+                return
+            if self.running:
+                await changed.wait()
+
+
+class BatchManager:
+    """管理 batch job：创建（落盘输入）、后台执行、取消、续跑。"""
+
+    def __init__(self, root: str, run_item: RunItem, *, max_concurrency: int = 256) -> None:
+        self.root = root
+        self.run_item = run_item
+        self.max_concurrency = max_concurrency
+        self._jobs: Dict[str, BatchJob] = {}
+        os.makedirs(root, exist_ok=True)
+
+    # ---------- 创建 ----------
+
+    async def create(
+        self,
+        items: Iterable[Any] | AsyncIterator[Any],
+        *,
+        concurrency: int = 16,
+        rate_per_s: float = 0.0,
+        system: Optional[str] = None,
+        max_steps: int = 6,
+        job_id: Optional[str] = None,
+    ) -> BatchJob:
+        """把输入写进 input.jsonl（边收边写，支持流式上传），然后开始执行。"""
+        job_id = job_id or uuid.uuid4().hex[:16]
+        if not valid_job_id(job_id):
+            raise ValueError(f"invalid job_id (allowed: letters, digits, _ and -, at most 64): {job_id!r}")
+        if job_id in self._jobs or os.path.exists(os.path.join(self.root, job_id)):
+            raise ValueError(f"batch job already exists: {job_id}")
+        meta: JsonDict = {
+            "job_id": job_id,
+            "created_at": time.time(),
+            "concurrency": max(1, min(int(concurrency), self.max_concurrency)),
+            "rate_per_s": max(0.0, float(rate_per_s)),
+            "system": system,
+            "max_steps": max_steps,
+            "total": 0,
+        }
+        job = BatchJob(self.root, job_id, meta)
+        os.makedirs(job.dir)
+        n = 0
+        try:
+            with open(job.input_path, "w", encoding="utf-8", buffering=1 << 16) as f:
+                if hasattr(items, "__aiter__"):
+                    async for raw in items:  # type: ignore[union-attr]
+                        f.write(json.dumps({"index": n, **normalize_item(raw)}, ensure_ascii=False) + "\n")
+                        n += 1
+                else:
+                    for raw in items:  # type: ignore[union-attr]
+                        f.write(json.dumps({"index": n, **normalize_item(raw)}, ensure_ascii=False) + "\n")
+                        n += 1
+        except BaseException:
+            # 输入有坏行 / 上传中断：不留半个 job
+            shutil.rmtree(job.dir, ignore_errors=True)
+            raise
+        meta["total"] = n
+        job.save_meta()
+        self._jobs[job_id] = job
+        self._start(job, skip=set())
+        return job
+
+    # ---------- 查询 / 控制 ----------
+
+    def get(self, job_id: str) -> Optional[BatchJob]:
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        if not valid_job_id(job_id):
+            return None
+        # 进程重启后：从磁盘恢复（只读状态，resume 之后才会再跑）
+        meta_path = os.path.join(self.root, job_id, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        job = BatchJob(self.root, job_id, meta)
+        if job.status == "running":
+            job.status = "interrupted"  # 上个进程没跑完就退出了
+        job.done = len(job.completed_indices())
+        self._jobs[job_id] = job
+        return job
+
+    def cancel(self, job_id: str) -> str:
+        job = self.get(job_id)
+        if job is None:
+            return "not_found"
+        if not job.running or job.task is None:
+            return "not_running"
+        job.token.cancel()
+        job.task.cancel()
+        return "cancelling"
+
+    def resume(self, job_id: str, *, retry_failed: bool = True) -> str:
+        """续跑：跳过已成功的条目；retry_failed=False 时失败过的也跳过（只跑没跑到的）。"""
+        job = self.get(job_id)
+        if job is None:
+            return "not_found"
+        if job.running:
+            return "already_running"
+        skip = job.completed_indices(ok_only=retry_failed)
+        if len(skip) >= job.total:
+            return "already_done"
+        job.token = CancellationToken()
+        self._start(job, skip=skip)
+        return "resumed"
+
+    def list(self) -> List[JsonDict]:
+        return [j.status_dict() for j in self._jobs.values()]
+
+    # ---------- 执行 ----------
+
+    def _start(self, job: BatchJob, skip: Set[int]) -> None:
+        job.status = "running"
+        job.error = None
+        job.finished_at = None
+        job.done = len(skip)
+        job.failed = 0
+        job.started_at = time.time()
+        job.save_meta()
+        job.task = asyncio.create_task(self._run(job, skip), name=f"batch:{job.id}")
+
+    async def _run(self, job: BatchJob, skip: Set[int]) -> None:
+        concurrency = int(job.meta["concurrency"])
+        q: asyncio.Queue[Optional[JsonDict]] = asyncio.Queue(maxsize=concurrency * 4)
+
+        async def _feed() -> None:
+            with open(job.input_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    item = json.loads(line)
+                    if item["index"] in skip:
+                        continue
+                    await q.put(item)
+            for _ in range(concurrency):
+                await q.put(None)
+
+        async def _worker() -> None:
+            while True:
+                item = await q.get()
+                if item is None:
+                    return
+                await job.token.checkpoint()
+                t0 = time.perf_counter()
+                rec: JsonDict = {"index": item["index"], "id": item.get("id")}
+                try:
+                    rec["output"] = await self.run_item(job, item, job.token)
+                    rec["ok"] = True
+                except asyncio.CancelledError:
+                    raise  # 取消的条目不写结果，续跑时重做
+                except Exception as e:
+                    rec["ok"] = False
+                    rec["error"] = str(e)
+                    job.failed += 1
+                rec["elapsed_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+                job.done += 1
+                job._write_result(rec)
+
+        tasks = [asyncio.create_task(_feed(), name=f"batch:{job.id}:feed")]
+        tasks += [asyncio.create_task(_worker(), name=f"batch:{job.id}:w{i}") for i in range(concurrency)]
+        try:
+            await asyncio.gather(*tasks)
+            job.status = "done"
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            raise
+        except Exception as e:
+            job.status = "error"
+            job.error = str(e)
+        finally:
+            for t in tasks:
+                t.cancel()
+            job.finished_at = time.time()
+            job._close_output()
+            job.save_meta()
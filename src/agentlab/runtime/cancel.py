@@ -1,19 +1,37 @@
 
 import asyncio
+from typing import Optional
 
 class CancellationToken:
     """
     协作式取消：长任务中定期 checkpoint()，一旦取消就抛 CancelledError。
+    parent：父令牌被取消时，子令牌也视为已取消（子 agent 共享父任务的取消信号）。
     """
-    def __init__(self):
+    def __init__(self, parent: Optional["CancellationToken"] = None):
         self._ev = asyncio.Event()
+        self._parent = parent
 
     def cancel(self) -> None:
         self._ev.set()
 
+    def child(self) -> "CancellationToken":
+        return CancellationToken(parent=self)
+
     @property
     def cancelled(self) -> bool:
-        return self._ev.is_set()
+        return self._ev.is_set() or (self._parent is not None and self._parent.cancelled)
+
+    async def wait(self) -> None:
+        """阻塞直到被取消（自己或任一祖先），给需要“立刻响应取消”的看门狗用。"""
+        if self._parent is None:
+            await self._ev.wait()
+            return
+        waiters = [asyncio.ensure_future(self._ev.wait()), asyncio.ensure_future(self._parent.wait())]
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for w in waiters:
+                w.cancel()
 
     async def checkpoint(self) -> None:
         if self.cancelled:
@@ -0,0 +1,215 @@
+"""
+checkpoint.py
+ReAct run 的步骤级 checkpoint：进程崩溃 / 重新部署后，从最后一个完成的步骤接着跑，
+已经花掉的 LLM 调用和工具 observation 不用再付一遍。
+
+- 落盘布局：{root}/{sid}.ckpt.jsonl，每个 session 最多一个未完成的 run（TaskManager 也是一个 session 一个 run）
+  - {"t": "start", "session_id", "run_id", "ts", "request", "history", "messages"}：run 开始时的完整上下文
+  - {"t": "step", "step", "append": [...], "obs": {...}}：每步只追加这一步新增的消息和 observation
+  - {"t": "snapshot", ...}：压缩后的完整状态（代替之前所有行）
+- 写入走后台线程（按提交顺序），run_react 不等 IO；每步一次 append + flush，
+  每 compact_every 步把文件重写成一条 snapshot（写临时文件后原子替换）
+- run 正常结束 / 出错 / 被用户取消时删除文件；进程退出时被打断的 run 文件留着，启动时或 POST resume 时续跑
+- 读取时忽略最后一行写了一半的情况（崩溃时可能发生）
+"""
+
+from __future__ import annotations
+
+import atexit
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from agentlab.types import Message
+
+logger = logging.getLogger(__name__)
+
+JsonDict = Dict[str, Any]
+_SAFE_RE = re.compile(r"^[\w.-]{1,64}$")
+_SUFFIX = ".ckpt.jsonl"
+
+
+class RunCheckpointStore:
+    def __init__(self, root: str = "data/checkpoints", *, compact_every: int = 16, fsync: bool = False) -> None:
+        self.root = root
+        self.compact_every = max(1, compact_every)
+        self.fsync = fsync
+        self._q: "queue.SimpleQueue[Optional[tuple]]" = queue.SimpleQueue()
+        self._steps: Dict[str, int] = {}  # 写线程内：自上次压缩以来追加的 step 行数
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self.written = 0
+        self.compactions = 0
+        os.makedirs(root, exist_ok=True)
+
+    # ---------- 路径 ----------
+
+    def _path(self, session_id: str) -> str:
+        name = session_id if _SAFE_RE.match(session_id) else hashlib.sha1(session_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, name + _SUFFIX)
+
+    # ---------- 写（调用方不阻塞） ----------
+
+    def run(self, session_id: str, request: JsonDict, run_id: Optional[str] = None) -> "RunCheckpoint":
+        """给一次 run 发一个写入句柄（调用 begin 之前什么都不写）；续跑时传原来的 run_id。"""
+        return RunCheckpoint(self, session_id, request, run_id)
+
+    def _submit(self, op: str, session_id: str, rec: Optional[JsonDict] = None) -> None:
+        if self._thread is None:
+            self._start()
+        self._q.put((op, session_id, rec))
+
+    def _start(self) -> None:
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._writer, name="checkpoint-writer", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """等已提交的写入全部落盘（阻塞，测试 / 关停时用）。"""
+        if self._thread is None:
+            return True
+        done = threading.Event()
+        self._q.put(("barrier", "", {"event": done}))
+        return done.wait(timeout)
+
+    def close(self) -> None:
+        """写完队列里剩下的并停掉写线程。"""
+        with self._start_lock:
+            t, self._thread = self._thread, None
+        if t is not None:
+            self._q.put(None)
+            t.join(timeout=10)
+
+    def _writer(self) -> None:
+        while True:
+            item = self._q.get()
+            if item is None:
+                return
+            op, sid, rec = item
+            try:
+                if op == "barrier":
+                    rec["event"].set()
+                elif op == "begin":
+                    self._write(sid, rec, mode="w")
+                    self._steps[sid] = 0
+                elif op == "step":
+                    self._write(sid, rec, mode="a")
+                    self._steps[sid] = self._steps.get(sid, 0) + 1
+                    if self._steps[sid] >= self.compact_every:
+                        self._compact(sid)
+                elif op == "finish":
+                    self._steps.pop(sid, None)
+                    try:
+                        os.remove(self._path(sid))
+                    except FileNotFoundError:
+                        pass
+            except Exception:
+                logger.exception("checkpoint write failed op=%s session=%s", op, sid)
+
+    def _write(self, session_id: str, rec: JsonDict, *, mode: str) -> None:
+        line = json.dumps(rec, ensure_ascii=False, default=str).encode("utf-8") + b"\n"
+        with open(self._path(session_id), mode + "b") as f:
+            f.write(line)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        self.written += 1
+
+    def _compact(self, session_id: str) -> None:
+        path = self._path(session_id)
+        state = self._read(path)
+        if state is None:
+            return
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(json.dumps({"t": "snapshot", **state}, ensure_ascii=False, default=str).encode("utf-8") + b"\n")
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self._steps[session_id] = 0
+        self.compactions += 1
+
+    # ---------- 读 ----------
+
+    @staticmethod
+    def _read(path: str) -> Optional[JsonDict]:
+        """重放 start / snapshot + step 行，得到 run 的当前状态；文件不存在或没有 start 返回 None。"""
+        state: Optional[JsonDict] = None
+        try:
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue  # 崩溃时写了一半的行
+                    t = rec.pop("t", None)
+                    if t == "start":
+                        state = {**rec, "observations": [], "step": 0}
+                    elif t == "snapshot":
+                        state = rec
+                    elif t == "step" and state is not None:
+                        state["messages"].extend(rec.get("append") or [])
+                        if rec.get("obs") is not None:
+                            state["observations"].append(rec["obs"])
+                        state["step"] = rec["step"]
+        except FileNotFoundError:
+            return None
+        return state
+
+    def load(self, session_id: str) -> Optional[JsonDict]:
+        """{"session_id", "run_id", "ts", "request", "history", "messages", "observations", "step"}；没有未完成的 run 返回 None。"""
+        return self._read(self._path(session_id))
+
+    def pending(self) -> List[JsonDict]:
+        """所有未完成 run 的概要（session_id / run_id / step / ts），按开始时间排序。"""
+        out = []
+        for name in os.listdir(self.root):
+            if not name.endswith(_SUFFIX):
+                continue
+            state = self._read(os.path.join(self.root, name))
+            if state is not None:
+                out.append({k: state.get(k) for k in ("session_id", "run_id", "step", "ts")})
+        out.sort(key=lambda r: r.get("ts") or 0)
+        return out
+
+    def stats(self) -> Dict[str, int]:
+        return {"written": self.written, "compactions": self.compactions}
+
+
+class RunCheckpoint:
+    """一次 run 的写入句柄（run_react 用）：begin -> step* -> finish；续跑时跳过 begin 直接接着写 step。"""
+
+    def __init__(self, store: RunCheckpointStore, session_id: str, request: JsonDict, run_id: Optional[str] = None) -> None:
+        self.store = store
+        self.session_id = session_id
+        self.request = request
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+
+    def begin(self, messages: List[Message], history: int = 0) -> None:
+        """messages = [system, *history, user]；history 是其中历史轮次的条数（续跑时 final 阶段要用）。"""
+        self.store._submit("begin", self.session_id, {
+            "t": "start",
+            "session_id": self.session_id,
+            "run_id": self.run_id,
+            "ts": time.time(),
+            "request": self.request,
+            "history": history,
+            "messages": list(messages),
+        })
+
+    def step(self, step: int, append: List[Message], observation: Optional[JsonDict]) -> None:
+        self.store._submit("step", self.session_id, {"t": "step", "step": step, "append": list(append), "obs": observation})
+
+    def finish(self) -> None:
+        self.store._submit("finish", self.session_id)
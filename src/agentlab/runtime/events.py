@@ -1,21 +1,34 @@
 import asyncio
 import logging
-from typing import Any, AsyncIterator, Dict
+from typing import Any, AsyncIterator, Callable, Dict, Set
 
 from opentelemetry import trace
 from opentelemetry.trace import Status, StatusCode
 
+from agentlab.observability.metrics import EVENTS_PUBLISHED
+
 logger = logging.getLogger(__name__)
 
+# listener(session_id, event)：publish 时同步调用，必须很快、不能阻塞（一般只是放进自己的缓冲区）
+Listener = Callable[[str, Dict[str, Any]], None]
+
 
 class EventBus:
     def __init__(self) -> None:
         self._queues: dict[str, asyncio.Queue[dict]] = {}
+        # session -> 当前连着的订阅者数（SSE / WS）
+        self._subscribers: dict[str, int] = {}
+        # session -> 不消费队列的监听者（WS 网关：一条连接监听很多 session，不和 SSE 抢事件）
+        self._listeners: dict[str, Set[Listener]] = {}
 
     def get_queue(self, session_id: str) -> asyncio.Queue[dict]:
         self._queues.setdefault(session_id, asyncio.Queue())
         return self._queues[session_id]
 
+    def queue_depths(self) -> Dict[str, int]:
+        """各 session 队列当前积压（/metrics 用）。"""
+        return {sid: q.qsize() for sid, q in self._queues.items()}
+
     def _attach_trace(self, event: Dict[str, Any]) -> Dict[str, Any]:
         """给事件附加 trace_id/span_id（如果当前有活跃 span）。永远返回 dict。"""
         try:
@@ -40,17 +53,78 @@ class EventBus:
         return event
 
     async def publish(self, session_id: str, event: Dict[str, Any]) -> None:
-        """发布事件，会自动附加 trace_id/span_id。"""
-        q = self.get_queue(session_id)
+        """
+        发布事件，会自动附加 trace_id/span_id。
+        该 session 只有监听者（WS 网关）、没有队列订阅者（SSE）时不入队：没人会来消费，
+        入队只会让内存无界增长（网关自己的缓冲区是有界的）。
+        """
         ev = self._attach_trace(event)
+        EVENTS_PUBLISHED.inc(str(ev.get("type")))
+
+        listeners = self._listeners.get(session_id)
+        if not listeners or self._subscribers.get(session_id, 0) > 0:
+            q = self.get_queue(session_id)
+            await q.put(ev)
+            # 每个事件一条，delta 风暴时量很大：默认 DEBUG 不输出，打开时由 log_config 里的 RateLimitFilter 限速
+            logger.debug("published event session=%s type=%s queue_size=%d", session_id, ev.get("type"), q.qsize())
+        if listeners:
+            for fn in tuple(listeners):
+                try:
+                    fn(session_id, ev)
+                except Exception:
+                    logger.exception("event listener failed session=%s", session_id)
 
-        logger.info("Publishing event session=%s type=%s", session_id, ev.get("type"))
-        await q.put(ev)
-        logger.info("queue size after put session=%s size=%d", session_id, q.qsize())
+    def has_subscribers(self, session_id: str) -> bool:
+        return self._subscribers.get(session_id, 0) > 0 or bool(self._listeners.get(session_id))
+
+    def add_listener(self, session_id: str, fn: Listener) -> None:
+        """该 session 之后发布的每个事件都同步回调 fn 一次（事件照常入队，不影响 SSE 订阅者）。"""
+        self._listeners.setdefault(session_id, set()).add(fn)
+
+    def remove_listener(self, session_id: str, fn: Listener) -> None:
+        fns = self._listeners.get(session_id)
+        if fns is None:
+            return
+        fns.discard(fn)
+        if not fns:
+            del self._listeners[session_id]
+
+    def listener_count(self) -> int:
+        return sum(len(fns) for fns in self._listeners.values())
 
     async def subscribe(self, session_id: str) -> AsyncIterator[Dict[str, Any]]:
         q = self.get_queue(session_id)
-        while True:
-            ev = await q.get()
-            logger.info("consumed by subscriber session=%s type=%s", session_id, getattr(ev, "get", lambda *_: None)("type"))
-            yield ev
+        self._subscribers[session_id] = self._subscribers.get(session_id, 0) + 1
+        try:
+            while True:
+                ev = await q.get()
+                logger.debug("consumed by subscriber session=%s type=%s", session_id, getattr(ev, "get", lambda *_: None)("type"))
+                yield ev
+        finally:
+            n = self._subscribers.get(session_id, 0) - 1
+            if n > 0:
+                self._subscribers[session_id] = n
+            else:
+                self._subscribers.pop(session_id, None)
+
+
+class NullBus:
+    """不投递任何事件的 bus：批量任务等没人订阅的场景，省掉每个事件的入队 / trace 附加开销。"""
+
+    async def publish(self, session_id: str, event: Dict[str, Any]) -> None:
+        return None
+
+
+class QuietBus:
+    """
+    包一层 EventBus：该 session 当前没有订阅者时直接丢弃事件（不附加 trace、不入队）。
+    给同步等待结果的 react_chat 用——调用方只要最终答案，没人看的事件不必构造和排队；
+    中途有人订阅的话，从那一刻起照常收到事件。
+    """
+
+    def __init__(self, bus: EventBus) -> None:
+        self.bus = bus
+
+    async def publish(self, session_id: str, event: Dict[str, Any]) -> None:
+        if self.bus.has_subscribers(session_id):
+            await self.bus.publish(session_id, event)
@@ -1,6 +1,9 @@
 import asyncio
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Awaitable, Callable, Dict, Optional
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from agentlab.models.base import UsageRecorder, capture_usage
 
 from .cancel import CancellationToken
 
@@ -10,6 +13,9 @@ class TaskRecord:
     token: CancellationToken
     status: str  # running/done/cancelled/error
     error: Optional[str] = None
+    result: Any = None  # coro_factory 的返回值（同步 / 长轮询取结果用）
+    usage: Optional[UsageRecorder] = None  # 这次 run 的 LLM 用量（运行中也是实时的）
+    started: bool = False  # task 已建但 loop 还没调度到它时为 False（/metrics 里算 queued）
 
 class TaskManager:
     """
@@ -18,20 +24,43 @@ class TaskManager:
     - cancel(): 取消任务
     - get_status(): 查询状态
     - 自动清理：任务结束后可以选择 remove
+    - 用量：每次 run 的 LLM token 用量自动累计到 run 和 session 两级；token_budget > 0 时
+      session 累计用量到预算就拒绝新 run，运行中超预算则取消当前 run
+    - 有界：最多记 max_sessions 个 session 的用量 / 最后一次 run，超了按最近使用淘汰没在跑的
+      （被淘汰的 session 用量从 0 重新累计）；已经用完预算的 session 淘汰时只留一个用量数字在
+      _exhausted（上限 10 × max_sessions），淘汰不会让它的预算重置
+    - 预算按 session_id 计：session_id 由客户端决定，换个 id 就是新预算，所以它只是防单个会话失控的
+      护栏，不是按调用方的配额（那个要在鉴权网关按 API key 做）
     """
-    def __init__(self):
+    def __init__(self, token_budget: int = 0, max_sessions: int = 10_000):
         self._tasks: Dict[str, TaskRecord] = {}
+        # session -> 该 session 所有 run 的累计用量（按最近一次 start 排序，LRU 淘汰）
+        self._usage: "OrderedDict[str, UsageRecorder]" = OrderedDict()
+        # 用完预算后被淘汰的 session -> 累计 token 数（按淘汰顺序，超上限丢最老的）
+        self._exhausted: "OrderedDict[str, int]" = OrderedDict()
+        self.token_budget = token_budget
+        self.max_sessions = max(1, max_sessions)
+        self.max_exhausted = self.max_sessions * 10
 
-    def start(self, session_id: str, coro_factory: Callable[[CancellationToken], Awaitable[None]]) -> str:
+    def start(self, session_id: str, coro_factory: Callable[[CancellationToken], Awaitable[Any]]) -> str:
         # 如果已有运行中的任务，先拒绝或先取消再重启（这里选择拒绝，更安全）
         if session_id in self._tasks and self._tasks[session_id].status == "running":
             return "already_running"
+        if self._over_budget(session_id):
+            return "token_budget_exceeded"
         # 准备取消令牌
         token = CancellationToken()
+        # run 级用量挂在 session 级下面：job 里所有 LLM 调用（包括子 task 里的）都记到这两级
+        session_usage = self._usage.setdefault(session_id, UsageRecorder())
+        self._usage.move_to_end(session_id)
+        run_usage = UsageRecorder(parent=session_usage, on_record=lambda: self._enforce_budget(session_id, token))
         #  随时捕捉token.cancel()的信号
         async def runner():
+            self._tasks[session_id].started = True
             try:
-                await coro_factory(token)
+                with capture_usage(run_usage):
+                    result = await coro_factory(token)
+                self._tasks[session_id].result = result
                 self._tasks[session_id].status = "done"
             except asyncio.CancelledError:
                 self._tasks[session_id].status = "cancelled"
@@ -41,7 +70,8 @@ class TaskManager:
                 self._tasks[session_id].error = str(e)
 
         task = asyncio.create_task(runner(), name=f"session:{session_id}")
-        self._tasks[session_id] = TaskRecord(task=task, token=token, status="running")
+        self._tasks[session_id] = TaskRecord(task=task, token=token, status="running", usage=run_usage)
+        self._evict_idle()
 
         # 任务结束后自动清理引用（避免内存泄露）
         # Python 的 lambda 本质上是一个匿名函数（没有名字的函数），其标准语法是： lambda 参数列表: 表达式
@@ -73,9 +103,77 @@ class TaskManager:
         rec = self._tasks.get(session_id)
         if not rec:
             return {"exists": False}
-        return {"exists": True, "status": rec.status, "error": rec.error}
+        out = {"exists": True, "status": rec.status, "error": rec.error}
+        if rec.result is not None:
+            out["result"] = rec.result
+        if rec.usage is not None:
+            out["usage"] = rec.usage.total.to_dict()
+        out["session_usage"] = self.session_usage(session_id)
+        if self.token_budget:
+            out["token_budget"] = self.token_budget
+        return out
+
+    def session_usage(self, session_id: str) -> Dict[str, Any]:
+        """该 session 所有 run 累计的 LLM 用量（用完预算后被淘汰的只剩 total_tokens）。"""
+        rec = self._usage.get(session_id)
+        if rec is not None:
+            return rec.total.to_dict()
+        if session_id in self._exhausted:
+            return {"total_tokens": self._exhausted[session_id]}
+        return {}
+
+    def _over_budget(self, session_id: str) -> bool:
+        if not self.token_budget:
+            return False
+        if session_id in self._exhausted:
+            return True
+        rec = self._usage.get(session_id)
+        return rec is not None and rec.total.total_tokens >= self.token_budget
+
+    def _enforce_budget(self, session_id: str, token: CancellationToken) -> None:
+        # 每次记用量后调用：超了就协作式取消当前 run（下一个 checkpoint 生效），状态里写明原因
+        if token.cancelled or not self._over_budget(session_id):
+            return
+        rec = self._tasks.get(session_id)
+        if rec is not None and rec.token is token:
+            rec.error = f"token budget exceeded ({self._usage[session_id].total.total_tokens}/{self.token_budget})"
+        token.cancel()
+
+    async def wait(self, session_id: str, timeout: Optional[float] = None) -> Dict:
+        """等任务结束（最多 timeout 秒，不会因为超时取消任务），返回同 get_status。"""
+        rec = self._tasks.get(session_id)
+        if rec is not None and not rec.task.done():
+            await asyncio.wait({rec.task}, timeout=timeout)
+        return self.get_status(session_id)
+
+    def counts(self) -> Dict[str, int]:
+        """各状态的任务数（/metrics 用）：running 里还没被 loop 调度到的单独算 queued。"""
+        out: Dict[str, int] = {"queued": 0, "running": 0}
+        for rec in self._tasks.values():
+            status = "queued" if rec.status == "running" and not rec.started else rec.status
+            out[status] = out.get(status, 0) + 1
+        return out
+
+    def _evict_idle(self) -> None:
+        # 从最久没用的开始淘汰；在跑的 run 还要往 session 级记用量，跳过
+        if len(self._usage) <= self.max_sessions:
+            return
+        for sid in list(self._usage):
+            if len(self._usage) <= self.max_sessions:
+                break
+            rec = self._tasks.get(sid)
+            if rec is not None and rec.status == "running":
+                continue
+            if self._over_budget(sid):
+                self._exhausted[sid] = self._usage[sid].total.total_tokens
+                if len(self._exhausted) > self.max_exhausted:
+                    self._exhausted.popitem(last=False)
+            del self._usage[sid]
+            self._tasks.pop(sid, None)
 
     def _cleanup(self, session_id: str) -> None:
+        # 超出上限时在跑的 session 没法淘汰：等它们结束时再补淘汰
+        self._evict_idle()
         # 如果你希望保留历史状态，可不删除；Day2 建议删除，避免堆积
         # 如果你想保留最后状态用于 /status 查询，可以延迟删除或另存 session_store
         # 这里做：结束后保留 60 秒再删（简化：先不延迟，直接删）
@@ -0,0 +1,259 @@
+"""
+ws_gateway.py
+多路复用 WebSocket 网关：一条连接订阅任意多个 session，并能发控制消息（start / cancel / ...）。
+
+协议（都是 JSON 文本帧）：
+- 客户端 -> 服务端：{"op": "...", "id": 可选的关联 id, ...}
+  - subscribe / unsubscribe：{"sessions": [...]}
+  - ack：{"seq": N}，表示 seq <= N 的事件都收到了（流控窗口据此前移）
+  - ping：心跳（任何消息都会刷新空闲计时）
+  - 其它 op（start / cancel / status ...）交给注入的 handlers 处理，start 会自动订阅该 session
+- 服务端 -> 客户端：
+  - {"type": "events", "events": [{"seq", "session", "event"}, ...], "dropped": {session: n}?}
+    同一小段时间（flush_interval_s）内的事件合并成一帧
+  - {"type": "reply", "id", "op", "ok", "result" | "error"}
+  - {"type": "ping"}：一段时间没帧可发时的服务端心跳
+
+流控（按连接）：
+- 已发出但没 ack 的事件最多 window 个，超过就先攒在缓冲区里（window=0 表示不等 ack）
+- 缓冲区最多 max_buffer 个事件，满了丢最旧的，丢了多少按 session 在下一帧的 dropped 里报告
+- idle_timeout_s 内客户端一条消息都没有（包括 ack / ping）就认为连接已死，关闭并清理
+
+断开（正常关闭、网络断、空闲超时、发送失败）时注销该连接在 EventBus 上的所有监听。
+已经启动的 run 不受影响，照常跑完（别的连接 / SSE 还能接着看）。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import collections
+import json
+import logging
+from typing import Any, Callable, Deque, Dict, Optional, Set
+
+from fastapi import WebSocket
+from starlette.websockets import WebSocketDisconnect
+
+from agentlab.runtime.events import EventBus
+
+logger = logging.getLogger(__name__)
+
+JsonDict = Dict[str, Any]
+# handler(msg) -> result：同步或 async 都行；抛异常 -> reply ok=false
+Handler = Callable[[JsonDict], Any]
+
+_connections: Set["GatewayConnection"] = set()
+
+
+class GatewayError(ValueError):
+    """控制消息不合法（回给客户端 ok=false，连接不断）。"""
+
+
+class GatewayConnection:
+    def __init__(
+        self,
+        ws: WebSocket,
+        bus: EventBus,
+        handlers: Dict[str, Handler],
+        *,
+        window: int = 1024,
+        max_batch: int = 256,
+        flush_interval_s: float = 0.02,
+        max_buffer: int = 10_000,
+        max_sessions: int = 1000,
+        heartbeat_s: float = 20.0,
+        idle_timeout_s: float = 60.0,
+    ) -> None:
+        self.ws = ws
+        self.bus = bus
+        self.handlers = handlers
+        self.window = max(0, window)
+        self.max_batch = max(1, max_batch)
+        self.flush_interval_s = flush_interval_s
+        self.max_buffer = max(1, max_buffer)
+        self.max_sessions = max_sessions
+        self.heartbeat_s = heartbeat_s
+        self.idle_timeout_s = idle_timeout_s
+
+        self.sessions: Set[str] = set()
+        self._buf: Deque[JsonDict] = collections.deque()
+        self._replies: Deque[JsonDict] = collections.deque()
+        self._dropped: Dict[str, int] = {}
+        self._wake = asyncio.Event()
+        self._seq = 0  # 最后一个入缓冲区的事件序号
+        # 已发出、还没 ack 的事件序号（最多 window 个）；被丢弃的事件没发过，不占窗口
+        self._inflight: Deque[int] = collections.deque()
+        self.dropped_total = 0
+
+    # ---------- EventBus 监听（在 publish 里同步调用，只做入缓冲） ----------
+
+    def _on_event(self, session_id: str, ev: JsonDict) -> None:
+        self._seq += 1
+        self._buf.append({"seq": self._seq, "session": session_id, "event": ev})
+        if len(self._buf) > self.max_buffer:
+            old = self._buf.popleft()
+            self._dropped[old["session"]] = self._dropped.get(old["session"], 0) + 1
+            self.dropped_total += 1
+        self._wake.set()
+
+    def subscribe(self, sessions: Any) -> JsonDict:
+        if isinstance(sessions, str):
+            sessions = [sessions]
+        if not isinstance(sessions, list) or not all(isinstance(s, str) and s for s in sessions):
+            raise GatewayError("sessions must be a list of session ids")
+        new = [s for s in dict.fromkeys(sessions) if s not in self.sessions]
+        if len(self.sessions) + len(new) > self.max_sessions:
+            raise GatewayError(f"too many subscriptions (max {self.max_sessions})")
+        for sid in new:
+            self.bus.add_listener(sid, self._on_event)
+            self.sessions.add(sid)
+        return {"subscribed": len(self.sessions)}
+
+    def unsubscribe(self, sessions: Any) -> JsonDict:
+        if isinstance(sessions, str):
+            sessions = [sessions]
+        for sid in sessions or []:
+            if sid in self.sessions:
+                self.bus.remove_listener(sid, self._on_event)
+                self.sessions.discard(sid)
+        return {"subscribed": len(self.sessions)}
+
+    def _close_subscriptions(self) -> None:
+        for sid in self.sessions:
+            self.bus.remove_listener(sid, self._on_event)
+        self.sessions.clear()
+        self._buf.clear()
+
+    # ---------- 收 ----------
+
+    async def _dispatch(self, msg: JsonDict) -> Optional[JsonDict]:
+        op = msg.get("op")
+        if op == "ack":
+            seq = msg.get("seq")
+            if not isinstance(seq, int):
+                raise GatewayError("ack needs an integer seq")
+            while self._inflight and self._inflight[0] <= seq:
+                self._inflight.popleft()
+            self._wake.set()
+            return None  # ack 不回复
+        if op == "ping":
+            return None
+        if op == "subscribe":
+            return self.subscribe(msg.get("sessions"))
+        if op == "unsubscribe":
+            return self.unsubscribe(msg.get("sessions"))
+        handler = self.handlers.get(op) if isinstance(op, str) else None
+        if handler is None:
+            raise GatewayError(f"unknown op: {op!r}")
+        if op == "start" and isinstance(msg.get("session_id"), str):
+            # 先订阅再启动：不会漏掉 run 的第一批事件
+            self.subscribe([msg["session_id"]])
+        result = handler(msg)
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+
+    async def _receiver(self) -> None:
+        while True:
+            try:
+                raw = await asyncio.wait_for(self.ws.receive_text(), timeout=self.idle_timeout_s)
+            except asyncio.TimeoutError:
+                logger.info("ws gateway idle timeout, closing (sessions=%d)", len(self.sessions))
+                await self.ws.close(code=1001)
+                return
+            try:
+                msg = json.loads(raw)
+                if not isinstance(msg, dict):
+                    raise GatewayError("message must be a JSON object")
+            except (ValueError, GatewayError) as e:
+                self._reply({"type": "reply", "id": None, "op": None, "ok": False, "error": str(e)})
+                continue
+            try:
+                result = await self._dispatch(msg)
+            except Exception as e:
+                self._reply({"type": "reply", "id": msg.get("id"), "op": msg.get("op"), "ok": False, "error": str(e)})
+                continue
+            if msg.get("op") not in ("ack", "ping"):
+                self._reply({"type": "reply", "id": msg.get("id"), "op": msg.get("op"), "ok": True, "result": result})
+
+    def _reply(self, frame: JsonDict) -> None:
+        # 回复也走发送协程（同一条 WS 上只有一个协程在 send），但不占事件窗口
+        self._replies.append(frame)
+        self._wake.set()
+
+    # ---------- 发 ----------
+
+    def _credit(self) -> int:
+        if not self.window:
+            return self.max_batch
+        return self.window - len(self._inflight)
+
+    async def _send(self, frame: JsonDict) -> None:
+        await self.ws.send_text(json.dumps(frame, ensure_ascii=False, default=str))
+
+    async def _sender(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.heartbeat_s)
+            except asyncio.TimeoutError:
+                await self._send({"type": "ping"})
+                continue
+            self._wake.clear()
+            while self._replies:
+                await self._send(self._replies.popleft())
+            if not self._buf or self._credit() <= 0:
+                continue
+            # 不满一帧就再等一小会儿，把 delta 风暴合并成少量大帧
+            if len(self._buf) < self.max_batch and self.flush_interval_s > 0:
+                await asyncio.sleep(self.flush_interval_s)
+            while self._buf and self._credit() > 0:
+                n = min(self.max_batch, self._credit(), len(self._buf))
+                events = [self._buf.popleft() for _ in range(n)]
+                frame: JsonDict = {"type": "events", "events": events}
+                if self._dropped:
+                    frame["dropped"], self._dropped = self._dropped, {}
+                if self.window:
+                    self._inflight.extend(e["seq"] for e in events)
+                await self._send(frame)
+                while self._replies:
+                    await self._send(self._replies.popleft())
+
+    # ---------- 生命周期 ----------
+
+    async def serve(self, sessions: Any = None) -> None:
+        """跑到连接断开为止；返回前一定清理订阅。"""
+        _connections.add(self)
+        try:
+            if sessions:
+                self.subscribe(sessions)
+            tasks = [asyncio.create_task(self._receiver()), asyncio.create_task(self._sender())]
+            try:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    e = t.exception()
+                    if e is not None and not isinstance(e, WebSocketDisconnect):
+                        logger.info("ws gateway connection ended: %r", e)
+            finally:
+                for t in tasks:
+                    t.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            self._close_subscriptions()
+            _connections.discard(self)
+
+    def stats(self) -> JsonDict:
+        return {
+            "sessions": len(self.sessions),
+            "buffered": len(self._buf),
+            "unacked": len(self._inflight),
+            "dropped": self.dropped_total,
+        }
+
+
+def stats() -> Dict[str, int]:
+    """所有网关连接的汇总（/metrics 用）。"""
+    out = {"connections": len(_connections), "sessions": 0, "buffered": 0, "unacked": 0, "dropped": 0}
+    for c in _connections:
+        for k, v in c.stats().items():
+            out[k] += v
+    return out
@@ -0,0 +1,333 @@
+"""
+bench_load.py
+进程内压测：起一个 uvicorn（同一个 event loop），用 ScriptedLLMClient 代替 Gemini，
+开 N 个 SSE 订阅（每个 session 一个），一共发 M 次 run，统计：
+- 吞吐（runs/s、events/s）
+- 首个 delta 延迟（POST -> 第一条 final_delta / llm_delta）
+- 端到端延迟 p50/p95/p99（POST -> run_done）
+- event loop lag（定时探针的超时量）
+- RSS（当前 / 峰值）
+结果输出 JSON，方便不同版本之间 diff。
+
+用法示例：
+  python -m agentlab.scripts.bench_load --sessions 50 --runs 500 --latency lognormal:0.05,0.5 --tool-calls 2
+  python -m agentlab.scripts.bench_load --mode chat --chunk-size 4 --out bench.json
+
+录制 / 回放（同一条 react_chat -> EventBus -> SSE 链路，LLM 换成录制文件）：
+  python -m agentlab.scripts.bench_load --runs 20 --record logs/llm_rec.jsonl.gz
+  python -m agentlab.scripts.bench_load --runs 20 --replay logs/llm_rec.jsonl.gz --replay-speed 100
+  线上用 LLM_RECORD_PATH 录下真实 Gemini 交互后同样可以 --replay（prompt 不同就加 --replay-loose）
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+
+def _pct(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    s = sorted(values)
+    idx = min(len(s) - 1, max(0, int(round(q * (len(s) - 1)))))
+    return round(s[idx] * 1000, 2)
+
+
+def _summary(values: List[float]) -> Dict[str, Any]:
+    return {
+        "count": len(values),
+        "p50_ms": _pct(values, 0.50),
+        "p95_ms": _pct(values, 0.95),
+        "p99_ms": _pct(values, 0.99),
+        "max_ms": round(max(values) * 1000, 2) if values else None,
+    }
+
+
+def _rss_mb() -> Dict[str, float]:
+    cur = 0.0
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    cur = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    return {"rss_mb": round(cur, 1), "peak_rss_mb": round(peak_mb, 1)}
+
+
+async def _loop_lag_probe(samples: List[float], stop: asyncio.Event, interval: float = 0.01) -> None:
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        t0 = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - t0 - interval))
+
+
+# ---------- 极简 HTTP 客户端（避免引入额外依赖） ----------
+
+async def _read_headers(reader: asyncio.StreamReader) -> Dict[str, str]:
+    status = await reader.readline()
+    if not status:
+        raise ConnectionError("empty response")
+    headers: Dict[str, str] = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        k, _, v = line.decode("latin-1").partition(":")
+        headers[k.strip().lower()] = v.strip()
+    return headers
+
+
+async def _post_json(host: str, port: int, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(payload).encode("utf-8")
+    writer.write(
+        f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+    )
+    await writer.drain()
+    headers = await _read_headers(reader)
+    n = int(headers.get("content-length", "0"))
+    data = await reader.readexactly(n) if n else await reader.read()
+    writer.close()
+    return json.loads(data or b"{}")
+
+
+class SSESubscriber:
+    """订阅一个 session 的 SSE，把事件按类型分发给等待者（解析 chunked 编码 + data: 行）。"""
+
+    def __init__(self, host: str, port: int, session_id: str) -> None:
+        self.host, self.port, self.session_id = host, port, session_id
+        self.events = 0
+        self._waiters: List[tuple[set, asyncio.Future]] = []
+        self._task: Optional[asyncio.Task] = None
+        self.connected = asyncio.Event()
+
+    def wait_for(self, types: set) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append((types, fut))
+        return fut
+
+    def _dispatch(self, ev: Dict[str, Any]) -> None:
+        self.events += 1
+        if ev.get("type") == "see_connection":
+            self.connected.set()
+        now = time.perf_counter()
+        for types, fut in list(self._waiters):
+            if ev.get("type") in types and not fut.done():
+                fut.set_result((now, ev))
+                self._waiters.remove((types, fut))
+
+    async def _run(self) -> None:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        writer.write(
+            f"GET /session/{self.session_id}/events HTTP/1.1\r\nHost: {self.host}\r\n"
+            "Accept: text/event-stream\r\n\r\n".encode("latin-1")
+        )
+        await writer.drain()
+        headers = await _read_headers(reader)
+        chunked = headers.get("transfer-encoding", "").lower() == "chunked"
+        buf = b""
+        try:
+            while True:
+                if chunked:
+                    size_line = await reader.readline()
+                    if not size_line:
+                        break
+                    size = int(size_line.strip() or b"0", 16)
+                    if size == 0:
+                        break
+                    data = await reader.readexactly(size + 2)
+                    buf += data[:-2]
+                else:
+                    data = await reader.read(65536)
+                    if not data:
+                        break
+                    buf += data
+                buf = buf.replace(b"\r\n", b"\n")
+                while b"\n\n" in buf:
+                    block, buf = buf.split(b"\n\n", 1)
+                    for line in block.split(b"\n"):
+                        if line.startswith(b"data:"):
+                            try:
+                                self._dispatch(json.loads(line[5:].strip()))
+                            except ValueError:
+                                pass
+        finally:
+            writer.close()
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+# ---------- 压测主流程 ----------
+
+async def run_bench(args: argparse.Namespace) -> Dict[str, Any]:
+    import uvicorn
+
+    import agentlab.app as app_mod
+    from agentlab.models.recording import RecordingLLMClient, ReplayLLMClient
+    from agentlab.models.scripted_client import LatencySpec, ScriptedLLMClient, ToolCallScript
+
+    client: Any
+    if args.replay:
+        client = ReplayLLMClient(args.replay, speed=args.replay_speed, strict=not args.replay_loose, loop=True)
+    else:
+        calls = [{"tool_name": "calc", "args": {"expression": f"{i} + 1"}} for i in range(args.tool_calls)]
+        client = ScriptedLLMClient(
+            script=ToolCallScript(calls=calls, final="x" * args.final_chars),
+            latency=LatencySpec.parse(args.latency),
+            first_chunk_latency=LatencySpec.parse(args.first_chunk_latency or args.latency),
+            chunk_interval=LatencySpec.parse(args.chunk_interval),
+            chunk_size=args.chunk_size,
+            seed=args.seed,
+        )
+    backend = RecordingLLMClient(client, args.record) if args.record else client
+    app_mod.set_llm_factory(lambda: backend)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    host, port = sock.getsockname()
+    server = uvicorn.Server(uvicorn.Config(app_mod.app, log_level="warning", access_log=False, lifespan="off"))
+    server_task = asyncio.create_task(server.serve(sockets=[sock]))
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    lag: List[float] = []
+    stop = asyncio.Event()
+    probe = asyncio.create_task(_loop_lag_probe(lag, stop))
+
+    subs = [SSESubscriber(host, port, f"bench-{i}") for i in range(args.sessions)]
+    for s in subs:
+        s.start()
+    await asyncio.gather(*(s.connected.wait() for s in subs))
+
+    path = "chat" if args.mode == "chat" else "react_chat"
+    first_delta: List[float] = []
+    e2e: List[float] = []
+    errors = 0
+    remaining = args.runs
+
+    async def _session_worker(sub: SSESubscriber) -> None:
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            delta_fut = sub.wait_for({"final_delta", "llm_delta"})
+            done_fut = sub.wait_for({"run_done", "error", "cancelled"})
+            payload: Dict[str, Any] = {"prompt": args.prompt, "use_memory": False}
+            if args.mode in ("react", "plan", "fanout"):
+                payload["mode"] = args.mode
+            t0 = time.perf_counter()
+            resp = await _post_json(host, port, f"/session/{sub.session_id}/{path}", payload)
+            if resp.get("result") != "started":
+                errors += 1
+                delta_fut.cancel()
+                done_fut.cancel()
+                continue
+            t_done, ev = await done_fut
+            if ev.get("type") != "run_done":
+                errors += 1
+            else:
+                e2e.append(t_done - t0)
+            if delta_fut.done():
+                first_delta.append(delta_fut.result()[0] - t0)
+            else:
+                delta_fut.cancel()
+
+    rss_before = _rss_mb()
+    ev_before = sum(s.events for s in subs)
+    t_start = time.perf_counter()
+    await asyncio.gather(*(_session_worker(s) for s in subs))
+    wall = time.perf_counter() - t_start
+    events = sum(s.events for s in subs) - ev_before
+
+    stop.set()
+    await probe
+    for s in subs:
+        await s.stop()
+    server.should_exit = True
+    await server_task
+    app_mod.set_llm_factory(None)
+    if args.record:
+        backend.close()
+
+    if isinstance(client, ReplayLLMClient):
+        llm_stats: Dict[str, Any] = {"replay_hits": client.hits, "replay_misses": client.misses}
+    else:
+        llm_stats = {"llm_calls": client.calls}
+
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "out"},
+        "wall_s": round(wall, 3),
+        "runs_ok": len(e2e),
+        "errors": errors,
+        "throughput": {
+            "runs_per_s": round(len(e2e) / wall, 2) if wall else None,
+            "events_per_s": round(events / wall, 1) if wall else None,
+            "events": events,
+        },
+        "time_to_first_delta": _summary(first_delta),
+        "end_to_end": _summary(e2e),
+        "event_loop_lag": _summary(lag),
+        "memory": {"before": rss_before, "after": _rss_mb()},
+        **llm_stats,
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sessions", type=int, default=20, help="并发 session 数（每个 session 一个 SSE 订阅）")
+    ap.add_argument("--runs", type=int, default=200, help="总 run 数，均摊到各 session 顺序执行")
+    ap.add_argument("--mode", default="react", choices=["react", "plan", "fanout", "chat"])
+    ap.add_argument("--latency", default="fixed:0.02", help="generate 延迟分布，如 lognormal:0.05,0.5")
+    ap.add_argument("--first-chunk-latency", default=None, help="流式首 chunk 延迟分布（默认同 --latency）")
+    ap.add_argument("--chunk-interval", default="fixed:0.002", help="流式 chunk 间隔分布")
+    ap.add_argument("--chunk-size", type=int, default=8)
+    ap.add_argument("--final-chars", type=int, default=200, help="最终回答长度（字符）")
+    ap.add_argument("--tool-calls", type=int, default=1, help="每个 ReAct run 的工具调用数")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--prompt", default="bench", help="每次 run 的用户输入（回放时要和录制时一致）")
+    ap.add_argument("--record", default=None, help="把 LLM 交互录制到该文件（gzip JSONL）")
+    ap.add_argument("--replay", default=None, help="用录制文件代替 ScriptedLLMClient")
+    ap.add_argument("--replay-speed", type=float, default=1.0, help="回放速度倍数，0 = 不等待")
+    ap.add_argument("--replay-loose", action="store_true", help="指纹没命中时按录制顺序兜底")
+    ap.add_argument("--out", default=None, help="结果 JSON 输出路径（默认打印到 stdout）")
+    args = ap.parse_args()
+
+    # 同 bench_startup：在临时目录里跑，app 默认写的 logs/（trace / 索引 / profile）和 data/
+    # （记忆 / 批量任务 / checkpoint）都落在临时目录，压测不污染本地数据；命令行给的路径先转成绝对路径
+    for name in ("record", "replay", "out"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    tmp = tempfile.mkdtemp(prefix="agentlab-bench-")
+    os.environ.setdefault("MEMORY_DIR", os.path.join(tmp, "memory"))
+    os.environ.setdefault("VECTOR_MEMORY_DIR", os.path.join(tmp, "vector_memory"))
+    os.chdir(tmp)
+
+    result = asyncio.run(run_bench(args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
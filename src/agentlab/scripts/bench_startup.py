@@ -0,0 +1,156 @@
+"""
+bench_startup.py
+冷启动基准：每轮起一个全新的解释器，分别计时
+- import agentlab.app（不建 app）
+- create_app()（OTel 初始化、挂路由、instrumentation）
+- 第一个请求（GET /health，直接走 ASGI，不经网络）
+并检查启动后不该被加载的重模块（google.genai、numpy、没配置时的 OTLP exporter）确实没被加载，
+以及 import 本身没有在工作目录里建 data/ 之类的文件（落盘单例都应该第一次用到时才建）。
+取各轮中位数和预算比较，超了 / 重模块被提前加载了就以非 0 退出，可以直接放进 CI。
+
+用法示例：
+  python -m agentlab.scripts.bench_startup
+  python -m agentlab.scripts.bench_startup --rounds 10 --budget-import-ms 450 --budget-total-ms 550
+  python -m agentlab.scripts.bench_startup --importtime-top 20   # 顺带列出累计耗时最多的 import
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from typing import Any, Dict, List
+
+# 启动路径上不应该出现的模块：出现了说明有人又把重依赖放回了 import 时
+LAZY_MODULES = [
+    "google.genai",
+    "numpy",  # 只有向量记忆 / 向量化 calc 用得到
+    "opentelemetry.exporter.otlp.proto.http.trace_exporter",
+]
+
+_CHILD = r"""
+import asyncio, json, os, sys, time
+t0 = time.perf_counter()
+import agentlab.app as m
+t1 = time.perf_counter()
+import_wrote = sorted(os.listdir("."))
+app = m.create_app()
+t2 = time.perf_counter()
+
+async def _first_request():
+    sent = []
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+    async def send(msg):
+        sent.append(msg)
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": "/health", "raw_path": b"/health", "query_string": b"",
+        "headers": [], "client": ("127.0.0.1", 1), "server": ("127.0.0.1", 80), "root_path": "",
+    }
+    await app(scope, receive, send)
+    return next(x["status"] for x in sent if x["type"] == "http.response.start")
+
+status = asyncio.run(_first_request())
+t3 = time.perf_counter()
+print(json.dumps({
+    "import_ms": (t1 - t0) * 1000,
+    "create_app_ms": (t2 - t1) * 1000,
+    "first_request_ms": (t3 - t2) * 1000,
+    "status": status,
+    "loaded": [name for name in %r if name in sys.modules],
+    "import_wrote": import_wrote,
+}))
+"""
+
+
+def _run_child(tmp: str, env: Dict[str, str], importtime: bool = False) -> Dict[str, Any]:
+    cwd = tempfile.mkdtemp(dir=tmp)  # 每轮一个空目录：才看得出 import 有没有写文件
+    cmd = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", _CHILD % (LAZY_MODULES,)]
+    p = subprocess.run(cmd, cwd=cwd, env=env, capture_output=True, text=True)
+    if p.returncode != 0:
+        raise RuntimeError(f"startup child failed:\n{p.stderr[-2000:]}")
+    out = json.loads(p.stdout.strip().splitlines()[-1])
+    if importtime:
+        out["importtime"] = p.stderr
+    return out
+
+
+def _top_imports(raw: str, n: int) -> List[Dict[str, Any]]:
+    """解析 -X importtime 输出，按累计耗时取前 n 个顶层（直接被 import 的）模块。"""
+    rows = []
+    for line in raw.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _self_us, cum_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth <= 1:
+            rows.append({"module": name.strip(), "cumulative_ms": round(int(cum_us) / 1000, 1)})
+    rows.sort(key=lambda r: r["cumulative_ms"], reverse=True)
+    return rows[:n]
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rounds", type=int, default=5, help="冷启动轮数（每轮一个新解释器），取中位数")
+    # 预算贴着实测中位数定（开发机 import ~385ms / 合计 ~445ms，单核 CI ~520 / ~625ms），
+    # 只留机器差异和抖动的余量：多一个重依赖回到 import 路径就会超
+    ap.add_argument("--budget-import-ms", type=float, default=600.0, help="import agentlab.app 的中位数预算")
+    ap.add_argument("--budget-total-ms", type=float, default=700.0, help="import + create_app + 首个请求的中位数预算")
+    ap.add_argument("--importtime-top", type=int, default=0, help="额外跑一轮 -X importtime，列出累计最慢的 N 个 import")
+    ap.add_argument("--out", default=None, help="结果 JSON 输出路径（默认打印到 stdout）")
+    args = ap.parse_args()
+
+    # 在临时目录里跑：logs/ / data/ 都写到那里，不污染工作区（默认的相对路径，正好也能查 import 有没有写文件）
+    tmp = tempfile.mkdtemp(prefix="agentlab-startup-")
+    env = dict(os.environ)
+    env.pop("OTEL_EXPORTER_OTLP_ENDPOINT", None)
+    src = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env["PYTHONPATH"] = os.pathsep.join(p for p in (src, env.get("PYTHONPATH")) if p)
+
+    _run_child(tmp, env)  # 预热一次（.pyc / 磁盘缓存），不计入
+    runs = [_run_child(tmp, env) for _ in range(args.rounds)]
+
+    def _median(key: str) -> float:
+        return round(statistics.median(r[key] for r in runs), 1)
+
+    total = [r["import_ms"] + r["create_app_ms"] + r["first_request_ms"] for r in runs]
+    result: Dict[str, Any] = {
+        "rounds": args.rounds,
+        "import_ms": _median("import_ms"),
+        "create_app_ms": _median("create_app_ms"),
+        "first_request_ms": _median("first_request_ms"),
+        "total_ms": round(statistics.median(total), 1),
+        "eagerly_loaded": sorted({name for r in runs for name in r["loaded"]}),
+        "import_wrote": sorted({name for r in runs for name in r["import_wrote"]}),
+        "budget": {"import_ms": args.budget_import_ms, "total_ms": args.budget_total_ms},
+    }
+    if args.importtime_top:
+        result["top_imports"] = _top_imports(_run_child(tmp, env, importtime=True)["importtime"], args.importtime_top)
+
+    failures = []
+    if result["import_ms"] > args.budget_import_ms:
+        failures.append(f"import {result['import_ms']}ms > budget {args.budget_import_ms}ms")
+    if result["total_ms"] > args.budget_total_ms:
+        failures.append(f"startup {result['total_ms']}ms > budget {args.budget_total_ms}ms")
+    if result["eagerly_loaded"]:
+        failures.append(f"modules loaded at startup that should be lazy: {', '.join(result['eagerly_loaded'])}")
+    if result["import_wrote"]:
+        failures.append(f"import agentlab.app wrote files: {', '.join(result['import_wrote'])}")
+    result["ok"] = not failures
+    result["failures"] = failures
+
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+    sys.exit(0 if not failures else 1)
+
+
+if __name__ == "__main__":
+    main()
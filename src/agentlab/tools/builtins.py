@@ -1,34 +1,59 @@
 import time
-import math
 import asyncio
 from typing import Any, Dict
 
+from agentlab.tools import calc_engine
 from agentlab.tools.registry import ToolRegistry, ToolSpec, RetryPolicy
 
+MAX_BATCH_EXPRESSIONS = 10_000
+
 
 def register_builtin_tools(reg: ToolRegistry) -> None:
-    # 1) 计算器（sync）
+    # 1) 计算器（sync）：AST 白名单 + 编译缓存，见 calc_engine
     def calc(args: Dict[str, Any]) -> Dict[str, Any]:
+        exprs = args.get("expressions")
+        variables = args.get("variables") or {}
+        if not isinstance(variables, dict):
+            raise ValueError("variables must be an object")
+
+        # 批量：一组表达式逐个算，单个出错只体现在该项的 error 上
+        if exprs is not None:
+            if not isinstance(exprs, list):
+                raise ValueError("expressions must be a list")
+            if len(exprs) > MAX_BATCH_EXPRESSIONS:
+                raise ValueError(f"too many expressions (> {MAX_BATCH_EXPRESSIONS})")
+            return {"results": calc_engine.evaluate_many(exprs, variables)}
+
         expr = str(args.get("expression", "")).strip()
         if not expr:
             raise ValueError("expression is required")
 
-        # 安全起见：只允许数字/运算符/括号/空格/小数点
-        allowed = set("0123456789+-*/(). %")
-        if any(c not in allowed for c in expr):
-            raise ValueError("expression contains illegal characters")
+        # 同一个表达式套在数组变量上：NumPy 一次算完
+        if any(isinstance(v, (list, tuple)) for v in variables.values()):
+            return {"expression": expr, "values": calc_engine.evaluate_vector(expr, variables)}
 
-        # 简单 eval（仅数学表达式）
-        val = eval(expr, {"__builtins__": {}}, {"math": math})
-        return {"expression": expr, "value": val}
+        return {"expression": expr, "value": calc_engine.evaluate(expr, variables)}
 
     reg.register(ToolSpec(
         name="calc",
-        description="Evaluate a simple math expression (safe subset).",
-        input_schema={"type": "object", "properties": {"expression": {"type": "string"}}, "required": ["expression"]},
+        description=(
+            "Evaluate math expressions (+ - * / // % **, sqrt/log/exp/sin/cos/min/max/round..., pi, e). "
+            "Pass `expression`, or `expressions` (a list) to evaluate many at once, "
+            "or `expression` plus `variables` mapping names to numbers or equal-length lists "
+            "to evaluate one formula over many values."
+        ),
+        input_schema={
+            "type": "object",
+            "properties": {
+                "expression": {"type": "string"},
+                "expressions": {"type": "array", "items": {"type": "string"}},
+                "variables": {"type": "object"},
+            },
+        },
         func=calc,
         is_async=False,
         timeout_s=3.0,
+        max_concurrency=16,  # sync 工具跑在默认线程池里，批量调用时别把线程池占满
         retry=RetryPolicy(max_retries=0),
     ))
 
@@ -0,0 +1,258 @@
+"""
+calc_engine.py
+calc 工具的表达式引擎：解析成 AST -> 白名单校验 -> 编译成 code object（按表达式字符串 LRU 缓存），
+再在只含白名单函数 / 常量 / 变量的命名空间里执行。
+
+- 运算符：+ - * / // % **，一元 + -；函数：abs round min max sqrt exp log log10 log2 sin cos tan floor ceil
+- 常量：pi e tau；其它名字必须由 variables 提供
+- 限制：表达式长度、AST 节点数、嵌套深度；** 的指数大小和整数结果位数；结果必须是有限数
+- 向量化：variables 里给数组时，同一个编译结果换成 NumPy 命名空间整批算（一次 pass，不逐个调用）
+"""
+
+from __future__ import annotations
+
+import ast
+import functools
+import math
+from typing import Any, Dict, List, Mapping, Optional
+
+MAX_EXPR_LEN = 2000
+MAX_NODES = 512
+MAX_DEPTH = 200  # 长的 a+b+c+... 链在 AST 里也是嵌套，别卡太紧
+MAX_EXPONENT = 1024  # |指数| 上限
+MAX_INT_BITS = 4096  # 整数结果位数上限（约 1233 位十进制）
+MAX_ARRAY_LEN = 100_000
+
+_BINOPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)
+_UNARYOPS = (ast.UAdd, ast.USub)
+_CONSTANTS = {"pi": math.pi, "e": math.e, "tau": math.tau}
+_FUNCS = ("abs", "round", "min", "max", "sqrt", "exp", "log", "log10", "log2", "sin", "cos", "tan", "floor", "ceil")
+
+
+class CalcError(ValueError):
+    """表达式非法 / 超出限制 / 计算出错（ToolRunner 按普通工具错误处理）。"""
+
+
+# ---------- 校验 + 编译 ----------
+
+
+class _PowToCall(ast.NodeTransformer):
+    """a ** b 改写成 _pow(a, b)：指数和结果大小在运行时检查。"""
+
+    def visit_BinOp(self, node: ast.BinOp) -> ast.AST:
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Pow):
+            call = ast.Call(func=ast.Name(id="_pow", ctx=ast.Load()), args=[node.left, node.right], keywords=[])
+            return ast.copy_location(call, node)
+        return node
+
+
+def _validate(node: ast.AST, depth: int, counter: List[int]) -> None:
+    counter[0] += 1
+    if counter[0] > MAX_NODES:
+        raise CalcError(f"expression too complex (> {MAX_NODES} nodes)")
+    if depth > MAX_DEPTH:
+        raise CalcError(f"expression nested too deeply (> {MAX_DEPTH})")
+
+    if isinstance(node, ast.Expression):
+        _validate(node.body, depth + 1, counter)
+    elif isinstance(node, ast.BinOp):
+        if not isinstance(node.op, _BINOPS):
+            raise CalcError(f"operator not allowed: {type(node.op).__name__}")
+        _validate(node.left, depth + 1, counter)
+        _validate(node.right, depth + 1, counter)
+    elif isinstance(node, ast.UnaryOp):
+        if not isinstance(node.op, _UNARYOPS):
+            raise CalcError(f"operator not allowed: {type(node.op).__name__}")
+        _validate(node.operand, depth + 1, counter)
+    elif isinstance(node, ast.Constant):
+        v = node.value
+        if isinstance(v, bool) or not isinstance(v, (int, float)):
+            raise CalcError(f"only numeric literals are allowed, got {v!r}")
+        if isinstance(v, int) and v.bit_length() > MAX_INT_BITS:
+            raise CalcError("numeric literal too large")
+    elif isinstance(node, ast.Name):
+        # 函数名只能出现在调用位置（Call 分支里单独校验，不会走到这里），当值用会把函数对象本身算出来
+        if node.id.startswith("_") or node.id in _FUNCS:
+            raise CalcError(f"name not allowed: {node.id}")
+    elif isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Name) or node.func.id not in _FUNCS:
+            raise CalcError(f"function not allowed: {ast.unparse(node.func)}")
+        if node.keywords:
+            raise CalcError("keyword arguments are not allowed")
+        for a in node.args:
+            _validate(a, depth + 1, counter)
+    else:
+        raise CalcError(f"syntax not allowed: {type(node).__name__}")
+
+
+@functools.lru_cache(maxsize=2048)
+def compile_expression(expr: str) -> Any:
+    """解析 + 校验 + 编译（按表达式字符串缓存，同一表达式只编译一次）。"""
+    if len(expr) > MAX_EXPR_LEN:
+        raise CalcError(f"expression too long (> {MAX_EXPR_LEN} chars)")
+    try:
+        tree = ast.parse(expr, mode="eval")
+    except (SyntaxError, RecursionError, MemoryError) as e:
+        raise CalcError(f"invalid expression: {e}") from None
+    _validate(tree, 0, [0])
+    tree = ast.fix_missing_locations(_PowToCall().visit(tree))
+    return compile(tree, "<calc>", "eval")
+
+
+# ---------- 标量求值 ----------
+
+
+def _check_scalar(v: Any) -> Any:
+    if isinstance(v, complex):
+        raise CalcError("result is not a real number")
+    if isinstance(v, bool) or not isinstance(v, (int, float)):
+        raise CalcError(f"result is not a number: {type(v).__name__}")
+    if isinstance(v, int) and v.bit_length() > MAX_INT_BITS:
+        raise CalcError("result too large")
+    if isinstance(v, float) and not math.isfinite(v):
+        raise CalcError("result is not finite")
+    return v
+
+
+def _pow(a: Any, b: Any) -> Any:
+    if abs(b) > MAX_EXPONENT:
+        raise CalcError(f"exponent too large (|exponent| > {MAX_EXPONENT})")
+    if isinstance(a, int) and isinstance(b, int) and b > 0 and abs(a) > 1:
+        if b * abs(a).bit_length() > MAX_INT_BITS + 64:
+            raise CalcError("result too large")
+    return _check_scalar(a ** b)
+
+
+def _check_ndigits(ndigits: Any) -> None:
+    # round(7, -10**7) 内部要算 10**(-ndigits)：不限住的话一个短表达式就能把线程池线程卡死
+    if isinstance(ndigits, bool) or not isinstance(ndigits, int):
+        raise CalcError("round() ndigits must be an integer")
+    if abs(ndigits) > MAX_EXPONENT:
+        raise CalcError(f"round() ndigits too large (|ndigits| > {MAX_EXPONENT})")
+
+
+def _round(x: Any, ndigits: Any = None) -> Any:
+    if ndigits is None:
+        return round(x)
+    _check_ndigits(ndigits)
+    return round(x, ndigits)
+
+
+_SCALAR_NS: Dict[str, Any] = {
+    "__builtins__": {},
+    "_pow": _pow,
+    "abs": abs, "round": _round, "min": min, "max": max,
+    "sqrt": math.sqrt, "exp": math.exp, "log": math.log, "log10": math.log10, "log2": math.log2,
+    "sin": math.sin, "cos": math.cos, "tan": math.tan, "floor": math.floor, "ceil": math.ceil,
+    **_CONSTANTS,
+}
+
+
+def _run(code: Any, ns: Dict[str, Any]) -> Any:
+    try:
+        return eval(code, ns)
+    except CalcError:
+        raise
+    except NameError as e:
+        raise CalcError(f"unknown name: {e.name}") from None
+    except ZeroDivisionError:
+        raise CalcError("division by zero") from None
+    except (OverflowError, ValueError, TypeError) as e:
+        raise CalcError(str(e)) from None
+
+
+def evaluate(expr: str, variables: Optional[Mapping[str, Any]] = None) -> Any:
+    code = compile_expression(expr.strip())
+    ns = _SCALAR_NS if not variables else {**_SCALAR_NS, **_scalar_vars(variables)}
+    return _check_scalar(_run(code, ns))
+
+
+def _scalar_vars(variables: Mapping[str, Any]) -> Dict[str, Any]:
+    out = {}
+    for k, v in variables.items():
+        if k.startswith("_") or k in _SCALAR_NS:
+            raise CalcError(f"variable name not allowed: {k}")
+        if isinstance(v, bool) or not isinstance(v, (int, float)):
+            raise CalcError(f"variable {k} must be a number")
+        out[k] = v
+    return out
+
+
+def evaluate_many(exprs: List[str], variables: Optional[Mapping[str, Any]] = None) -> List[Dict[str, Any]]:
+    """逐个求值一批表达式（编译结果有缓存），单个出错不影响其它。"""
+    out: List[Dict[str, Any]] = []
+    for expr in exprs:
+        try:
+            out.append({"expression": expr, "value": evaluate(str(expr), variables)})
+        except CalcError as e:
+            out.append({"expression": expr, "error": str(e)})
+    return out
+
+
+# ---------- 向量化求值 ----------
+
+
+@functools.lru_cache(maxsize=1)
+def _vector_ns() -> Dict[str, Any]:
+    import numpy as np  # 只有向量化求值才需要
+
+    def _vpow(a: Any, b: Any) -> Any:
+        if np.max(np.abs(b)) > MAX_EXPONENT:
+            raise CalcError(f"exponent too large (|exponent| > {MAX_EXPONENT})")
+        return np.power(np.asarray(a, dtype=np.float64), b)
+
+    def _vround(a: Any, ndigits: Any = 0) -> Any:
+        # 数组变量算出来的 ndigits 是 float64 ndarray，和标量版一样只认整数
+        if isinstance(ndigits, np.ndarray) and ndigits.ndim == 0:
+            ndigits = ndigits.item()
+        if isinstance(ndigits, float) and ndigits.is_integer():
+            ndigits = int(ndigits)
+        _check_ndigits(ndigits)
+        return np.round(a, ndigits)
+
+    return {
+        "__builtins__": {},
+        "_pow": _vpow,
+        "abs": np.abs, "round": _vround,
+        "min": lambda *a: functools.reduce(np.minimum, a),
+        "max": lambda *a: functools.reduce(np.maximum, a),
+        "sqrt": np.sqrt, "exp": np.exp, "log": np.log, "log10": np.log10, "log2": np.log2,
+        "sin": np.sin, "cos": np.cos, "tan": np.tan, "floor": np.floor, "ceil": np.ceil,
+        **_CONSTANTS,
+    }
+
+
+def evaluate_vector(expr: str, variables: Mapping[str, Any]) -> List[Any]:
+    """variables 里的数组（可与标量混用，按 NumPy 广播）一次算完，返回列表；无效结果（除零 / 溢出）为 None。"""
+    import numpy as np
+
+    code = compile_expression(expr.strip())
+    ns = dict(_vector_ns())
+    n = None
+    for k, v in variables.items():
+        if k.startswith("_") or k in ns:
+            raise CalcError(f"variable name not allowed: {k}")
+        try:
+            arr = np.asarray(v, dtype=np.float64)
+        except (TypeError, ValueError):
+            raise CalcError(f"variable {k} must be a number or a list of numbers") from None
+        if arr.ndim > 1:
+            raise CalcError(f"variable {k} must be 1-dimensional")
+        if arr.size > MAX_ARRAY_LEN:
+            raise CalcError(f"variable {k} too long (> {MAX_ARRAY_LEN})")
+        if arr.ndim == 1:
+            if arr.size == 0:
+                raise CalcError(f"variable {k} must not be empty")
+            if n is not None and arr.size != n:
+                raise CalcError("array variables must have the same length")
+            n = arr.size
+        ns[k] = arr
+    with np.errstate(all="ignore"):
+        res = _run(code, ns)
+    try:
+        res = np.broadcast_to(np.asarray(res, dtype=np.float64), (n or 1,))
+    except (TypeError, ValueError):
+        raise CalcError("result is not a number or an array of numbers") from None
+    # 除零 / 溢出 / 定义域外在 NumPy 里是 inf / nan：逐项置 None，不让整批失败
+    return [float(x) if math.isfinite(x) else None for x in res.tolist()]
@@ -1,11 +1,15 @@
 from __future__ import annotations
 import asyncio
+import contextlib
 import time
 import random
 from dataclasses import dataclass
-from typing import Any, Awaitable, Callable, Dict, Optional
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
 
 from opentelemetry import trace
+
+from agentlab.observability import profiler
+from agentlab.observability.metrics import TOOL_CALLS, TOOL_DURATION, TOOL_INFLIGHT
 tracer = trace.get_tracer(__name__)
 
 JsonDict = Dict[str, Any]
@@ -29,6 +33,7 @@ class ToolSpec:
     is_async: bool = False
     timeout_s: float = 10.0
     retry: RetryPolicy = RetryPolicy()
+    max_concurrency: int = 0  # 同一工具同时执行的上限（跨所有 session），0 = 不限
 
 
 class ToolError(RuntimeError):
@@ -39,13 +44,45 @@ class ToolError(RuntimeError):
 
 
 class ToolRegistry:
+    """
+    version 在每次 register / unregister 时加一。排好序的工具列表、给模型看的工具摘要、/tools 的 JSON、
+    system prompt 这类派生数据都用 cached(key, build) 按 version 缓存：注册表不变，就不再重复排序、拼字符串。
+    """
+
+    MAX_CACHED = 256  # 按请求挑工具子集时 key 会变多，超过就丢最早的
+
     def __init__(self) -> None:
         self._tools: dict[str, ToolSpec] = {}
+        self.version = 0
+        self._cache: Dict[Any, Any] = {}
 
     def register(self, spec: ToolSpec) -> None:
         if spec.name in self._tools:
             raise ValueError(f"Tool already registered: {spec.name}")
         self._tools[spec.name] = spec
+        self._changed()
+
+    def unregister(self, name: str) -> ToolSpec:
+        spec = self.get(name)
+        del self._tools[name]
+        self._changed()
+        return spec
+
+    def _changed(self) -> None:
+        self.version += 1
+        self._cache.clear()
+
+    def cached(self, key: Any, build: Callable[[], Any]) -> Any:
+        """当前 version 下 key 对应的派生数据，没有就 build() 一次。注册表一变全部失效。"""
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        value = build()
+        if len(self._cache) >= self.MAX_CACHED:
+            self._cache.pop(next(iter(self._cache)))
+        self._cache[key] = value
+        return value
 
     def get(self, name: str) -> ToolSpec:
         if name not in self._tools:
@@ -53,7 +90,26 @@ class ToolRegistry:
         return self._tools[name]
 
     def list(self) -> list[ToolSpec]:
-        return sorted(self._tools.values(), key=lambda t: t.name)
+        return list(self.cached("list", lambda: tuple(sorted(self._tools.values(), key=lambda t: t.name))))
+
+    def normalize_names(self, names: Optional[Iterable[str]]) -> Optional[Tuple[str, ...]]:
+        """
+        请求里给的工具子集 -> 排序去重后的 tuple（用作缓存 key）；None 表示全部工具。
+        有不存在的工具名抛 ValueError。
+        """
+        if names is None:
+            return None
+        out = tuple(sorted(set(names)))
+        unknown = [n for n in out if n not in self._tools]
+        if unknown:
+            raise ValueError(f"unknown tools: {', '.join(unknown)}")
+        return out
+
+    def select(self, names: Optional[Tuple[str, ...]] = None) -> list[ToolSpec]:
+        """normalize_names 的结果 -> 对应的 ToolSpec（按名字排序）；None 返回全部。"""
+        if names is None:
+            return self.list()
+        return [self._tools[n] for n in names if n in self._tools]
 
 
 class ToolRunner:
@@ -64,11 +120,31 @@ class ToolRunner:
     """
     def __init__(self, registry: ToolRegistry) -> None:
         self.registry = registry
+        # tool name -> (登记时的 spec, 信号量)；工具被注销后重新注册（可能换了 max_concurrency）时重建
+        self._slots: Dict[str, Tuple[ToolSpec, asyncio.Semaphore]] = {}
+
+    def _slot(self, spec: ToolSpec):
+        """按 max_concurrency 限制同一工具的并发；排队时间不算进 timeout。"""
+        if spec.max_concurrency <= 0:
+            return contextlib.nullcontext()
+        slot = self._slots.get(spec.name)
+        if slot is None or slot[0] is not spec:
+            slot = self._slots[spec.name] = (spec, asyncio.Semaphore(spec.max_concurrency))
+        return slot[1]
 
     async def _call_func(self, spec: ToolSpec, args: JsonDict) -> Any:
         if spec.is_async:
             return await spec.func(args)  # type: ignore[misc]
         # sync 工具放线程池，避免阻塞 event loop
+        if profiler.active:
+            # profiling 时给线程打上发起它的 task 名，采样能按 session 归属
+            task_name = profiler.current_task_name()
+
+            def _tagged(a: JsonDict) -> Any:
+                with profiler.tagged_thread(task_name):
+                    return spec.func(a)
+
+            return await asyncio.to_thread(_tagged, args)
         return await asyncio.to_thread(spec.func, args)
 
     async def run(
@@ -100,13 +176,28 @@ class ToolRunner:
 
             try:
                 attempt += 1
-                t0 = time.time()
-                with tracer.start_as_current_span(
-                    "tool.run",
-                    attributes={"tool.name": tool_name, "session_id": session_id},
-                ):
-                    # ✅ timeout：超时直接抛 TimeoutError
-                    result = await asyncio.wait_for(self._call_func(spec, args), timeout=spec.timeout_s)
+                async with self._slot(spec):
+                    t0 = time.time()
+                    outcome = "error"
+                    TOOL_INFLIGHT.inc(spec.name)
+                    try:
+                        with tracer.start_as_current_span(
+                            "tool.run",
+                            attributes={"tool.name": tool_name, "session_id": session_id},
+                        ):
+                            # ✅ timeout：超时直接抛 TimeoutError
+                            result = await asyncio.wait_for(self._call_func(spec, args), timeout=spec.timeout_s)
+                        outcome = "ok"
+                    except asyncio.TimeoutError:
+                        outcome = "timeout"
+                        raise
+                    except asyncio.CancelledError:
+                        outcome = "cancelled"
+                        raise
+                    finally:
+                        TOOL_INFLIGHT.dec(spec.name)
+                        TOOL_DURATION.observe(time.time() - t0, spec.name)
+                        TOOL_CALLS.inc(spec.name, outcome)
 
                 dur_ms = int((time.time() - t0) * 1000)
                 await bus.publish(session_id, {
@@ -139,3 +230,64 @@ class ToolRunner:
                 delay = min(spec.retry.base_delay_s * (2 ** (attempt - 1)), spec.retry.max_delay_s)
                 delay += random.uniform(0, spec.retry.jitter_s)
                 await asyncio.sleep(delay)
+
+    async def run_many(
+        self,
+        *,
+        session_id: str,
+        calls: List[JsonDict],
+        token: Any,
+        bus: Any,
+        concurrency: int = 32,
+    ) -> AsyncIterator[JsonDict]:
+        """
+        并发执行一批 {"tool", "args"}，按完成顺序产出 {"index", "tool", "ok", ...}。
+        每个调用照常走 run()（timeout / retry / 取消 / 每工具并发上限），单个失败不影响其它；
+        token 被取消时还没完成的调用以 error="cancelled" 结束。
+        固定 concurrency 个 worker 从输入里依次取调用：任务数不随批大小增长。
+        """
+
+        async def _one(index: int, call: JsonDict) -> JsonDict:
+            tool = call.get("tool")
+            try:
+                if not isinstance(tool, str):
+                    raise ValueError(f"tool must be string, got: {tool!r}")
+                args = call.get("args") or {}
+                if not isinstance(args, dict):
+                    raise ValueError(f"args must be object, got: {args!r}")
+                out = await self.run(session_id=session_id, tool_name=tool, args=args, token=token, bus=bus)
+                return {"index": index, **out}
+            except asyncio.CancelledError:
+                if not token.cancelled:
+                    raise
+                return {"index": index, "tool": tool, "ok": False, "error": "cancelled"}
+            except (ToolError, KeyError, ValueError) as e:
+                msg = e.args[0] if isinstance(e, KeyError) else str(e)
+                return {"index": index, "tool": tool, "ok": False, "error": msg}
+            except Exception as e:
+                return {"index": index, "tool": tool, "ok": False, "error": repr(e)}
+
+        pending = iter(enumerate(calls))  # worker 共享：单线程 event loop 里 next() 不会被打断
+        results: "asyncio.Queue[JsonDict]" = asyncio.Queue()
+
+        async def _worker() -> None:
+            for index, call in pending:
+                results.put_nowait(await _one(index, call))
+
+        workers = [asyncio.create_task(_worker()) for _ in range(min(max(1, concurrency), len(calls)))]
+
+        async def _watch() -> None:
+            # 和 TaskManager 一样“双保险”：token 只在 checkpoint 生效，正在执行的调用要 task.cancel() 打断
+            await token.wait()
+            for t in workers:
+                t.cancel()
+
+        watcher = asyncio.create_task(_watch())
+        try:
+            for _ in range(len(calls)):
+                yield await results.get()
+        finally:
+            # 调用方提前退出（客户端断开 / 取消）：剩下的调用一起取消
+            watcher.cancel()
+            for t in workers:
+                t.cancel()
@@ -5,9 +5,19 @@ trace_tree.py
 从 OpenTelemetry JSONL（每行一个 span）里抽取某个 trace_id，
 并以树状结构打印（带耗时ms、step/tool聚合信息）。
 
+有 SQLite 索引（logs/traces.index.sqlite，由 JsonlFileSpanExporter 维护）时直接按偏移 seek，
+不再整文件扫描；没有索引时退回全量扫描。
+
 用法示例：
   python tools/trace_tree.py --trace-id de0c8dbe3bfd5f5c9e96fb56df6d328d
   python tools/trace_tree.py --trace-id ... --file logs/traces.jsonl
+  # 不给 trace-id：按时间范围 / 属性列出 trace（走索引）
+  python tools/trace_tree.py --where tool.name=calc --since 2h
+  python tools/trace_tree.py --where span.status=ERROR --since 2025-12-23T10:00 --until 2025-12-23T12:00
+  # 跨 trace 分析：各 span / 工具 / react.step 的 p50/p95/p99、agent.run 关键路径、火焰图
+  python tools/trace_tree.py --analyze --folded out.folded --json summary.json
+  python tools/trace_tree.py --analyze --where tool.name=calc --since 1d   # 有索引时只读命中的 trace
+  flamegraph.pl out.folded > flame.svg   # 或把 out.folded 拖进 speedscope
 """
 
 from __future__ import annotations
@@ -16,8 +26,13 @@ import argparse
 import json
 import os
 import re
+import time
+from collections import OrderedDict
+from datetime import datetime
 from dataclasses import dataclass, field
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from agentlab.observability.latency import LatencyHistogram
 
 
 @dataclass
@@ -45,36 +60,81 @@ def _safe_int(v: Any, default: int = 0) -> int:
         return default
 
 
-def load_spans(jsonl_path: str, trace_id: str) -> List[Span]:
+def span_from_obj(obj: Dict[str, Any]) -> Span:
+    return Span(
+        name=str(obj.get("name", "")),
+        trace_id=str(obj.get("trace_id", "")),
+        span_id=str(obj.get("span_id", "")),
+        parent_span_id=obj.get("parent_span_id"),
+        start_ns=_safe_int(obj.get("start_time_ns", 0)),
+        end_ns=_safe_int(obj.get("end_time_ns", 0)),
+        status=str(obj.get("status", "")),
+        attributes=obj.get("attributes") or {},
+    )
+
+
+def open_index(jsonl_path: str, index_path: Optional[str] = None):
+    """
+    打开 jsonl 对应的 SQLite 索引；索引不存在（也没显式指定）时返回 None。
+    只有活跃文件和索引进度对不上（有新追加 / 被截断）时才补索引，否则只读、不碰数据库。
+    """
+    from agentlab.observability.trace_index import TraceIndex, default_index_path
+
+    path = index_path or default_index_path(jsonl_path)
+    if not index_path and not os.path.exists(path):
+        return None
+    idx = TraceIndex(path)
+    if os.path.exists(jsonl_path) and os.path.getsize(jsonl_path) != idx.indexed_bytes(jsonl_path):
+        idx.index_file(jsonl_path)
+    return idx
+
+
+def load_spans(jsonl_path: str, trace_id: str, index: Any = None) -> List[Span]:
+    if index is not None:
+        return [span_from_obj(obj) for obj in index.read_records(trace_id)]
+
+    from agentlab.observability.segments import iter_lines, segment_paths
+
     spans: List[Span] = []
-    with open(jsonl_path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                obj = json.loads(line)
-            except Exception:
-                continue
-
-            if obj.get("trace_id") != trace_id:
-                continue
-
-            spans.append(
-                Span(
-                    name=str(obj.get("name", "")),
-                    trace_id=str(obj.get("trace_id", "")),
-                    span_id=str(obj.get("span_id", "")),
-                    parent_span_id=obj.get("parent_span_id"),
-                    start_ns=_safe_int(obj.get("start_time_ns", 0)),
-                    end_ns=_safe_int(obj.get("end_time_ns", 0)),
-                    status=str(obj.get("status", "")),
-                    attributes=obj.get("attributes") or {},
-                )
-            )
+    needle = trace_id.encode("ascii", "ignore")
+    # 没有索引：扫活跃文件和所有轮转分段（压缩的透明解压）
+    for line in iter_lines(segment_paths(jsonl_path) or [jsonl_path]):
+        # 先按字节过滤，只有包含 trace_id 的行才 json.loads
+        if needle not in line:
+            continue
+        try:
+            obj = json.loads(line)
+        except Exception:
+            continue
+
+        if obj.get("trace_id") != trace_id:
+            continue
+
+        spans.append(span_from_obj(obj))
     return spans
 
 
+def parse_time(value: Optional[str]) -> Optional[int]:
+    """时间参数 -> ns：epoch 秒、ISO 时间（本地时区），或相对现在的 30s / 15m / 2h / 1d。"""
+    if not value:
+        return None
+    m = re.fullmatch(r"(\d+(?:\.\d+)?)([smhd])", value)
+    if m:
+        sec = float(m.group(1)) * {"s": 1, "m": 60, "h": 3600, "d": 86400}[m.group(2)]
+        return int((time.time() - sec) * 1e9)
+    try:
+        return int(float(value) * 1e9)
+    except ValueError:
+        return int(datetime.fromisoformat(value).timestamp() * 1e9)
+
+
+def print_trace_list(rows: List[Dict[str, Any]]) -> None:
+    for r in rows:
+        started = datetime.fromtimestamp(r["start_ns"] / 1e9).strftime("%Y-%m-%d %H:%M:%S")
+        dur = (r["end_ns"] - r["start_ns"]) / 1_000_000.0
+        print(f"{r['trace_id']}  {started}  {dur:9.1f} ms  spans={r['spans']:<4} {r['root'] or ''}")
+
+
 def build_tree(spans: List[Span]) -> Tuple[List[Span], Dict[str, List[Span]]]:
     by_id: Dict[str, Span] = {s.span_id: s for s in spans if s.span_id}
     children: Dict[str, List[Span]] = {}
@@ -153,14 +213,326 @@ def print_tree(roots: List[Span], children: Dict[str, List[Span]], show_ids: boo
         _walk(r, "")
 
 
+# ---------- 跨 trace 分析 ----------
+
+def fold_label(s: Span) -> str:
+    """火焰图 / 关键路径用的标签：和 pretty_label 类似，但不带 step 序号（否则同一函数被拆成很多列）。"""
+    if s.name == "react.step":
+        return "react.step"
+    return pretty_label(s).replace(";", ",")
+
+
+def _exclusive_ns(node: Span, kids: List[Span]) -> int:
+    """自身耗时 = 总耗时 - 子 span 区间的并集（并发子任务不重复扣）。"""
+    total = max(0, node.end_ns - node.start_ns)
+    covered = 0
+    cur_s = cur_e = None
+    for k in sorted(kids, key=lambda x: x.start_ns):
+        s, e = max(k.start_ns, node.start_ns), min(k.end_ns, node.end_ns)
+        if e <= s:
+            continue
+        if cur_e is None or s > cur_e:
+            if cur_e is not None:
+                covered += cur_e - cur_s
+            cur_s, cur_e = s, e
+        else:
+            cur_e = max(cur_e, e)
+    if cur_e is not None:
+        covered += cur_e - cur_s
+    return max(0, total - covered)
+
+
+def critical_path(node: Span, children: Dict[str, List[Span]], end_ns: Optional[int] = None) -> List[Tuple[Span, int]]:
+    """
+    从结束时间往回走：每次挑“在游标之前结束得最晚”的子 span 进入递归，空档算给父 span 自己。
+    返回 [(span, 记在它头上的关键路径 ns)]，并发分支里只有拖后腿的那条会出现。
+    """
+    cursor = node.end_ns if end_ns is None else min(end_ns, node.end_ns)
+    out: List[Tuple[Span, int]] = []
+    self_ns = 0
+    kids = children.get(node.span_id, [])
+    while cursor > node.start_ns:
+        best: Optional[Span] = None
+        best_end = node.start_ns
+        for k in kids:
+            if k.start_ns < cursor:
+                e = min(k.end_ns, cursor)
+                if e > best_end:
+                    best, best_end = k, e
+        if best is None:
+            break
+        self_ns += cursor - best_end
+        out.extend(critical_path(best, children, best_end))
+        cursor = max(best.start_ns, node.start_ns)
+    self_ns += max(0, cursor - node.start_ns)
+    out.append((node, self_ns))
+    return out
+
+
+class TraceAnalytics:
+    """
+    流式统计，内存有界：
+    - 分位数：每个 span 名 / tool.name / react.step 序号一个对数直方图（O(桶数)）
+    - 关键路径 / 火焰图要整棵子树：按 trace 暂存 span，等 agent.run（最后结束、最后写入）到了就处理并释放；
+      不在任何 run 子树里的 span（HTTP 请求 span 之类）在 run 结束或 trace 根 span 到达时，
+      只要祖先链已经完整（不挂在还没结束的 run 下面）就一起释放；
+      暂存总量超过 max_buffered_spans 时淘汰最老的 trace（计入 evicted_traces）
+    """
+
+    def __init__(self, *, root_name: str = "agent.run", max_buffered_spans: int = 200_000) -> None:
+        self.root_name = root_name
+        self.max_buffered_spans = max_buffered_spans
+        self.by_name: Dict[str, LatencyHistogram] = {}
+        self.by_tool: Dict[str, LatencyHistogram] = {}
+        self.by_step: Dict[str, LatencyHistogram] = {}
+        self.run_hist = LatencyHistogram()
+        self.critical_ns: Dict[str, int] = {}
+        self.folded: Dict[str, int] = {}
+        self.spans = 0
+        self.runs = 0
+        self.errors = 0
+        self.evicted_traces = 0
+        self._buffer: "OrderedDict[str, List[Span]]" = OrderedDict()
+        self._buffered = 0
+
+    @staticmethod
+    def _hist(d: Dict[str, LatencyHistogram], key: str) -> LatencyHistogram:
+        h = d.get(key)
+        if h is None:
+            h = d[key] = LatencyHistogram()
+        return h
+
+    def add(self, s: Span) -> None:
+        self.spans += 1
+        if "ERROR" in (s.status or ""):
+            self.errors += 1
+        dur_s = s.dur_ms / 1000.0
+        self._hist(self.by_name, s.name).record(dur_s)
+        if s.name == "tool.run":
+            tool = s.attributes.get("tool.name")
+            if tool:
+                self._hist(self.by_tool, str(tool)).record(dur_s)
+        elif s.name == "react.step" and s.attributes.get("step") is not None:
+            self._hist(self.by_step, str(s.attributes["step"])).record(dur_s)
+
+        if s.name == self.root_name:
+            self._finish_run(s)
+            return
+        if not s.parent_span_id:
+            # trace 根（一般是 HTTP server span）最后结束：之前挂在它下面的 span 都可以放了
+            self._release_settled(s.trace_id, s)
+            return
+        buf = self._buffer.get(s.trace_id)
+        if buf is None:
+            buf = self._buffer[s.trace_id] = []
+        buf.append(s)
+        self._buffered += 1
+        while self._buffered > self.max_buffered_spans and self._buffer:
+            _, dropped = self._buffer.popitem(last=False)
+            self._buffered -= len(dropped)
+            self.evicted_traces += 1
+
+    def _finish_run(self, root: Span) -> None:
+        self.runs += 1
+        self.run_hist.record(root.dur_ms / 1000.0)
+        buf = self._buffer.pop(root.trace_id, [])
+        self._buffered -= len(buf)
+
+        children: Dict[str, List[Span]] = {}
+        for s in buf:
+            if s.parent_span_id:
+                children.setdefault(s.parent_span_id, []).append(s)
+
+        used: set = set()
+
+        def _walk(node: Span, stack: str) -> None:
+            used.add(node.span_id)
+            kids = children.get(node.span_id, [])
+            self.folded[stack] = self.folded.get(stack, 0) + _exclusive_ns(node, kids) // 1000
+            for k in kids:
+                _walk(k, f"{stack};{fold_label(k)}")
+
+        _walk(root, fold_label(root))
+        for node, ns in critical_path(root, children):
+            label = fold_label(node)
+            self.critical_ns[label] = self.critical_ns.get(label, 0) + ns
+
+        # 同一 trace 里不属于这次 run 的 span：祖先链完整的（HTTP span 等）直接放掉，
+        # 挂在别的还没结束的 run 下面的继续留着
+        rest = [s for s in buf if s.span_id not in used]
+        if rest:
+            self._buffer[root.trace_id] = rest
+            self._buffered += len(rest)
+            self._release_settled(root.trace_id, root)
+
+    def _release_settled(self, trace_id: str, anchor: Span) -> None:
+        """释放该 trace 里祖先链能走到 anchor / trace 根（都已结束）的暂存 span。"""
+        buf = self._buffer.get(trace_id)
+        if not buf:
+            return
+        by_id = {s.span_id: s for s in buf}
+        settled: Dict[str, bool] = {anchor.span_id: True}
+
+        def _settled(s: Span) -> bool:
+            chain = []
+            cur: Optional[Span] = s
+            ok = False
+            while cur is not None:
+                known = settled.get(cur.span_id)
+                if known is not None:
+                    ok = known
+                    break
+                chain.append(cur.span_id)
+                if not cur.parent_span_id:
+                    ok = True
+                    break
+                if cur.parent_span_id in settled:
+                    ok = settled[cur.parent_span_id]
+                    break
+                cur = by_id.get(cur.parent_span_id)  # 父 span 还没到 / 还没结束 -> None -> 不能放
+            for sid in chain:
+                settled[sid] = ok
+            return ok
+
+        keep = [s for s in buf if not _settled(s)]
+        self._buffered -= len(buf) - len(keep)
+        if keep:
+            self._buffer[trace_id] = keep
+        else:
+            del self._buffer[trace_id]
+
+    def folded_lines(self) -> List[str]:
+        """Brendan Gregg folded 格式：栈;以;分号分隔 + 空格 + 自身耗时（微秒）。"""
+        return [f"{stack} {us}" for stack, us in sorted(self.folded.items()) if us > 0]
+
+    def summary(self, top: int = 20) -> Dict[str, Any]:
+        total_crit = sum(self.critical_ns.values()) or 1
+        crit = sorted(self.critical_ns.items(), key=lambda kv: kv[1], reverse=True)[:top]
+        return {
+            "spans": self.spans,
+            "errors": self.errors,
+            "agent_runs": self.runs,
+            "evicted_traces": self.evicted_traces,
+            "agent_run": self.run_hist.snapshot(),
+            "by_span_name": {k: v.snapshot() for k, v in sorted(self.by_name.items())},
+            "by_tool": {k: v.snapshot() for k, v in sorted(self.by_tool.items())},
+            "by_react_step": {k: v.snapshot() for k, v in sorted(self.by_step.items(), key=lambda kv: int(kv[0]) if kv[0].isdigit() else 0)},
+            "critical_path": [
+                {
+                    "label": label,
+                    "total_ms": round(ns / 1e6, 1),
+                    "per_run_ms": round(ns / 1e6 / max(self.runs, 1), 2),
+                    "share": round(ns / total_crit, 4),
+                }
+                for label, ns in crit
+            ],
+        }
+
+
+def iter_spans(jsonl_path: str, start_ns: Optional[int] = None, end_ns: Optional[int] = None) -> Iterator[Span]:
+    """流式读活跃文件和所有轮转分段（不整体载入），可按 span 时间过滤。"""
+    from agentlab.observability.segments import iter_lines, segment_paths
+
+    for line in iter_lines(segment_paths(jsonl_path) or [jsonl_path]):
+        try:
+            obj = json.loads(line)
+        except Exception:
+            continue
+        s = span_from_obj(obj)
+        if start_ns is not None and s.end_ns < start_ns:
+            continue
+        if end_ns is not None and s.start_ns > end_ns:
+            continue
+        yield s
+
+
+def print_summary(summary: Dict[str, Any]) -> None:
+    def _row(name: str, snap: Dict[str, Any]) -> str:
+        return f"  {name:<48} n={snap['count']:<7} p50={snap['p50_ms']}  p95={snap['p95_ms']}  p99={snap['p99_ms']} ms"
+
+    print(f"spans={summary['spans']}  errors={summary['errors']}  agent_runs={summary['agent_runs']}"
+          f"  evicted_traces={summary['evicted_traces']}")
+    for title, key in (("by span name", "by_span_name"), ("by tool.name", "by_tool"), ("by react.step", "by_react_step")):
+        if summary[key]:
+            print(f"\n{title}:")
+            for name, snap in summary[key].items():
+                print(_row(name, snap))
+    if summary["critical_path"]:
+        print("\ncritical path of agent.run (where the time goes):")
+        for c in summary["critical_path"]:
+            print(f"  {c['label']:<48} {c['share'] * 100:5.1f}%  {c['per_run_ms']} ms/run")
+
+
 def main() -> None:
     ap = argparse.ArgumentParser()
-    ap.add_argument("--trace-id", required=True, help="要查看的 trace_id（从 SSE 输出里复制）")
+    ap.add_argument("--trace-id", default=None, help="要查看的 trace_id（从 SSE 输出里复制）；不给则按条件列出 trace")
     ap.add_argument("--file", default=os.path.join("logs", "traces.jsonl"), help="traces.jsonl 路径")
     ap.add_argument("--show-ids", action="store_true", help="显示 span_id/parent_span_id 方便精确对照")
+    ap.add_argument("--index", default=None, help="SQLite 索引路径（默认 logs/traces.index.sqlite，存在就用）")
+    ap.add_argument("--no-index", action="store_true", help="不用索引，全量扫描 JSONL")
+    ap.add_argument("--where", action="append", default=[], metavar="KEY=VALUE",
+                    help="属性过滤，可重复，如 tool.name=calc / span.name=agent.run / span.status=ERROR")
+    ap.add_argument("--since", default=None, help="起始时间：epoch 秒 / ISO 时间 / 相对时间如 2h")
+    ap.add_argument("--until", default=None, help="结束时间，格式同 --since")
+    ap.add_argument("--limit", type=int, default=50, help="列出 trace 时最多几条")
+    ap.add_argument("--analyze", action="store_true", help="跨 trace 分析（分位数 / 关键路径 / 火焰图）")
+    ap.add_argument("--folded", default=None, help="--analyze 时输出 folded-stack 文件（flamegraph.pl / speedscope）")
+    ap.add_argument("--json", default=None, help="--analyze 时输出 JSON 汇总（- 表示 stdout）")
+    ap.add_argument("--max-buffered-spans", type=int, default=200_000, help="--analyze 暂存 span 上限（控制内存）")
     args = ap.parse_args()
 
-    spans = load_spans(args.file, args.trace_id)
+    index = None if args.no_index else open_index(args.file, args.index)
+
+    if args.analyze:
+        where = {}
+        for item in args.where:
+            k, sep, v = item.partition("=")
+            if not sep:
+                ap.error(f"--where 需要 KEY=VALUE 形式：{item}")
+            where[k] = v
+        start_ns, end_ns = parse_time(args.since), parse_time(args.until)
+        an = TraceAnalytics(max_buffered_spans=args.max_buffered_spans)
+        if where:
+            if index is None:
+                ap.error("--where 需要索引：先运行 python -m agentlab.observability.trace_index " + args.file)
+            rows = index.find_traces(start_ns=start_ns, end_ns=end_ns, where=where, limit=1 << 62)
+            for r in rows:
+                # 同一 trace 内按结束时间喂，保证 agent.run 在它的子 span 之后
+                for sp in sorted((span_from_obj(o) for o in index.read_records(r["trace_id"])), key=lambda x: x.end_ns):
+                    an.add(sp)
+        else:
+            for sp in iter_spans(args.file, start_ns, end_ns):
+                an.add(sp)
+        summary = an.summary()
+        if args.folded:
+            with open(args.folded, "w", encoding="utf-8") as f:
+                f.write("\n".join(an.folded_lines()) + "\n")
+        if args.json == "-":
+            print(json.dumps(summary, ensure_ascii=False, indent=2))
+            return
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(summary, f, ensure_ascii=False, indent=2)
+        print_summary(summary)
+        return
+
+    if not args.trace_id:
+        if index is None:
+            ap.error("列出 trace 需要索引：先运行 python -m agentlab.observability.trace_index " + args.file)
+        where = {}
+        for item in args.where:
+            k, sep, v = item.partition("=")
+            if not sep:
+                ap.error(f"--where 需要 KEY=VALUE 形式：{item}")
+            where[k] = v
+        rows = index.find_traces(
+            start_ns=parse_time(args.since), end_ns=parse_time(args.until), where=where, limit=args.limit
+        )
+        print(f"matched traces={len(rows)}")
+        print_trace_list(rows)
+        return
+
+    spans = load_spans(args.file, args.trace_id, index=index)
     if not spans:
         print(f"未找到 trace_id={args.trace_id} 的 spans。请确认文件路径和 trace_id 是否正确。")
         return
@@ -0,0 +1,21 @@
+import pytest
+
+from agentlab.tools import calc_engine
+
+
+@pytest.mark.parametrize("expr", ["round(7, -10**7)", "round(1, -(10**300))", "round(1, 10**4)", "round(1, 2.5)"])
+def test_round_ndigits_is_bounded(expr):
+    # 不限 ndigits 时 round(7, -10**7) 会把执行它的线程卡死（超时也停不掉 to_thread 里的线程）
+    with pytest.raises(calc_engine.CalcError):
+        calc_engine.evaluate(expr)
+
+
+def test_round_ndigits_is_bounded_vectorized():
+    with pytest.raises(calc_engine.CalcError):
+        calc_engine.evaluate_vector("round(x, -10**7)", {"x": [1.0, 2.0]})
+
+
+def test_round_within_limits():
+    assert calc_engine.evaluate("round(3.14159, 2)") == 3.14
+    assert calc_engine.evaluate("round(1234, -2)") == 1200
+    assert calc_engine.evaluate_vector("round(x, 1)", {"x": [1.26, 2.34]}) == [1.3, 2.3]